@@ -0,0 +1,384 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, TensorDataset, DataLoader
+
+
+def to_uint8(data):
+    """ quantizes pixel data normalized to [0, 1] back to uint8, lossless for 8-bit frames divided by 255 """
+    if data.min() < 0 or data.max() > 1:
+        raise ValueError("uint8 storage requires data in [0, 1], e.g. frames divided by 255")
+    return torch.round(data * 255.).to(torch.uint8)
+
+
+def from_uint8(data):
+    return data.float() / 255. if data.dtype == torch.uint8 else data
+
+
+class RunningMoments:
+    def __init__(self, count=0, mean=0., m2=0.):
+        """
+        Count, mean and sum of squared deviations from the mean (M2) of a set of samples, component-wise in float64.
+        Moments of disjoint parts are merged exactly with the pairwise update of Chan et al., so the moments of a dataset
+        can be updated with new data without revisiting the old.
+        """
+        self.count = int(count)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.m2 = np.asarray(m2, dtype=np.float64)
+
+    @classmethod
+    def from_data(cls, data, chunk_size=256):
+        """ :param data: (N, ...) array, the moments are computed in two passes over row chunks """
+        def chunks():
+            for start in range(0, len(data), chunk_size):
+                yield np.asarray(data[start:start + chunk_size], dtype=np.float64)
+
+        mean = sum(chunk.sum(axis=0) for chunk in chunks()) / max(len(data), 1)
+        m2 = sum(((chunk - mean) ** 2).sum(axis=0) for chunk in chunks())
+        return cls(len(data), mean, m2)
+
+    def merge(self, other):
+        """ :return: RunningMoments of the union of both sets of samples """
+        if self.count == 0 or other.count == 0:
+            return other if self.count == 0 else self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        return RunningMoments(count, self.mean + delta * other.count / count, self.m2 + other.m2 + delta ** 2 * self.count * other.count / count)
+
+    def update(self, data):
+        merged = self.merge(RunningMoments.from_data(data))
+        self.count, self.mean, self.m2 = merged.count, merged.mean, merged.m2
+        return self
+
+    def std(self, unbiased=True):
+        return np.sqrt(self.m2 / max(self.count - 1 if unbiased else self.count, 1))
+
+    def state_dict(self):
+        return dict(count=self.count, mean=self.mean, m2=self.m2)
+
+
+def patch_grid(frame_shape, patch_size, patch_stride=None):
+    """ :return: rows, columns of the patch grid, border pixels that do not fill a patch are dropped """
+    patch_stride = patch_stride or patch_size
+    return (frame_shape[0] - patch_size) // patch_stride + 1, (frame_shape[1] - patch_size) // patch_stride + 1
+
+
+def num_patches(frame_shape, patch_size, patch_stride=None):
+    rows, columns = patch_grid(frame_shape, patch_size, patch_stride)
+    return rows * columns
+
+
+def unfold_patches(frames, frame_shape, patch_size, patch_stride=None):
+    """
+    Unfolds flattened frames into patches with a single F.unfold, row-major over the patch grid.
+
+    :param frames: (N, H * W) flattened frames
+    :param patch_stride: defaults to patch_size, i.e. non-overlapping patches
+    :return: (N, P, patch_size ** 2) flattened patches
+    """
+    patches = F.unfold(frames.reshape(-1, 1, *frame_shape), kernel_size=patch_size, stride=patch_stride or patch_size)
+    return patches.transpose(1, 2)
+
+
+def fold_patch_scores(patch_scores, frame_shape, patch_size, patch_stride=None):
+    """
+    Pixel-level anomaly maps from patch scores, every pixel gets the mean score of the patches covering it
+    and pixels not covered by any patch are zero.
+
+    :param patch_scores: (N, P) scores of the patches of every frame in the order of unfold_patches
+    :return: (N, H, W) anomaly maps
+    """
+    patch_scores = torch.as_tensor(patch_scores, dtype=torch.float32)
+    patch_stride = patch_stride or patch_size
+    columns = patch_scores[:, None, :].expand(-1, patch_size ** 2, -1)  # every pixel of a patch gets the patch score
+    summed = F.fold(columns, output_size=frame_shape, kernel_size=patch_size, stride=patch_stride)
+    counts = F.fold(torch.ones_like(columns[:1]), output_size=frame_shape, kernel_size=patch_size, stride=patch_stride)
+    return (summed / counts.clamp(min=1))[:, 0]
+
+
+CORESET_METHODS = ["k_center", "frame_difference"]
+
+
+def k_center_greedy(features, n):
+    """
+    Greedy k-center coreset: starting from the sample closest to the mean, repeatedly adds the sample farthest from
+    the selected ones, so that every sample is close to a selected one. One distance pass over the samples per
+    selected sample.
+
+    :param features: (N, d) features of the samples, e.g. downsampled frames
+    :param n: size of the coreset
+    :return: sorted indices of the n selected samples
+    """
+    features = torch.as_tensor(features, dtype=torch.float32)
+    n = min(n, len(features))
+    selected = [int(torch.cdist(features.mean(dim=0, keepdim=True), features)[0].argmin())]
+    min_distances = torch.full((len(features),), float("inf"))
+    while len(selected) < n:
+        min_distances = torch.minimum(min_distances, torch.cdist(features[selected[-1]][None], features)[0])
+        selected.append(int(min_distances.argmax()))
+    return np.sort(np.asarray(selected, dtype=np.int64))
+
+
+def frame_difference_selection(features, video_lengths, threshold):
+    """
+    Temporal deduplication: keeps the first frame of every video and every frame whose mean absolute difference to
+    the last kept frame of its video exceeds threshold.
+
+    :param features: (N, d) features of consecutive frames of the videos, e.g. downsampled frames in [0, 1]
+    :param video_lengths: number of frames of every video, summing to N
+    :return: sorted indices of the kept frames
+    """
+    features = np.asarray(features)
+    selected, offset = [], 0
+    for length in video_lengths:
+        last = offset
+        selected.append(offset)
+        for idx in range(offset + 1, offset + length):
+            if np.abs(features[idx] - features[last]).mean() > threshold:
+                selected.append(idx)
+                last = idx
+        offset += length
+    return np.asarray(selected, dtype=np.int64)
+
+
+TEMPORAL_MODES = ["frames", "differences"]
+
+
+def temporal_inputs(windows, mode="frames"):
+    """
+    :param windows: (B, K, D) windows of K consecutive frames, oldest first
+    :param mode: "frames" stacks the K frames, "differences" the last frame and the K - 1 differences of consecutive frames
+    :return: (B, K * D) inputs
+    """
+    if mode == "differences":
+        windows = torch.cat([windows[:, -1:], windows[:, 1:] - windows[:, :-1]], dim=1)
+    elif mode != "frames":
+        raise ValueError(f"Unknown temporal mode '{mode}', expected one of {TEMPORAL_MODES}")
+    return windows.reshape(windows.shape[0], -1)
+
+
+class TemporalWindowDataset(Dataset):
+    def __init__(self, data, labels, video_lengths, K, mode="frames", device="cpu"):
+        """
+        Inputs of K consecutive frames of the same video, one per frame, labeled like the frame ending the window.
+        Every video is preceded by K - 1 copies of its first frame, so the first frames of a video get a window as well
+        and the scores stay aligned with the frames. The windows are a strided view over the padded frames,
+        a batch of windows is gathered with a single index operation, there are no per-sample copies.
+
+        :param data: (N, D) frames of consecutive videos, as returned by get_dataset
+        :param video_lengths: number of frames of every video, summing to N
+        """
+        if sum(video_lengths) != len(data):
+            raise ValueError(f"video lengths sum to {sum(video_lengths)}, but there are {len(data)} frames")
+        self.K = K
+        self.mode = mode
+        data = torch.as_tensor(data).reshape(len(data), -1)
+        pieces, window_starts, offset, padded_offset = [], [], 0, 0
+        for length in video_lengths:
+            video = data[offset:offset + length]
+            pieces += [video[:1].expand(K - 1, -1), video]
+            window_starts.append(torch.arange(padded_offset, padded_offset + length))  # window of frame t starts at t - K + 1 in padded order
+            offset += length
+            padded_offset += length + K - 1
+        self.padded = torch.cat(pieces).to(device)
+        frame_dim = self.padded.shape[1]
+        self.windows = self.padded.as_strided((len(self.padded) - K + 1, K, frame_dim), (frame_dim, frame_dim, 1))
+        self.window_index = torch.cat(window_starts).to(device) if window_starts else torch.zeros(0, dtype=torch.long, device=device)
+        self.labels = torch.as_tensor(labels).to(device)
+
+    def __len__(self):
+        return len(self.window_index)
+
+    def __getitem__(self, idx):
+        return self.batch(torch.as_tensor([idx], device=self.padded.device))[0][0], self.labels[idx]
+
+    def batch(self, indices):
+        """ :return: (B, K * D) inputs and (B,) labels of the frames at indices """
+        return temporal_inputs(from_uint8(self.windows[self.window_index[indices]]), self.mode), self.labels[indices]
+
+    def moments(self, batch_size=256, indices=None):
+        """
+        :param indices: optional subset of the frames, e.g. a coreset
+        :return: RunningMoments of the (K * D)-dimensional inputs, e.g. for their standardization
+        """
+        indices = torch.arange(len(self)) if indices is None else torch.as_tensor(indices)
+        moments = RunningMoments()
+        for start in range(0, len(indices), batch_size):
+            inputs = self.batch(indices[start:start + batch_size].to(self.padded.device))[0]
+            moments = moments.merge(RunningMoments.from_data(inputs.cpu().numpy()))
+        return moments
+
+
+class TemporalWindowLoader:
+    def __init__(self, dataset, batch_size, shuffle=False, sampler=None, indices=None):
+        """
+        Iterates batches of a TemporalWindowDataset, like DeviceTensorLoader the batches are formed by indexing.
+
+        :param sampler: optional sampler of indices, e.g. a DistributedSampler, replaces shuffle
+        :param indices: optional subset of the frames, e.g. the contiguous shard of a rank (see distributed_utils.shard_bounds)
+        """
+        self.full_dataset = dataset
+        self.indices = torch.arange(len(dataset)) if indices is None else torch.as_tensor(indices)
+        self.dataset = self.indices  # len(loader.dataset) is the number of frames scored, see eval_utils.calculate_scores
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sampler = sampler
+
+    def __len__(self):
+        n = len(self.sampler) if self.sampler is not None else len(self.indices)
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.sampler is not None:
+            indices = self.indices[torch.as_tensor(list(self.sampler))]
+        elif self.shuffle:
+            indices = self.indices[torch.randperm(len(self.indices))]
+        else:
+            indices = self.indices
+        indices = indices.to(self.full_dataset.padded.device)
+        for start in range(0, len(indices), self.batch_size):
+            yield self.full_dataset.batch(indices[start:start + self.batch_size])
+
+
+class TemporalRingBuffer:
+    def __init__(self, K, frame_dim, mode="frames", device="cpu"):
+        """
+        Streaming counterpart of TemporalWindowDataset, holds the last K frames of a video.
+        Every frame is written twice, at position p and p + K of a 2K buffer, so the last K frames are always
+        the contiguous slice [p + 1, p + K + 1), a view without copies. Before K frames were pushed the window is
+        padded with the first frame, as in training.
+        """
+        self.K = K
+        self.mode = mode
+        self.buffer = torch.zeros((2 * K, frame_dim), device=device)
+        self.reset()
+
+    def reset(self):
+        """ call at the start of every video """
+        self.position = -1
+
+    def push(self, frame):
+        """
+        :param frame: (D,) frame
+        :return: (K * D,) input of the window ending with the frame, in "frames" mode a view of the buffer that is
+                 overwritten by the next push
+        """
+        frame = frame.reshape(-1).to(self.buffer.device)
+        if self.position < 0:
+            self.buffer[:] = frame  # pad with the first frame of the video
+            self.position = 0
+        self.position = (self.position + 1) % self.K
+        self.buffer[self.position] = frame
+        self.buffer[self.position + self.K] = frame
+        return temporal_inputs(self.buffer[self.position + 1:self.position + self.K + 1][None], self.mode)[0]
+
+    def push_batch(self, frames):
+        """ :return: (B, K * D) inputs of consecutive frames (B, D) of the current video """
+        inputs = torch.empty((len(frames), self.K * self.buffer.shape[1]), device=self.buffer.device)
+        for i, frame in enumerate(frames):
+            inputs[i] = self.push(frame)
+        return inputs
+
+
+class DeviceTensorLoader:
+    def __init__(self, data, labels, batch_size, shuffle=False, device="cpu", sampler=None):
+        """
+        Iterates batches of a dataset that is uploaded to the device once.
+        Batches are formed by indexing with a per-epoch random permutation, there is no collation and no host to device copy.
+
+        :param data: (N, ...) tensor, float or uint8 (converted to float in [0, 1] per batch)
+        :param labels: (N,) tensor
+        :param sampler: optional sampler of indices, e.g. a DistributedSampler, replaces shuffle
+        """
+        self.dataset = TensorDataset(data.to(device), labels.to(device))
+        self.batch_size = batch_size
+        self.shuffle = shuffle or sampler is not None
+        self.device = device
+        self.sampler = sampler
+
+    def __len__(self):
+        n = len(self.sampler) if self.sampler is not None else len(self.dataset)
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        data, labels = self.dataset.tensors
+        if self.sampler is not None:
+            indices = torch.as_tensor(list(self.sampler), device=data.device)
+        elif self.shuffle:
+            indices = torch.randperm(len(data), device=data.device)
+        for start in range(0, len(indices) if self.shuffle else len(data), self.batch_size):
+            if self.shuffle:
+                batch_indices = indices[start:start + self.batch_size]
+                yield from_uint8(data[batch_indices]), labels[batch_indices]
+            else:
+                yield from_uint8(data[start:start + self.batch_size]), labels[start:start + self.batch_size]
+
+
+class PrefetchLoader:
+    def __init__(self, dataloader, device):
+        """
+        Wraps a DataLoader with pinned memory, the next batch is copied to the device with non_blocking copies
+        (on a side stream for CUDA) while the current batch is processed.
+        """
+        self.dataloader = dataloader
+        self.dataset = dataloader.dataset
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _to_device(self, batch):
+        return [from_uint8(t.to(self.device, non_blocking=True)) for t in batch]
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for batch in self.dataloader:
+                yield self._to_device(batch)
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        next_batch = None
+        for batch in self.dataloader:
+            with torch.cuda.stream(stream):
+                batch = self._to_device(batch)
+            if next_batch is not None:
+                yield next_batch
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            for t in batch:
+                t.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = batch
+        if next_batch is not None:
+            yield next_batch
+
+
+def fits_on_device(nbytes, device, max_fraction=0.5):
+    """ True if nbytes take at most max_fraction of the free memory of a CUDA device, always True for the CPU """
+    device = torch.device(device)
+    if device.type != "cuda":
+        return True
+    free, _ = torch.cuda.mem_get_info(device)
+    return nbytes <= max_fraction * free
+
+
+def get_dataloader(data, labels, batch_size, shuffle, device, device_resident=False, uint8=False, sampler=None):
+    """
+    :param data: (N, ...) float tensor
+    :param labels: (N,) tensor
+    :param device_resident: if True, keep the whole dataset on the device (DeviceTensorLoader) if it fits,
+            otherwise fall back to a pinned-memory PrefetchLoader
+    :param uint8: store the data as uint8, 4x less memory and host to device traffic, requires data in [0, 1]
+    :param sampler: optional sampler, e.g. a DistributedSampler for sharding the data across ranks, replaces shuffle
+    :return: iterable of (data, labels) batches, the default is a plain DataLoader as used for training so far
+    """
+    if sampler is not None:
+        shuffle = False  # the sampler shuffles
+    if not device_resident:
+        return DataLoader(TensorDataset(data, labels), shuffle=shuffle, batch_size=batch_size, sampler=sampler)
+
+    if uint8:
+        data = to_uint8(data)
+    if fits_on_device(data.element_size() * data.nelement(), device):
+        return DeviceTensorLoader(data, labels, batch_size=batch_size, shuffle=shuffle, device=device, sampler=sampler)
+    print(f"Dataset of shape {tuple(data.shape)} does not fit on {device}, using a pinned-memory prefetching loader")
+    return PrefetchLoader(DataLoader(TensorDataset(data, labels), shuffle=shuffle, batch_size=batch_size, sampler=sampler,
+                                     pin_memory=torch.device(device).type == "cuda"), device)
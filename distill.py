@@ -0,0 +1,194 @@
+"""
+Distill a model trained with --save_checkpoint into a compact student MLP
+
+# student with two layers of 256 units on the full-resolution frames
+python distill.py --checkpoint runs/MULDE/<timestamp>/checkpoint.pt --units 256 256
+
+# student on frames average-pooled 4x4 (60x90 instead of 240x360), 16x fewer inputs
+python distill.py --checkpoint runs/MULDE/<timestamp>/checkpoint.pt --units 256 256 --input_pool 4
+
+The student is trained to match the teacher's log-densities and scores of training frames at the sigma grid of the
+evaluation (eval_utils.get_sigmas with the teacher's L, sigma_low, sigma_high). On full-resolution inputs the score
+vectors are matched, on pooled inputs the squared score norms (in log space) since the input spaces differ.
+The student is saved to <log_path>/checkpoint.pt with the pooling factor, teacher and student AUC-ROC and latency are reported.
+"""
+
+import argparse
+import time
+import numpy as np
+import torch
+import torch.optim as optim
+from tqdm import tqdm
+import utils
+import data_utils
+import eval_utils
+from models import MLPs, ScoreOrLogDensityNetwork, load_checkpoint, save_checkpoint
+from uscd_dataset_loader import get_dataset
+
+data_dir = "UCSD_Anomaly_Dataset.v1p2/UCSDped2"
+m_file_path = "UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test/UCSDped2.m"
+
+
+def latency(model, frames, sigma_L, mean, std, pool, frame_shape, device, repeats=10):
+    """ :return: milliseconds per frame of pooling, standardization and the multiscale log-densities and score norms """
+    sigmas = torch.tensor(sigma_L, device=device)
+    frames = frames.to(device)
+    gram = model.score_norm_gram()
+    model.eval()
+
+    def run():
+        x = eval_utils.standardize(eval_utils.pool_frames(frames, frame_shape, pool), mean.to(device), std.to(device))
+        model.multiscale_log_density_and_score_norm(x, sigmas, gram=gram)
+
+    run()  # warm-up
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        run()
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats / len(frames) * 1e3
+
+
+def distill(args):
+    teacher, checkpoint = load_checkpoint(args.checkpoint, device=args.device)
+    if checkpoint.get("standardization_folded"):
+        raise ValueError("distillation trains in the standardized input space, use the checkpoint.pt the folded checkpoint was exported from")
+    if checkpoint.get("input_pool", 1) > 1 or checkpoint.get("patch_size"):
+        raise ValueError("the teacher must consume whole frames, distilling a student with input_pool > 1 or a patch model is not supported")
+    if checkpoint.get("temporal_frames", 1) > 1:
+        raise ValueError("the teacher must consume single frames, distilling a model trained with --temporal_frames is not supported")
+    teacher.requires_grad_(False)
+    teacher_mean, teacher_std = checkpoint["data_train_mean"].to(args.device), checkpoint["data_train_std"].to(args.device)
+    sigma_L = eval_utils.get_sigmas(checkpoint.get("L", 16), checkpoint.get("sigma_low", 1e-3), checkpoint.get("sigma_high", 1.))
+    sigma_grid = torch.tensor(sigma_L, device=args.device)
+    # frames at the resolution of the teacher, the student input is pooled from these
+    frame_shape = tuple(size // (checkpoint.get("resolution") or 1) for size in args.frame_shape)
+    teacher_pixels = checkpoint.get("static_pixel_indices")  # pixels of a teacher trained with --static_pixel_threshold
+
+    def teacher_input(frames):
+        return frames if teacher_pixels is None else frames[:, teacher_pixels.to(frames.device)]
+
+    def student_input(frames):
+        # without pooling the student has the same input space as the teacher
+        return eval_utils.pool_frames(frames, frame_shape, args.input_pool) if args.input_pool > 1 else teacher_input(frames)
+
+    data_train, labels_train, data_test, labels_test, _ = get_dataset(data_dir, m_file_path, resolution=checkpoint.get("resolution"))
+    data_train = torch.Tensor(data_train)
+    data_test = torch.Tensor(data_test)
+
+    data_train_pooled = student_input(data_train)
+    student_mean, student_std = data_train_pooled.mean(dim=0), data_train_pooled.std(dim=0)
+    if args.input_pool == 1:
+        student_mean, student_std = checkpoint["data_train_mean"], checkpoint["data_train_std"]  # same input space as the teacher
+    del data_train_pooled
+
+    model_config = dict(input_dim=student_input(data_train[:1]).shape[1] + 1,  # +1 for noise conditioning
+                        units=args.units,
+                        dropout=None,
+                        layernorm=args.layernorm)
+    student = ScoreOrLogDensityNetwork(MLPs(**model_config), score_network=False).to(args.device)
+    optimizer = optim.Adam(student.parameters(), lr=args.lr, betas=(0.5, 0.9))
+    log_path, summary_writer = utils.get_log_path_and_summary_writer(root_dir_runs="runs", experiment_name=args.experiment_name, args=args)
+    utils.save_current_experiment_source_code(log_path)
+
+    dataloader_train = data_utils.get_dataloader(data_train, torch.Tensor(labels_train), batch_size=args.batch_size, shuffle=True,
+                                                 device=args.device, device_resident=args.device_resident)
+    for epoch in range(args.epochs):
+        with tqdm(dataloader_train) as tepoch:
+            tepoch.set_description(f"Distill Epoch {epoch}")
+            student.train()
+            loss_accumulate_train = utils.LossAccumulate()
+            for data in tepoch:
+                frames = data[0].to(args.device)
+                frames = frames.reshape(frames.shape[0], -1)
+                # one sigma of the evaluation grid per sample
+                sigma = sigma_grid[torch.randint(len(sigma_L), (frames.shape[0],), device=args.device)].unsqueeze(1)
+
+                x_teacher = eval_utils.standardize(teacher_input(frames), teacher_mean, teacher_std).requires_grad_()
+                score_teacher, log_density_teacher = teacher.score(torch.hstack([x_teacher, sigma]), return_log_density=True)
+                score_teacher, log_density_teacher = score_teacher[:, :-1].detach(), log_density_teacher.detach()
+
+                x_student = eval_utils.standardize(student_input(frames), student_mean.to(args.device), student_std.to(args.device))
+                score_student, log_density_student = student.score(torch.hstack([x_student.requires_grad_(), sigma]), return_log_density=True)
+                score_student = score_student[:, :-1]
+
+                loss_log_density = ((log_density_student - log_density_teacher) ** 2).mean()
+                if args.input_pool == 1:
+                    # sigma^2 weighting as in the DSM loss, balances the score magnitudes across sigmas
+                    loss_score = ((sigma ** 2).ravel() * ((score_student - score_teacher) ** 2).sum(dim=1)).mean() / 2.
+                else:
+                    score_norm_teacher = (score_teacher ** 2).sum(dim=1)
+                    score_norm_student = (score_student ** 2).sum(dim=1)
+                    loss_score = ((torch.log(score_norm_student + 1e-8) - torch.log(score_norm_teacher + 1e-8)) ** 2).mean()
+                loss = args.alpha * loss_log_density + loss_score
+
+                optimizer.zero_grad()
+                loss.backward()
+                utils.clip_and_track_gradients(student.parameters(), args.gradient_clipping)
+                optimizer.step()
+
+                loss_accumulate_train["loss_log_density"].append(loss_log_density.item())
+                loss_accumulate_train["loss_score"].append(loss_score.item())
+                loss_accumulate_train["loss_distill"].append(loss.item())
+                tepoch.set_postfix(loss=loss.item())
+
+        for k, values in loss_accumulate_train.items():
+            summary_writer.add_scalar(f'loss_train/{k}', np.asarray(values).mean(), epoch)
+
+    save_checkpoint(f"{log_path}/checkpoint.pt", student, dict(model_config, score_network=False), student_mean, student_std,
+                    sigma_low=checkpoint.get("sigma_low", 1e-3), sigma_high=checkpoint.get("sigma_high", 1.), L=checkpoint.get("L", 16),
+                    input_pool=args.input_pool, frame_shape=frame_shape, resolution=checkpoint.get("resolution"),
+                    static_pixel_indices=teacher_pixels if args.input_pool == 1 else None)
+
+    # teacher vs student: AUC-ROC at every sigma and latency per frame
+    student.eval()
+    dataloader_teacher = data_utils.get_dataloader(teacher_input(data_test), torch.Tensor(labels_test), batch_size=args.batch_size,
+                                                   shuffle=False, device=args.device)
+    dataloader_student = data_utils.get_dataloader(student_input(data_test), torch.Tensor(labels_test), batch_size=args.batch_size,
+                                                   shuffle=False, device=args.device)
+    auc_teacher = eval_utils.per_sigma_aucs(teacher, dataloader_teacher, labels_test, sigma_L, teacher_mean, teacher_std, args.device)
+    auc_student = eval_utils.per_sigma_aucs(student, dataloader_student, labels_test, sigma_L, student_mean.to(args.device),
+                                            student_std.to(args.device), args.device)
+    for score_type_idx, score_type_ in enumerate(eval_utils.SCORE_TYPES):
+        for sigma, auc_teacher_, auc_student_ in zip(sigma_L, auc_teacher[:, score_type_idx].tolist(), auc_student[:, score_type_idx].tolist()):
+            summary_writer.add_scalar(f"roc_auc_{score_type_}_individual_teacher/sigma_{sigma}", auc_teacher_, 0)
+            summary_writer.add_scalar(f"roc_auc_{score_type_}_individual_student/sigma_{sigma}", auc_student_, 0)
+        print(f"{score_type_}: best AUC-ROC over sigmas teacher {auc_teacher[:, score_type_idx].max():.4f}, "
+              f"student {auc_student[:, score_type_idx].max():.4f}")
+
+    n_parameters_teacher = sum(p.numel() for p in teacher.parameters())
+    n_parameters_student = sum(p.numel() for p in student.parameters())
+    for batch_size in [1, args.batch_size]:
+        frames = data_test[:batch_size]
+        latency_teacher = latency(teacher, teacher_input(frames), sigma_L, teacher_mean, teacher_std, 1, frame_shape, args.device)
+        latency_student = latency(student, frames if args.input_pool > 1 else teacher_input(frames), sigma_L, student_mean, student_std,
+                                  args.input_pool, frame_shape, args.device)
+        print(f"latency at {len(sigma_L)} sigmas, batch size {len(frames)}: teacher {latency_teacher:.3f} ms/frame "
+              f"({n_parameters_teacher} parameters), student {latency_student:.3f} ms/frame ({n_parameters_student} parameters), "
+              f"{latency_teacher / latency_student:.1f}x faster")
+    print(f"Student saved to {log_path}/checkpoint.pt")
+    summary_writer.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True, help='teacher checkpoint.pt saved with --save_checkpoint')
+    parser.add_argument("--experiment_name", type=str, default="MULDE_distill")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--epochs", type=int, default=50, help='')
+    parser.add_argument("--lr", type=float, default=5e-4, help='')
+    parser.add_argument("--batch_size", type=int, default=256, help='')
+    parser.add_argument('--device_resident', action='store_true', help='keep the train set on the device and batch by indexing')
+    parser.set_defaults(device_resident=False)
+    parser.add_argument('--units', nargs='+', default=[256, 256], help='units of the student', type=int)
+    parser.add_argument('--layernorm', action='store_true')
+    parser.set_defaults(layernorm=False)
+    parser.add_argument("--input_pool", type=int, default=1, help='average pooling factor of the student input frames')
+    parser.add_argument("--frame_shape", nargs=2, type=int, default=[240, 360], help='height and width of the full resolution frames')
+    parser.add_argument("--alpha", type=float, default=1., help='weight of the log-density matching loss')
+    parser.add_argument('--gradient_clipping', type=float, default=None, help='value for gradient clipping')
+
+    args = parser.parse_args()
+    distill(args)
@@ -0,0 +1,181 @@
+import contextlib
+import datetime
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextlib.contextmanager
+def main_process_first():
+    """
+    Runs the block in rank 0 first, then in the first local process of every other node and then in the remaining processes,
+    so that files the block writes, e.g. the caches in cache/, are written by one process per filesystem while the others wait.
+    """
+    stage = 0 if is_main_process() else 1 if int(os.environ.get("LOCAL_RANK", 0)) == 0 else 2
+    for _ in range(stage):
+        barrier()
+    try:
+        yield
+    finally:
+        for _ in range(2 - stage):
+            barrier()
+
+
+def init_distributed(backend="gloo", threads_per_process=None, timeout_minutes=120):
+    """
+    Joins the process group described by the torchrun environment variables (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT).
+    torchrun limits every process to one OpenMP thread, the cores of the node are split between the local processes instead.
+
+    :param threads_per_process: intra-op threads of every process, defaults to the cores of the node / local processes
+    :param timeout_minutes: timeout of collectives, the other ranks wait in a barrier while rank 0 evaluates
+    :return: rank, world_size
+    """
+    dist.init_process_group(backend=backend, timeout=datetime.timedelta(minutes=timeout_minutes))
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", get_world_size()))
+    if threads_per_process is None:
+        threads_per_process = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(threads_per_process)
+    # different noise and sigmas on every rank, the model parameters are broadcast from rank 0 by DDP
+    torch.manual_seed(torch.initial_seed() + get_rank())
+    return get_rank(), get_world_size()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def _spawn_entry(local_rank, fn, args, nprocs, master_port):
+    os.environ.update(RANK=str(local_rank), LOCAL_RANK=str(local_rank), WORLD_SIZE=str(nprocs), LOCAL_WORLD_SIZE=str(nprocs),
+                      MASTER_ADDR=os.environ.get("MASTER_ADDR", "127.0.0.1"), MASTER_PORT=str(master_port))
+    fn(args)
+
+
+def launch(fn, args, nprocs, master_port=29500):
+    """
+    Runs fn(args) in nprocs local processes, unless the processes were already started by torchrun.
+    Multi-node training is launched with torchrun on every node.
+    """
+    if "RANK" in os.environ:
+        fn(args)
+    else:
+        mp.spawn(_spawn_entry, args=(fn, args, nprocs, master_port), nprocs=nprocs, join=True)
+
+
+class _ScoreAndLogDensity(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.score(x, return_log_density=True)
+
+
+class DistributedScore:
+    def __init__(self, model):
+        """
+        Data-parallel ScoreOrLogDensityNetwork.score, the gradients of the DSM loss are averaged over all ranks in backward.
+        DDP wraps the score computation and not the log-density network, so that the reduction hooks fire once
+        after the double backward through torch.autograd.grad(..., create_graph=True).
+        The bias of the last layer does not influence the score and has no gradient, hence find_unused_parameters=True.
+
+        :param model: ScoreOrLogDensityNetwork, its parameters are shared with the wrapper and synchronized with rank 0
+        """
+        self.model = model
+        self.ddp = DistributedDataParallel(_ScoreAndLogDensity(model), find_unused_parameters=True)
+
+    def __call__(self, x, return_log_density=False):
+        score, log_density = self.ddp(x)
+        if return_log_density:
+            return score, log_density
+        return score
+
+
+def shard_bounds(n, rank=None, world_size=None):
+    """ [start, end) of the contiguous shard of n samples of a rank, the first n % world_size ranks get one more sample """
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    shard_size, remainder = divmod(n, world_size)
+    start = rank * shard_size + min(rank, remainder)
+    return start, start + shard_size + (1 if rank < remainder else 0)
+
+
+def gather_shards(local, n):
+    """
+    Concatenates the contiguous shards (see shard_bounds) computed by all ranks on rank 0, in rank order,
+    so that the result is in the order of the unsharded dataset.
+    The shards are padded to the largest one and collected with a single gather.
+
+    :param local: (n_rank, ...) numpy array of the rank's shard
+    :param n: number of samples of the full dataset
+    :return: (n, ...) numpy array on rank 0, None on all other ranks
+    """
+    sizes = [end - start for start, end in (shard_bounds(n, rank_) for rank_ in range(get_world_size()))]
+    padded = torch.zeros((max(sizes),) + local.shape[1:], dtype=torch.from_numpy(local[:0]).dtype)
+    padded[:len(local)] = torch.from_numpy(local)
+    if not is_main_process():
+        dist.gather(padded, dst=0)
+        return None
+    gathered = [torch.empty_like(padded) for _ in sizes]
+    dist.gather(padded, gather_list=gathered, dst=0)
+    return torch.cat([shard[:size] for shard, size in zip(gathered, sizes)]).numpy()
+
+
+def distributed_mean_and_std(data, unbiased=True):
+    """
+    Component-wise mean and standard deviation of a dataset sharded over all ranks, with two all-reduced passes
+    (sum, then sum of squared deviations from the global mean) so that the result equals data.mean(0)/data.std(0) of the full dataset.
+
+    :param data: (n_rank, ...) shard of the rank
+    """
+    n = torch.tensor([float(data.shape[0])], dtype=torch.float64)
+    sum_ = data.double().sum(dim=0)
+    dist.all_reduce(n)
+    dist.all_reduce(sum_)
+    mean = sum_ / n
+    squared_deviations = ((data.double() - mean) ** 2).sum(dim=0)
+    dist.all_reduce(squared_deviations)
+    std = torch.sqrt(squared_deviations / (n - 1 if unbiased else n))
+    return mean.to(data.dtype), std.to(data.dtype)
+
+
+def all_reduce_means(loss_accumulate):
+    """
+    :param loss_accumulate: utils.LossAccumulate or dict of key -> list of values recorded on this rank
+    :return: dict key -> mean of the values of all ranks
+    """
+    keys = sorted(loss_accumulate.keys())
+    sums_and_counts = torch.tensor([[np.sum(loss_accumulate[k]), len(loss_accumulate[k])] for k in keys], dtype=torch.float64)
+    dist.all_reduce(sums_and_counts)
+    return {k: (s / max(c, 1)) for k, (s, c) in zip(keys, sums_and_counts.tolist())}
+
+
+class NullSummaryWriter:
+    """ drop-in for the SummaryWriter of rank 0 on all other ranks, ignores every call """
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
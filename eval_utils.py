@@ -0,0 +1,230 @@
+import numpy as np
+import torch
+from scipy.stats import rankdata
+from tqdm import tqdm
+import data_utils
+
+
+def roc_auc_scores(labels, scores):
+    """
+    AUC-ROC of every column of a score matrix in one rank-based pass (Mann-Whitney U statistic).
+    Tied scores get their average rank, which gives exactly the trapezoidal AUC of sklearn.metrics.roc_auc_score.
+
+    :param labels: (N,) binary labels, ones are anomalous
+    :param scores: (N,) or (N, K) anomaly scores, higher is more anomalous
+    :return: float or (K,) array of AUC-ROC values
+    """
+    labels = np.asarray(labels).ravel() == 1
+    scores = np.asarray(scores)
+    n_pos = labels.sum()
+    n_neg = len(labels) - n_pos
+    if n_pos == 0 or n_neg == 0:
+        raise ValueError("Only one class present in labels. ROC AUC score is not defined in that case.")
+
+    ranks = rankdata(scores, axis=0)  # average ranks of ties, 1-based
+    rank_sum_pos = ranks[labels].sum(axis=0)
+    auc = (rank_sum_pos - n_pos * (n_pos + 1) / 2.) / (n_pos * n_neg)
+    return float(auc) if scores.ndim == 1 else auc
+
+
+# order of the last axis of the score arrays returned by calculate_scores
+SCORE_TYPES = ["log_density", "score_norm"]
+
+
+def get_sigmas(L, sigma_low, sigma_high):
+    """
+    :param L: int or list of floats.
+            If int, then L is the number of sigmas linspaced from sigma_low to sigma_high to evaluate.
+            If list, then L is the list of sigmas to evaluate.
+    :return: sorted list of sigmas rounded to 5 decimals
+    """
+    if L.__class__ == list().__class__:
+        sigma_L = np.asarray(L).tolist()
+    else:
+        sigma_L = np.linspace(sigma_low, sigma_high, L).tolist()
+        # sigma_L = np.exp(np.asarray(sigma_L)).tolist()
+    return sorted(map(lambda x: float(f"{x:.5f}"), sigma_L))
+
+
+def _score_batch(model, x, sigma_L, sigmas, gram, max_rows_per_pass):
+    """ :return: (B, L, 2) tensor of noise free log densities and squared score norms of a batch of standardized samples """
+    scores = torch.empty((x.shape[0], len(sigma_L), len(SCORE_TYPES)), device=x.device)
+    if gram is not None:
+        sigmas_per_pass = max(1, max_rows_per_pass // x.shape[0])
+        for sigma_start in range(0, len(sigma_L), sigmas_per_pass):
+            sigma_end = sigma_start + sigmas_per_pass
+            log_density_, score_squared_norms = model.multiscale_log_density_and_score_norm(x, sigmas[sigma_start:sigma_end], gram=gram)
+            scores[:, sigma_start:sigma_end, 0] = log_density_
+            scores[:, sigma_start:sigma_end, 1] = score_squared_norms
+        return scores
+
+    # score networks output the score and the analytic score needs no autograd
+    needs_autograd = not (model.is_score_network or model.analytic_score)
+    if needs_autograd:
+        x = x.requires_grad_()
+    for sigma_idx, sigma_ in enumerate(sigma_L):  # iterate every sigma for 1:L
+        model.zero_grad()
+        with torch.set_grad_enabled(needs_autograd):
+            score_, log_density_ = model.score(torch.hstack([x, sigma_ * torch.ones((x.shape[0], 1), device=x.device)]), return_log_density=True)  # evaluate clean sample at noise scale sigma_
+        scores[:, sigma_idx, 0] = log_density_.detach().ravel()
+        scores[:, sigma_idx, 1] = (torch.norm(score_[:, :-1], dim=1) ** 2).detach()
+    return scores
+
+
+def calculate_scores(model, dataloader, sigma_L, data_train_mean, data_train_std, device, max_rows_per_pass=16384):
+    """
+    This function calculates the noise free log densities and squared score norms for the given dataloader at every sigma.
+    The scores are written batch by batch into a preallocated (N, L, 2) tensor on the device and transferred to the host once.
+    Score networks (score_network=True) have no log-densities, their log-density scores are zeros.
+    For MULDE log-density MLPs the first layer's projection of a batch is shared by all sigmas.
+
+    :param sigma_L: list of L sigmas to evaluate, see get_sigmas
+    :param data_train_mean: standardization statistics, None if the standardization is folded into the model
+    :param max_rows_per_pass: limits batch size x sigmas evaluated at once with the shared projection
+    :return: (N, L, 2) numpy array, the last axis is ordered as SCORE_TYPES
+    """
+    scores = torch.empty((len(dataloader.dataset), len(sigma_L), len(SCORE_TYPES)), device=device)
+    gram = model.score_norm_gram() if model.supports_shared_projection() else None
+    sigmas = torch.tensor(sigma_L, device=device)
+    with tqdm(dataloader) as tepoch:
+        tepoch.set_description(f"Calculate noise free log-densities/score norms across sigmas")
+        model.eval()
+        start = 0
+        for batch_idx, (data, labels) in enumerate(tepoch):
+            x = data.to(device)
+            x = x.reshape(x.shape[0], -1)
+            if data_train_mean is not None:  # None for models with folded standardization
+                x = (x - data_train_mean) / (data_train_std + 1e-8)
+            end = start + x.shape[0]
+            scores[start:end] = _score_batch(model, x, sigma_L, sigmas, gram, max_rows_per_pass)
+            start = end
+
+    return scores.cpu().numpy()
+
+
+def calculate_patch_scores(model, dataloader, sigma_L, data_train_mean, data_train_std, device, frame_shape, patch_size,
+                           patch_stride=None, max_rows_per_pass=16384):
+    """
+    Patch mode of calculate_scores: every frame of a batch is unfolded into patches (data_utils.unfold_patches)
+    and the B * P patches of the batch are scored in chunks of at most max_rows_per_pass patches.
+
+    :param dataloader: batches of flattened (B, H * W) frames
+    :param data_train_mean: (patch_size ** 2,) standardization statistics of the training patches, None if folded into the model
+    :return: (N, P, L, 2) numpy array of the scores of every patch, see reduce_patch_scores and data_utils.fold_patch_scores
+    """
+    n_patches = data_utils.num_patches(frame_shape, patch_size, patch_stride)
+    scores = torch.empty((len(dataloader.dataset), n_patches, len(sigma_L), len(SCORE_TYPES)), device=device)
+    gram = model.score_norm_gram() if model.supports_shared_projection() else None
+    sigmas = torch.tensor(sigma_L, device=device)
+    with tqdm(dataloader) as tepoch:
+        tepoch.set_description(f"Calculate noise free log-densities/score norms of patches across sigmas")
+        model.eval()
+        start = 0
+        for batch_idx, (data, labels) in enumerate(tepoch):
+            patches = data_utils.unfold_patches(data.to(device), frame_shape, patch_size, patch_stride)  # (B, P, p * p)
+            x = patches.reshape(-1, patches.shape[-1])
+            if data_train_mean is not None:  # None for models with folded standardization
+                x = (x - data_train_mean) / (data_train_std + 1e-8)
+            end = start + patches.shape[0]
+            batch_scores = scores[start:end].view(-1, len(sigma_L), len(SCORE_TYPES))  # (B * P, L, 2) view of the preallocated scores
+            for row_start in range(0, x.shape[0], max_rows_per_pass):  # B * P can be far more rows than a frame batch
+                row_end = row_start + max_rows_per_pass
+                batch_scores[row_start:row_end] = _score_batch(model, x[row_start:row_end], sigma_L, sigmas, gram, max_rows_per_pass)
+            start = end
+
+    return scores.cpu().numpy()
+
+
+def reduce_patch_scores(patch_scores, reduction="max"):
+    """
+    :param patch_scores: (N, P, ...) scores of the patches of every frame, higher is more anomalous
+    :param reduction: "max" or a quantile in (0, 1), e.g. "0.99", which is less sensitive to single noisy patches
+    :return: (N, ...) frame scores
+    """
+    if reduction == "max":
+        return patch_scores.max(axis=1)
+    return np.quantile(patch_scores, float(reduction), axis=1)
+
+
+def pool_frames(frames, frame_shape, pool):
+    """
+    :param frames: (N, H * W) flattened frames
+    :param pool: average pooling factor, 1 returns the frames unchanged
+    :return: (N, (H // pool) * (W // pool)) flattened pooled frames
+    """
+    if pool == 1:
+        return frames
+    pooled = torch.nn.functional.avg_pool2d(frames.reshape(-1, 1, *frame_shape), pool)
+    return pooled.reshape(frames.shape[0], -1)
+
+
+# checkpoint entries that define how the model inputs are formed from the frames, see checkpoint_dataloader
+CHECKPOINT_INPUT_KEYS = ["frame_shape", "input_pool", "patch_size", "patch_stride", "patch_reduction", "temporal_frames", "temporal_mode"]
+
+
+def checkpoint_standardization(checkpoint):
+    """ :return: data_train_mean, data_train_std of a checkpoint, None, None if export_model.py folded them into the model """
+    if checkpoint.get("standardization_folded"):
+        return None, None
+    return checkpoint["data_train_mean"], checkpoint["data_train_std"]
+
+
+def standardize(x, data_train_mean, data_train_std):
+    """ standardizes model inputs, unchanged for models with folded standardization (data_train_mean None) """
+    if data_train_mean is None:
+        return x
+    return (x - data_train_mean) / (data_train_std + 1e-8)
+
+
+def checkpoint_dataloader(checkpoint, data, labels, batch_size, shuffle=False, device="cpu", device_resident=False, samples=False,
+                          video_lengths=None):
+    """
+    Batches of frames as the model of a checkpoint consumes them, e.g. average-pooled by the input_pool of a student of distill.py
+    or as windows of temporal_frames frames (data_utils.TemporalWindowDataset). Models with folded standardization consume
+    the frames divided by their input_scale, e.g. raw pixels in [0, 255].
+    In patch mode (patch_size) the batches hold whole frames, which calculate_checkpoint_scores unfolds, or with samples the patches.
+
+    :param data: (N, D) frames of get_dataset at the resolution and pixels of the checkpoint, see uscd_dataset_loader.get_checkpoint_dataset
+    :param samples: batch the training samples of the model, i.e. the patches of all frames in patch mode, e.g. for fine-tuning
+    :param video_lengths: number of frames of every video, required for temporal windows
+    """
+    data = torch.as_tensor(data, dtype=torch.float32)
+    labels = torch.Tensor(labels)
+    if checkpoint.get("standardization_folded") and checkpoint.get("input_scale", 1.) != 1.:
+        data = torch.round(data / checkpoint["input_scale"])
+    if checkpoint.get("temporal_frames", 1) > 1:
+        if video_lengths is None:
+            raise ValueError("the model consumes windows of consecutive frames, the video lengths of the frames are required")
+        dataset = data_utils.TemporalWindowDataset(data, labels, video_lengths, checkpoint["temporal_frames"], checkpoint.get("temporal_mode", "frames"),
+                                                   device=device if device_resident else "cpu")
+        return data_utils.TemporalWindowLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+    if checkpoint.get("input_pool", 1) > 1:
+        data = pool_frames(data, checkpoint["frame_shape"], checkpoint["input_pool"])
+    if samples and checkpoint.get("patch_size"):
+        patch_size, patch_stride = checkpoint["patch_size"], checkpoint.get("patch_stride")
+        data = data_utils.unfold_patches(data, checkpoint["frame_shape"], patch_size, patch_stride).reshape(-1, patch_size ** 2)
+        labels = labels.repeat_interleave(data_utils.num_patches(checkpoint["frame_shape"], patch_size, patch_stride))
+    return data_utils.get_dataloader(data, labels, batch_size=batch_size, shuffle=shuffle, device=device, device_resident=device_resident)
+
+
+def calculate_checkpoint_scores(model, checkpoint, dataloader, sigma_L, data_train_mean, data_train_std, device):
+    """
+    calculate_scores of the frames of a checkpoint_dataloader, in patch mode the frame scores are reduced from the
+    patch scores with the patch_reduction of the checkpoint
+
+    :return: (N, L, 2) numpy array, the last axis is ordered as SCORE_TYPES
+    """
+    if checkpoint.get("patch_size"):
+        patch_scores = calculate_patch_scores(model, dataloader, sigma_L, data_train_mean, data_train_std, device, checkpoint["frame_shape"],
+                                              checkpoint["patch_size"], checkpoint.get("patch_stride"))
+        return reduce_patch_scores(patch_scores, checkpoint.get("patch_reduction", "max"))
+    return calculate_scores(model, dataloader, sigma_L, data_train_mean, data_train_std, device)
+
+
+def per_sigma_aucs(model, dataloader, labels, sigma_L, data_train_mean, data_train_std, device, checkpoint=None):
+    """
+    :param checkpoint: checkpoint dict the dataloader was built for with checkpoint_dataloader, None for batches of model inputs
+    :return: (L, 2) AUC-ROC of the log-density and score norm at every sigma
+    """
+    scores = calculate_checkpoint_scores(model, checkpoint or dict(), dataloader, sigma_L, data_train_mean, data_train_std, device)
+    return roc_auc_scores(labels, scores.reshape(len(scores), -1)).reshape(len(sigma_L), len(SCORE_TYPES))
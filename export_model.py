@@ -0,0 +1,201 @@
+"""
+Export a model trained with --save_checkpoint for inference
+
+# fold the standardization into the first layer, the exported model consumes frames with pixel values in [0, 1]
+python export_model.py --checkpoint runs/MULDE/<timestamp>/checkpoint.pt
+
+# the exported model consumes raw uint8 pixels in [0, 255], check the scores against the unfolded model on the test set
+python export_model.py --checkpoint runs/MULDE/<timestamp>/checkpoint.pt --uint8_input --verify
+
+# additionally write a frozen TorchScript and an ONNX graph computing log-densities and squared score norms at a list of sigmas,
+# the export fails (non-zero exit) if the graphs deviate from the model by more than --parity_tol
+python export_model.py --checkpoint runs/MULDE/<timestamp>/checkpoint.pt --uint8_input --torchscript --onnx --parity_tol 1e-2 1e-3
+
+The graphs take (N, d) frames (patches of checkpoints trained in patch mode) and (L,) sigmas and return (N, L) log-densities and (N, L) squared score norms,
+e.g. in C++ with torch::jit::load("model_scripted.pt") or with onnxruntime.InferenceSession("model.onnx").
+"""
+
+import argparse
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+import eval_utils
+from models import fold_standardization, load_checkpoint, save_checkpoint, mlp_forward_and_input_gradient
+from uscd_dataset_loader import get_checkpoint_dataset
+
+data_dir = "UCSD_Anomaly_Dataset.v1p2/UCSDped2"
+m_file_path = "UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test/UCSDped2.m"
+
+
+class MultiscaleScoreExport(nn.Module):
+    def __init__(self, folded_model):
+        """
+        Inference graph of a standardization-folded MULDE log-density MLP for serving without Python.
+        The first layer's projection of the frames is shared by all sigmas (see multiscale_log_density_and_score_norm)
+        and the gradient w.r.t. the input is computed with mlp_forward_and_input_gradient instead of autograd,
+        so that the traced graph runs under inference mode and can be exported to ONNX.
+
+        :param folded_model: ScoreOrLogDensityNetwork returned by fold_standardization
+        """
+        super().__init__()
+        if not folded_model.supports_shared_projection():
+            raise ValueError("export requires a MULDE log-density MLP, i.e. ScoreOrLogDensityNetwork(MLPs(...), score_network=False)")
+        mlp = folded_model.network.network
+        linear = mlp[0][0]
+        d = linear.in_features - 1
+        self.head = nn.Sequential(*mlp[0][1:], *mlp[1:])
+        self.register_buffer("weight_x", linear.weight[:, :d].detach().clone())
+        self.register_buffer("bias", linear.bias.detach().clone())
+        self.register_buffer("weight_sigma", linear.weight[:, d].detach().clone())
+        # the squared score norm is g^T G g with G the Gram matrix, or ||g^T W_x diag(score_scale)||^2 if H >= d
+        gram = folded_model.score_norm_gram()
+        self.use_gram = gram is not None
+        if self.use_gram:
+            self.register_buffer("score_weight", gram.clone())
+        else:
+            score_scale = folded_model.score_scale[:d] if folded_model.score_scale is not None else torch.ones(d)
+            self.register_buffer("score_weight", (self.weight_x * score_scale).detach().clone())
+
+    def forward(self, x, sigmas):
+        """
+        :param x: (N, d) raw frames, scaled as the folded model expects (input_scale)
+        :param sigmas: (L,) noise scales
+        :return: (N, L) log-densities, (N, L) squared score norms
+        """
+        projection = x @ self.weight_x.T + self.bias  # (N, H)
+        pre_activation = (projection[:, None, :] + sigmas[:, None] * self.weight_sigma).reshape(-1, projection.shape[-1])  # (N * L, H)
+        log_density, grad_pre = mlp_forward_and_input_gradient(self.head, pre_activation)  # the sign of the score drops out of the norm
+        if self.use_gram:
+            score_norm = ((grad_pre @ self.score_weight) * grad_pre).sum(dim=1)
+        else:
+            score_norm = ((grad_pre @ self.score_weight) ** 2).sum(dim=1)
+        return log_density.reshape(x.shape[0], -1), score_norm.reshape(x.shape[0], -1)
+
+
+def export_torchscript(export_module, d, path):
+    """ traces and freezes the graph, batch size and number of sigmas stay dynamic """
+    example_inputs = (torch.rand(2, d), torch.tensor([1e-3, 1e-1, 1.]))
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(export_module.eval(), example_inputs))
+    torch.jit.save(scripted, path)
+    return torch.jit.load(path)
+
+
+def export_onnx(export_module, d, path):
+    """ :return: inference function of the ONNX graph with onnxruntime, None if onnxruntime is not installed """
+    example_inputs = (torch.rand(2, d), torch.tensor([1e-3, 1e-1, 1.]))
+    with torch.no_grad():
+        torch.onnx.export(export_module.eval(), example_inputs, path, input_names=["frames", "sigmas"], output_names=["log_density", "score_norm"],
+                          dynamic_axes={"frames": {0: "batch"}, "sigmas": {0: "sigmas"}, "log_density": {0: "batch", 1: "sigmas"},
+                                        "score_norm": {0: "batch", 1: "sigmas"}})
+    try:
+        import onnxruntime
+    except ImportError:
+        print("onnxruntime is not installed, skipping the parity check of the ONNX graph")
+        return None
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+    return lambda x, sigmas: [torch.from_numpy(output) for output in session.run(None, {"frames": x.numpy(), "sigmas": sigmas.numpy()})]
+
+
+def check_parity(exported, model, checkpoint, input_scale, frames, sigma_L, name, tolerances):
+    """
+    compares the log-densities and squared score norms of an exported graph on raw frames
+    to ScoreOrLogDensityNetwork.score of the original model on standardized frames
+    :param frames: (N, d) model inputs in [0, 1], see eval_utils.checkpoint_dataloader
+    :param tolerances: maximum relative errors of the log-densities and of the score norms, a larger error raises a RuntimeError
+    """
+    sigmas = torch.tensor(sigma_L)
+    x = (frames - checkpoint["data_train_mean"]) / (checkpoint["data_train_std"] + 1e-8)
+    x = x.requires_grad_()
+    log_density, score_norm = torch.empty(len(frames), len(sigma_L)), torch.empty(len(frames), len(sigma_L))
+    for sigma_idx, sigma_ in enumerate(sigma_L):
+        score_, log_density_ = model.score(torch.hstack([x, sigma_ * torch.ones((x.shape[0], 1))]), return_log_density=True)
+        log_density[:, sigma_idx] = log_density_.detach().ravel()
+        score_norm[:, sigma_idx] = (torch.norm(score_[:, :-1], dim=1) ** 2).detach()
+
+    with torch.inference_mode():
+        log_density_exported, score_norm_exported = exported(frames / input_scale, sigmas)
+    failed = []
+    for score_type_, reference, exported_, tolerance in [("log_density", log_density, log_density_exported, tolerances[0]),
+                                                         ("score_norm", score_norm, score_norm_exported, tolerances[1])]:
+        relative_error = ((reference - exported_).abs() / (reference.abs() + 1e-8)).max().item()
+        print(f"{name} {score_type_}: max relative error {relative_error:.2e} (tolerance {tolerance:.0e})")
+        if not relative_error <= tolerance:  # NaN fails as well
+            failed.append(f"{score_type_} {relative_error:.2e} > {tolerance:.0e}")
+    if failed:
+        raise RuntimeError(f"{name} graph does not match the model: {', '.join(failed)}")
+
+
+def verify_folded(model, folded_model, checkpoint, input_scale, args):
+    """ compares log-densities, score norms and per-sigma AUC-ROC of the folded model on raw test frames to the original model """
+    _, _, data_test, labels_test, _, video_lengths = get_checkpoint_dataset(data_dir, m_file_path, checkpoint)
+    sigma_L = eval_utils.get_sigmas(checkpoint.get("L", 16), checkpoint.get("sigma_low", 1e-3), checkpoint.get("sigma_high", 1.))
+
+    dataloader = eval_utils.checkpoint_dataloader(checkpoint, data_test, labels_test, args.batch_size, video_lengths=video_lengths["test"])
+    dataloader_raw = eval_utils.checkpoint_dataloader(dict(checkpoint, standardization_folded=True, input_scale=input_scale), data_test, labels_test,
+                                                      args.batch_size, video_lengths=video_lengths["test"])
+    scores = eval_utils.calculate_checkpoint_scores(model, checkpoint, dataloader, sigma_L, checkpoint["data_train_mean"].to(args.device),
+                                                    checkpoint["data_train_std"].to(args.device), args.device)
+    scores_folded = eval_utils.calculate_checkpoint_scores(folded_model, checkpoint, dataloader_raw, sigma_L, None, None, args.device)
+
+    relative_error = np.abs(scores - scores_folded) / (np.abs(scores) + 1e-8)
+    auc = eval_utils.roc_auc_scores(labels_test, scores.reshape(len(scores), -1))
+    auc_folded = eval_utils.roc_auc_scores(labels_test, scores_folded.reshape(len(scores), -1))
+    for score_type_idx, score_type_ in enumerate(eval_utils.SCORE_TYPES):
+        print(f"{score_type_}: max relative error {relative_error[:, :, score_type_idx].max():.2e}, "
+              f"max AUC-ROC difference {np.abs(auc - auc_folded).reshape(len(sigma_L), -1)[:, score_type_idx].max():.2e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True, help='checkpoint.pt saved with --save_checkpoint')
+    parser.add_argument("--output", type=str, default=None, help='defaults to checkpoint_folded.pt next to the checkpoint')
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch_size", type=int, default=256, help='')
+    parser.add_argument('--uint8_input', action='store_true', help='exported model consumes pixels in [0, 255] instead of [0, 1]')
+    parser.set_defaults(uint8_input=False)
+    parser.add_argument('--verify', action='store_true', help='compare the scores of the exported model on the test set')
+    parser.set_defaults(verify=False)
+    parser.add_argument('--torchscript', action='store_true', help='write a frozen TorchScript graph to model_scripted.pt next to --output')
+    parser.set_defaults(torchscript=False)
+    parser.add_argument('--onnx', action='store_true', help='write an ONNX graph to model.onnx next to --output')
+    parser.set_defaults(onnx=False)
+    parser.add_argument("--parity_frames", type=int, default=64, help='test frames used to check the graphs against ScoreOrLogDensityNetwork.score')
+    parser.add_argument("--parity_tol", nargs=2, type=float, default=[1e-2, 1e-3], metavar=("LOG_DENSITY", "SCORE_NORM"),
+                        help='maximum relative errors of the log-densities and score norms of the graphs, the export fails above them')
+    args = parser.parse_args()
+
+    model, checkpoint = load_checkpoint(args.checkpoint, device=args.device)
+    input_scale = 1. / 255. if args.uint8_input else 1.
+    folded_model = fold_standardization(model, checkpoint["data_train_mean"], checkpoint["data_train_std"], input_scale=input_scale)
+
+    output = args.output or os.path.join(os.path.dirname(args.checkpoint), "checkpoint_folded.pt")
+    extra = {k: v for k, v in checkpoint.items() if k not in ["state_dict", "model_config", "data_train_mean", "data_train_std"]}
+    extra.update(standardization_folded=True, input_scale=input_scale)
+    save_checkpoint(output, folded_model, checkpoint["model_config"], checkpoint["data_train_mean"], checkpoint["data_train_std"], **extra)
+    print(f"Standardization-folded model saved to {output}")
+
+    if args.verify:
+        verify_folded(model, folded_model, checkpoint, input_scale, args)
+
+    if args.torchscript or args.onnx:
+        model, folded_model = model.cpu(), folded_model.cpu()
+        export_module = MultiscaleScoreExport(folded_model)
+        d = export_module.weight_x.shape[1]
+        sigma_L = eval_utils.get_sigmas(checkpoint.get("L", 16), checkpoint.get("sigma_low", 1e-3), checkpoint.get("sigma_high", 1.))
+        _, _, data_test, labels_test, _, video_lengths = get_checkpoint_dataset(data_dir, m_file_path, checkpoint)
+        torch.manual_seed(0)
+        frames = next(iter(eval_utils.checkpoint_dataloader(checkpoint, data_test, labels_test, args.parity_frames, shuffle=True,
+                                                            samples=True, video_lengths=video_lengths["test"])))[0].reshape(-1, d)
+        del data_test
+        if args.torchscript:
+            path = os.path.join(os.path.dirname(output), "model_scripted.pt")
+            check_parity(export_torchscript(export_module, d, path), model, checkpoint, input_scale, frames, sigma_L, "TorchScript", args.parity_tol)
+            print(f"TorchScript graph saved to {path}")
+        if args.onnx:
+            path = os.path.join(os.path.dirname(output), "model.onnx")
+            onnx_session = export_onnx(export_module, d, path)
+            if onnx_session is not None:
+                check_parity(onnx_session, model, checkpoint, input_scale, frames, sigma_L, "ONNX", args.parity_tol)
+            print(f"ONNX graph saved to {path}")
@@ -0,0 +1,274 @@
+"""
+Single-file chunked and compressed frame store, replaces walking thousands of .tif files
+
+# decode the .tif folders once and write cache/UCSDped2.mfs (zstd if installed, else lz4, else zlib)
+python frame_store.py --build
+
+# compare the read time of the store with decoding the .tif files
+python frame_store.py --benchmark
+
+python main.py --frame_store cache/UCSDped2.mfs
+# or read the train frames lazily with FrameStoreDataset, chunk by chunk while training
+python main.py --frame_store cache/UCSDped2.mfs --lazy
+
+Layout: magic, compressed chunks of up to --chunk_frames uint8 frames of one video, a zlib-compressed JSON index
+(videos of every split with labels and the (offset, size, frames) of their chunks) and a footer with the index position.
+Chunks never span videos, every video and every frame can be read without touching the rest of the file.
+Within a chunk the frames are stored as differences to the previous frame (mod 256), consecutive frames of
+a static camera are nearly identical and the differences compress far better.
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+MAGIC = b"MULDEFS1"
+FOOTER = struct.Struct("<QQ8s")  # index offset, index size, magic
+
+data_dir = "UCSD_Anomaly_Dataset.v1p2/UCSDped2"
+m_file_path = "UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test/UCSDped2.m"
+
+
+def _codecs():
+    """ name -> (compress(bytes, level), decompress(bytes)) of the available codecs, zlib is always available """
+    codecs = dict(zlib=(lambda data, level: zlib.compress(data, 1 if level is None else level), zlib.decompress))
+    try:
+        import zstandard
+        codecs["zstd"] = (lambda data, level: zstandard.ZstdCompressor(level=3 if level is None else level).compress(data),
+                          lambda data: zstandard.ZstdDecompressor().decompress(data))
+    except ImportError:
+        pass
+    try:
+        import lz4.frame
+        codecs["lz4"] = (lambda data, level: lz4.frame.compress(data, compression_level=0 if level is None else level), lz4.frame.decompress)
+    except ImportError:
+        pass
+    return codecs
+
+
+CODECS = _codecs()
+
+
+def default_codec():
+    """ the fastest available codec with a good ratio: zstd, then lz4, then zlib """
+    return next(codec for codec in ["zstd", "lz4", "zlib"] if codec in CODECS)
+
+
+def _encode_chunk(frames, codec, level):
+    delta = frames.copy()
+    delta[1:] -= frames[:-1]  # uint8 wraps around, inverted by a cumulative sum mod 256
+    return CODECS[codec][0](delta.tobytes(), level)
+
+
+def write_frame_store(path, videos, frame_shape, codec=None, level=None, chunk_frames=32, threads=None, meta=None):
+    """
+    :param videos: iterable of (split, name, (n, H * W) uint8 frames, (n,) labels), e.g. from iter_dataset_videos
+    :param codec: "zstd", "lz4" or "zlib", defaults to default_codec()
+    :param chunk_frames: frames per compressed chunk, the unit of random access
+    :param threads: threads compressing the chunks of a video in parallel
+    :param meta: further JSON entries of the index
+    :return: the index
+    """
+    codec = codec or default_codec()
+    if codec not in CODECS:
+        raise ValueError(f"Codec '{codec}' is not available, available codecs: {sorted(CODECS)}")
+    index = dict(codec=codec, frame_shape=list(frame_shape), chunk_frames=chunk_frames, splits=dict(), meta=meta or dict())
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f, ThreadPoolExecutor(threads) as executor:
+        f.write(MAGIC)
+        for split, name, frames, labels in videos:
+            frames = np.ascontiguousarray(frames, dtype=np.uint8)
+            starts = range(0, len(frames), chunk_frames)
+            chunks = []
+            for start, data in zip(starts, executor.map(lambda start: _encode_chunk(frames[start:start + chunk_frames], codec, level), starts)):
+                chunks.append([f.tell(), len(data), min(chunk_frames, len(frames) - start)])
+                f.write(data)
+            index["splits"].setdefault(split, []).append(dict(name=name, n_frames=len(frames), labels=np.asarray(labels).tolist(), chunks=chunks))
+        index_data = zlib.compress(json.dumps(index).encode())
+        index_offset = f.tell()
+        f.write(index_data)
+        f.write(FOOTER.pack(index_offset, len(index_data), MAGIC))
+    os.replace(tmp_path, path)  # a partially written store is never picked up
+    return index
+
+
+class FrameStore:
+    def __init__(self, path, threads=None):
+        """
+        Read access to a store written by write_frame_store. The file is memory-mapped, reads of different chunks are
+        independent and decompressed in parallel by a thread pool.
+
+        :param threads: decompression threads, defaults to the number of cores
+        """
+        self.path = path
+        self.threads = threads or os.cpu_count() or 1
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a frame store")
+        index_offset, index_size, magic = FOOTER.unpack(self._mmap[-FOOTER.size:])
+        if magic != MAGIC:
+            raise ValueError(f"{path} is truncated, the index footer is missing")
+        self.index = json.loads(zlib.decompress(self._mmap[index_offset:index_offset + index_size]))
+        if self.index["codec"] not in CODECS:
+            raise ValueError(f"{path} is compressed with '{self.index['codec']}', which is not installed")
+        self._decompress = CODECS[self.index["codec"]][1]
+        self.frame_shape = tuple(self.index["frame_shape"])
+        self.frame_size = int(np.prod(self.frame_shape))
+
+    def videos(self, split):
+        """ :return: list of dicts with name, n_frames, labels and chunks of the videos of a split in order """
+        return self.index["splits"].get(split, [])
+
+    def video_lengths(self, split):
+        return [video["n_frames"] for video in self.videos(split)]
+
+    def labels(self, split):
+        return np.asarray([label for video in self.videos(split) for label in video["labels"]], dtype=np.int64)
+
+    def read_chunk(self, chunk, out=None):
+        """ :return: (n, H * W) uint8 frames of a chunk [offset, size, n] of the index """
+        offset, size, n = chunk
+        delta = np.frombuffer(self._decompress(self._mmap[offset:offset + size]), dtype=np.uint8).reshape(n, self.frame_size)
+        return np.cumsum(delta, axis=0, dtype=np.uint8, out=out)
+
+    def _read_chunks(self, chunks):
+        frames = np.empty((sum(chunk[2] for chunk in chunks), self.frame_size), dtype=np.uint8)
+        starts = np.cumsum([0] + [chunk[2] for chunk in chunks])
+        with ThreadPoolExecutor(self.threads) as executor:
+            list(executor.map(lambda i: self.read_chunk(chunks[i], out=frames[starts[i]:starts[i + 1]]), range(len(chunks))))
+        return frames
+
+    def read_video(self, split, name):
+        """ :return: (n, H * W) uint8 frames and (n,) labels of one video """
+        video = next(video for video in self.videos(split) if video["name"] == name)
+        return self._read_chunks(video["chunks"]), np.asarray(video["labels"], dtype=np.int64)
+
+    def read_split(self, split):
+        """ :return: (N, H * W) uint8 frames and (N,) labels of all videos of a split in order """
+        return self._read_chunks([chunk for video in self.videos(split) for chunk in video["chunks"]]), self.labels(split)
+
+    def close(self):
+        self._mmap.close()
+
+
+class FrameStoreDataset(Dataset):
+    def __init__(self, path, split, resolution=None, threads=1, cached_chunks=4):
+        """
+        Lazy dataset of the frames of a split, frames are decompressed chunk by chunk on access and only the
+        last cached_chunks chunks are kept in memory. The store is opened on first access, so that every
+        DataLoader worker process maps the file itself.
+        Random access decompresses a whole chunk per frame, shuffle with ChunkShuffleSampler instead.
+
+        :param resolution: if given, the chunks are area-downsampled by this factor as in get_dataset
+        :return: items (H * W,) float tensor in [0, 1], label
+        """
+        self.path = path
+        self.split = split
+        self.resolution = resolution
+        self.threads = threads
+        self.cached_chunks = cached_chunks
+        self._store = None
+        store = FrameStore(path)
+        self.chunks = [chunk for video in store.videos(split) for chunk in video["chunks"]]
+        self.chunk_starts = np.cumsum([0] + [chunk[2] for chunk in self.chunks])
+        self.labels = store.labels(split)
+        store.close()
+
+    def _open(self):
+        if self._store is None:
+            self._store = FrameStore(self.path, threads=self.threads)
+            self._read_chunk = lru_cache(maxsize=self.cached_chunks)(self._decode_chunk)
+        return self._store
+
+    def _decode_chunk(self, chunk_idx):
+        frames = self._store.read_chunk(self.chunks[chunk_idx])
+        if self.resolution not in (None, 1):
+            from uscd_dataset_loader import area_downsample
+            return area_downsample(frames, self._store.frame_shape, self.resolution) / 255.
+        return frames.astype(np.float32) / 255.
+
+    def __getstate__(self):
+        return dict(self.__dict__, _store=None, _read_chunk=None)  # memory maps are not picklable
+
+    def __len__(self):
+        return int(self.chunk_starts[-1])
+
+    def __getitem__(self, idx):
+        self._open()
+        chunk_idx = int(np.searchsorted(self.chunk_starts, idx, side="right")) - 1
+        frame = self._read_chunk(chunk_idx)[idx - self.chunk_starts[chunk_idx]]
+        return torch.from_numpy(frame), self.labels[idx]
+
+
+class ChunkShuffleSampler(Sampler):
+    def __init__(self, dataset):
+        """ shuffles the chunks of a FrameStoreDataset and the frames within every chunk, every chunk is decompressed once per epoch """
+        self.chunk_starts = dataset.chunk_starts
+
+    def __len__(self):
+        return int(self.chunk_starts[-1])
+
+    def __iter__(self):
+        for chunk_idx in torch.randperm(len(self.chunk_starts) - 1).tolist():
+            start, end = int(self.chunk_starts[chunk_idx]), int(self.chunk_starts[chunk_idx + 1])
+            yield from (start + torch.randperm(end - start)).tolist()
+
+
+def iter_dataset_videos(data_dir, m_file_path):
+    """ :return: iterator of (split, video name, (n, H * W) uint8 frames, (n,) labels) of the .tif dataset, see write_frame_store """
+    from uscd_dataset_loader import iter_ucsd_videos, parse_ground_truth_m_file
+    TestVideoFile = parse_ground_truth_m_file(m_file_path)
+    for split, train in [("train", True), ("test", False)]:
+        for name, frames, labels in iter_ucsd_videos(os.path.join(data_dir, split.capitalize()), TestVideoFile, train=train):
+            yield split, name, np.round(frames * 255.).astype(np.uint8), labels
+
+
+def build_frame_store(data_dir, m_file_path, path, codec=None, level=None, chunk_frames=32, threads=None):
+    from uscd_dataset_loader import get_frame_shape
+    frame_shape = get_frame_shape(os.path.join(data_dir, "Train"))
+    return write_frame_store(path, iter_dataset_videos(data_dir, m_file_path), frame_shape, codec=codec, level=level,
+                             chunk_frames=chunk_frames, threads=threads, meta=dict(data_dir=data_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default=None, help='defaults to cache/<dataset>.mfs')
+    parser.add_argument('--build', action='store_true', help='decode the .tif folders and write the store')
+    parser.set_defaults(build=False)
+    parser.add_argument('--benchmark', action='store_true', help='compare reading the store with decoding the .tif files')
+    parser.set_defaults(benchmark=False)
+    parser.add_argument("--codec", type=str, default=None, choices=["zstd", "lz4", "zlib"], help='defaults to the best available codec')
+    parser.add_argument("--level", type=int, default=None, help='compression level of the codec')
+    parser.add_argument("--chunk_frames", type=int, default=32, help='frames per compressed chunk')
+    parser.add_argument("--threads", type=int, default=None, help='compression/decompression threads, defaults to all cores')
+    args = parser.parse_args()
+    output = args.output or os.path.join("cache", f"{os.path.basename(os.path.normpath(data_dir))}.mfs")
+
+    if args.build:
+        start = time.perf_counter()
+        index = build_frame_store(data_dir, m_file_path, output, codec=args.codec, level=args.level, chunk_frames=args.chunk_frames, threads=args.threads)
+        n_frames = sum(video["n_frames"] for videos in index["splits"].values() for video in videos)
+        raw_size = n_frames * int(np.prod(index["frame_shape"]))
+        print(f"{n_frames} frames written to {output} with {index['codec']} in {time.perf_counter() - start:.1f} s, "
+              f"{os.path.getsize(output) / 2 ** 20:.1f} MiB ({raw_size / os.path.getsize(output):.1f}x smaller than uint8)")
+
+    if args.benchmark:
+        from uscd_dataset_loader import get_dataset
+        start = time.perf_counter()
+        get_dataset(data_dir, m_file_path)
+        time_tif = time.perf_counter() - start
+        start = time.perf_counter()
+        get_dataset(data_dir, m_file_path, store_path=output)
+        time_store = time.perf_counter() - start
+        print(f"get_dataset: .tif files {time_tif:.2f} s, frame store {time_store:.2f} s ({time_tif / time_store:.1f}x faster)")
@@ -0,0 +1,208 @@
+import math
+import torch
+
+
+class BatchedGaussianMixture:
+    def __init__(self, n_components, reg_covar=1e-6, tol=1e-3, max_iter=100, kmeans_iter=10, dtype=torch.float64, generator=None):
+        """
+        B full-covariance GMMs fitted with EM in one batched computation, on the device of the data.
+        Mixture b has n_components[b] components, smaller mixtures are padded to the largest one with components of zero weight.
+
+        :param n_components: list of B numbers of components
+        :param reg_covar: added to the diagonal of the covariances, as in sklearn.mixture.GaussianMixture
+        :param tol: EM stops when the mean log-likelihood of every mixture improves by less than tol
+        :param max_iter: maximum number of EM iterations
+        :param kmeans_iter: iterations of Lloyd's algorithm used for initializing the means
+        :param dtype: computation dtype, float64 matches sklearn
+        :param generator: torch.Generator used for the initialization
+        """
+        self.n_components = list(n_components)
+        self.reg_covar = reg_covar
+        self.tol = tol
+        self.max_iter = max_iter
+        self.kmeans_iter = kmeans_iter
+        self.dtype = dtype
+        self.generator = generator
+        self.weights_, self.means_, self.covariances_, self.covariances_cholesky_ = None, None, None, None
+        self.converged_ = False
+        self.n_iter_ = 0
+
+    def _component_mask(self, device):
+        # (B, K), True for the components used by a mixture
+        k_max = max(self.n_components)
+        return torch.arange(k_max, device=device)[None, :] < torch.as_tensor(self.n_components, device=device)[:, None]
+
+    def _estimate_weighted_log_prob(self, X):
+        """
+        :param X: (B, N, D)
+        :return: (B, K, N) log(weight_k) + log N(x | mean_k, cov_k)
+        """
+        D = X.shape[-1]
+        diff = X[:, None, :, :] - self.means_[:, :, None, :]  # (B, K, N, D)
+        # solve L y = diff^T with covariance = L L^T
+        y = torch.linalg.solve_triangular(self.covariances_cholesky_, diff.transpose(-1, -2), upper=False)  # (B, K, D, N)
+        mahalanobis = (y ** 2).sum(dim=-2)  # (B, K, N)
+        log_det = 2 * torch.log(torch.diagonal(self.covariances_cholesky_, dim1=-2, dim2=-1)).sum(dim=-1)  # (B, K)
+        log_prob = -0.5 * (D * math.log(2 * math.pi) + log_det[:, :, None] + mahalanobis)
+        return log_prob + torch.log(self.weights_)[:, :, None]  # padded components have zero weight
+
+    def _m_step(self, X, resp):
+        """
+        :param X: (B, N, D)
+        :param resp: (B, K, N) responsibilities, zero for padded components
+        """
+        D = X.shape[-1]
+        eps = 10 * torch.finfo(X.dtype).eps
+        nk = resp.sum(dim=-1) + eps  # (B, K)
+        self.means_ = torch.einsum('bkn,bnd->bkd', resp, X) / nk[:, :, None]
+        diff = X[:, None, :, :] - self.means_[:, :, None, :]  # (B, K, N, D)
+        covariances = (resp[:, :, :, None] * diff).transpose(-1, -2) @ diff / nk[:, :, None, None]
+        self.covariances_ = covariances + self.reg_covar * torch.eye(D, device=X.device, dtype=X.dtype)
+        self.covariances_cholesky_ = torch.linalg.cholesky(self.covariances_)
+        self.weights_ = nk * self._component_mask(X.device) / X.shape[1]
+        self.weights_ = self.weights_ / self.weights_.sum(dim=-1, keepdim=True)
+
+    def _initialize(self, X):
+        """ k-means++ seeding followed by Lloyd iterations, batched over the mixtures """
+        B, N, D = X.shape
+        mask = self._component_mask(X.device)  # (B, K)
+        k_max = mask.shape[1]
+        batch_index = torch.arange(B, device=X.device)
+
+        centers = torch.empty((B, k_max, D), device=X.device, dtype=X.dtype)
+        first = torch.randint(N, (B,), generator=self.generator).to(X.device)
+        centers[:, 0] = X[batch_index, first]
+        min_dist = ((X - centers[:, 0:1]) ** 2).sum(dim=-1)  # (B, N)
+        for k in range(1, k_max):
+            probs = min_dist + 1e-12
+            probs = (probs / probs.sum(dim=-1, keepdim=True)).to(torch.float64)
+            next_ = torch.multinomial(probs.cpu(), 1, generator=self.generator).squeeze(1).to(X.device)
+            centers[:, k] = X[batch_index, next_]
+            min_dist = torch.minimum(min_dist, ((X - centers[:, k:k + 1]) ** 2).sum(dim=-1))
+
+        for _ in range(self.kmeans_iter + 1):
+            dist = torch.cdist(X, centers) ** 2  # (B, N, K)
+            dist = dist.masked_fill(~mask[:, None, :], float("inf"))
+            labels = dist.argmin(dim=-1)  # (B, N)
+            resp = torch.nn.functional.one_hot(labels, k_max).to(X.dtype).transpose(1, 2)  # (B, K, N)
+            counts = resp.sum(dim=-1)
+            centers = torch.where(counts[:, :, None] > 0, torch.einsum('bkn,bnd->bkd', resp, X) / counts.clamp(min=1)[:, :, None], centers)
+
+        self._m_step(X, resp)
+
+    def fit(self, X, warm_start=False):
+        """
+        :param X: (B, N, D) data, one set of N samples per mixture
+        :param warm_start: if True and the mixture has been fitted before, EM starts from the previous parameters
+        """
+        X = X.to(self.dtype)
+        if not (warm_start and self.means_ is not None and self.means_.shape[-1] == X.shape[-1] and self.means_.device == X.device):
+            self._initialize(X)
+
+        lower_bound = torch.full((X.shape[0],), -float("inf"), device=X.device, dtype=X.dtype)
+        self.converged_ = False
+        for n_iter in range(1, self.max_iter + 1):
+            # E-step
+            weighted_log_prob = self._estimate_weighted_log_prob(X)
+            log_prob_norm = torch.logsumexp(weighted_log_prob, dim=1)  # (B, N)
+            resp = torch.exp(weighted_log_prob - log_prob_norm[:, None, :])
+            # M-step
+            self._m_step(X, resp)
+
+            previous_lower_bound, lower_bound = lower_bound, log_prob_norm.mean(dim=-1)
+            if bool(((lower_bound - previous_lower_bound).abs() < self.tol).all()):
+                self.converged_ = True
+                break
+        self.n_iter_ = n_iter
+        return self
+
+    def score_samples(self, X):
+        """
+        :param X: (B, M, D) or (M, D) data scored by every mixture
+        :return: (B, M) log-likelihoods
+        """
+        if X.dim() == 2:
+            X = X[None].expand(len(self.n_components), -1, -1)
+        return torch.logsumexp(self._estimate_weighted_log_prob(X.to(self.dtype)), dim=1)
+
+    def state_dict(self):
+        return {"n_components": self.n_components, "weights": self.weights_, "means": self.means_, "covariances": self.covariances_}
+
+    def load_state_dict(self, state_dict):
+        self.n_components = list(state_dict["n_components"])
+        self.weights_, self.means_, self.covariances_ = state_dict["weights"], state_dict["means"], state_dict["covariances"]
+        self.covariances_cholesky_ = torch.linalg.cholesky(self.covariances_)
+        return self
+
+    def bic(self, X):
+        """
+        :param X: (B, N, D)
+        :return: (B,) Bayesian information criterion of every mixture, lower is better
+        """
+        N, D = X.shape[1], X.shape[2]
+        n_components = torch.as_tensor(self.n_components, device=X.device, dtype=self.dtype)
+        n_parameters = n_components * D * (D + 1) / 2. + n_components * D + n_components - 1
+        return -2 * self.score_samples(X).mean(dim=-1) * N + n_parameters * math.log(N)
+
+
+class MultiscaleGMM:
+    def __init__(self, components=(1, 3, 5), warm_start=True, subsample=None, seed=None, device=None):
+        """
+        GMMs fitted to the L-dimensional multiscale scores of the training set, one per score type and number of components,
+        all fitted in one BatchedGaussianMixture on the given device (the device of the scores if None).
+        The mixtures are kept between evaluations so that every fit is warm-started from the parameters of the previous one.
+
+        :param components: numbers of mixture components to fit
+        :param warm_start: if True, initialize each fit with the parameters of the previous evaluation
+        :param subsample: if given, fit on at most this many randomly drawn training score vectors
+        :param seed: random seed for subsampling and GMM initialization
+        :param device: device to run EM and scoring on, the scores are moved there before fitting
+        """
+        self.components = list(components)
+        self.warm_start = warm_start
+        self.subsample = subsample
+        self.device = device
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        self.score_types = None
+        self.gmm = None
+        self.bic = dict()  # (score_type, components) -> BIC on the data used for fitting
+
+    def _keys(self):
+        return [(score_type, components) for score_type in self.score_types for components in self.components]
+
+    def fit(self, multiscale_data_train):
+        """
+        :param multiscale_data_train: dict score_type -> (N, L) array or tensor of training scores
+        """
+        score_types = list(multiscale_data_train.keys())
+        if self.gmm is None or score_types != self.score_types:
+            self.score_types = score_types
+            self.gmm = BatchedGaussianMixture([components for _, components in self._keys()], generator=self.generator)
+
+        data_fit = torch.stack([torch.as_tensor(multiscale_data_train[score_type], device=self.device) for score_type in self.score_types])  # (S, N, L)
+        if self.subsample is not None and data_fit.shape[1] > self.subsample:
+            data_fit = data_fit[:, torch.randperm(data_fit.shape[1], generator=self.generator)[:self.subsample].to(data_fit.device)]
+        # one copy of the score type's data for every number of components
+        data_fit = data_fit.repeat_interleave(len(self.components), dim=0)  # (S * C, N, L)
+
+        self.gmm.fit(data_fit, warm_start=self.warm_start)
+        for key, bic in zip(self._keys(), self.gmm.bic(data_fit.to(self.gmm.dtype)).tolist()):
+            self.bic[key] = bic
+        return self
+
+    def best_components(self, score_type):
+        """ number of components with the lowest BIC """
+        return min(self.components, key=lambda components: self.bic[(score_type, components)])
+
+    def score_samples(self, multiscale_data):
+        """
+        Scores the data with every fitted GMM in one batched computation.
+        :param multiscale_data: dict score_type -> (N, L) array or tensor, same score types as used for fitting
+        :return: dict (score_type, components) -> (N,) numpy array of log-likelihoods
+        """
+        device = self.gmm.means_.device
+        data_ = torch.stack([torch.as_tensor(multiscale_data[score_type]).to(device) for score_type in self.score_types])
+        ll_scores = self.gmm.score_samples(data_.repeat_interleave(len(self.components), dim=0)).cpu().numpy()
+        return {key: ll_scores[i] for i, key in enumerate(self._keys())}
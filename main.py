@@ -11,6 +11,43 @@ python main.py --layernorm --dropout 0.5
 # if you want to plot the data used before training
 python main.py --plot_dataset
 
+# patch mode: the model scores 24x24 patches of the frames, frame scores are the 0.99 quantile of the patch scores
+python main.py --patch_size 24 --patch_reduction 0.99
+
+# drop the static pixels of the scene, i.e. pixels with a std over the training frames of at most 0.02 (about a third are kept)
+python main.py --static_pixel_threshold 0.02
+
+# quarter resolution (60x90) frames from the cached resolution pyramid, built in cache/ on first use,
+# only new or changed video folders are decoded when the dataset grows
+python main.py --resolution 4
+
+# frames from the single-file compressed frame store written by python frame_store.py --build
+python main.py --frame_store cache/UCSDped2.mfs
+# or stream the train frames from the store chunk by chunk instead of loading them into memory, decompressed by 4 worker processes
+python main.py --frame_store cache/UCSDped2.mfs --lazy --lazy_workers 4
+
+# frames decoded from video files in <video_dir>/Train and <video_dir>/Test, every second frame at half resolution
+python main.py --video_dir footage --video_stride 2 --resolution 2
+
+# inputs of 3 consecutive frames (the current frame and the 2 before it) at quarter resolution, or the current frame and the 2 frame differences
+python main.py --temporal_frames 3 --resolution 4
+python main.py --temporal_frames 3 --temporal_mode differences --resolution 4
+
+# train on a k-center coreset of 10% of the train frames, selected on frames downsampled 4x4 and cached in cache/,
+# and take the reference statistics of the aggregate evaluation and the GMMs from the coreset as well
+python main.py --coreset k_center --coreset_size 0.1 --coreset_train --coreset_reference
+# or drop train frames that differ from the last kept frame of their video by a mean absolute difference of at most 0.01
+python main.py --coreset frame_difference --coreset_threshold 0.01 --coreset_train
+
+# score network (MSMA/NCSN) instead of the log-density network, the score is the network output, evaluated on score norms
+python main.py --score_network --score_head_rank 512
+
+# data-parallel training in 4 processes on one CPU node (DDP, gloo backend), the ranks score shards of the data, rank 0 evaluates and logs
+python main.py --distributed --nprocs 4
+
+# or across nodes with torchrun, run on every node
+torchrun --nnodes 2 --nproc_per_node 4 --rdzv_backend c10d --rdzv_endpoint <host>:29500 main.py --distributed
+
 tensorboard --logdir=runs/MULDE --samples_per_plugin images=100
 # we distinguish between individual sigma evaluation and an aggregate evaluation
 An aggregate is either based on the AUC-ROC of the GMMs or a max/median/mean of the standardized scores over all sigma 1:L
@@ -20,15 +57,19 @@ The individual sigma evaluation is based on the AUC-ROC of the scores for each s
 import numpy as np
 import argparse
 import utils
+import data_utils
+import distributed_utils
 import torch
-from models import MLPs, ScoreOrLogDensityNetwork
+from models import MLPs, ScoreOrLogDensityNetwork, save_checkpoint
 import torch.optim as optim
-from torch.utils.data import TensorDataset, DataLoader
-from sklearn.metrics import roc_auc_score
+from torch.utils.data import TensorDataset, DataLoader, DistributedSampler
+import eval_utils
 from tqdm import tqdm
-from sklearn import mixture
+from gmm_utils import MultiscaleGMM
 import matplotlib.pyplot as plt
-from uscd_dataset_loader import get_dataset, create_meshgrid_from_data
+from uscd_dataset_loader import get_dataset, create_meshgrid_from_data, load_train_moments, load_coreset, coreset_cache_path
+from video_loader import get_video_dataset
+from frame_store import ChunkShuffleSampler
 #torch.cuda.empty_cache() # uncomment this if you have GPU on your device
 import plotting_utils
 
@@ -46,12 +87,83 @@ data_dir = "UCSD_Anomaly_Dataset.v1p2/UCSDped2"
 m_file_path = "UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test/UCSDped2.m"
 
 def train_and_evaluate(args):
+    if args.score_network and args.beta:
+        raise ValueError("--beta regularizes the log-density, which score networks do not model")
+    if args.patch_size and args.static_pixel_threshold is not None:
+        raise ValueError("--patch_size needs whole frames, it cannot be combined with --static_pixel_threshold")
+    if args.video_dir is not None and (args.static_pixel_threshold is not None or args.frame_store is not None):
+        raise ValueError("--video_dir reads the frames from video files, it cannot be combined with --static_pixel_threshold or --frame_store")
+    if args.lazy and (args.frame_store is None or args.patch_size or args.temporal_frames > 1 or args.coreset is not None
+                      or args.static_pixel_threshold is not None or args.distributed or args.device_resident or args.plot_dataset):
+        raise ValueError("--lazy streams the train frames of --frame_store, it cannot be combined with --patch_size, --temporal_frames, --coreset, "
+                         "--static_pixel_threshold, --distributed, --device_resident or --plot_dataset")
+    if args.patch_size and args.temporal_frames > 1:
+        raise ValueError("--patch_size cannot be combined with --temporal_frames")
+    if (args.coreset is not None) != (args.coreset_train or args.coreset_reference):
+        raise ValueError("--coreset needs --coreset_train and/or --coreset_reference and vice versa")
+    if args.distributed:
+        distributed_utils.init_distributed(backend=args.dist_backend, threads_per_process=args.threads_per_process)
+
+    frame_shape = tuple(size // (args.resolution or 1) for size in args.frame_shape)
     # zeros are normal, ones are anomalous
-    data_train, labels_train, data_test, labels_test, id_to_type = get_dataset(data_dir,m_file_path)
-
-    data_train = torch.Tensor(data_train)
+    # with --distributed rank 0 builds or updates the caches in cache/ before the other ranks read them
+    with distributed_utils.main_process_first():
+        if args.video_dir is not None:
+            # decoded from video files and resized to frame_shape
+            data_train, labels_train, data_test, labels_test, id_to_type, video_lengths = get_video_dataset(args.video_dir, m_file_path, stride=args.video_stride,
+                                                                                                            size=frame_shape, return_video_lengths=True)
+            static_pixel_indices = None
+        else:
+            (data_train, labels_train, data_test, labels_test, id_to_type, video_lengths,
+             static_pixel_indices) = get_dataset(data_dir, m_file_path, static_pixel_threshold=args.static_pixel_threshold, resolution=args.resolution,
+                                                 store_path=args.frame_store, return_video_lengths=True, return_static_pixel_indices=True,
+                                                 lazy_train=args.lazy)
+    if static_pixel_indices is not None:
+        # saved with the checkpoint so that inference selects the same pixels
+        static_pixel_indices = torch.from_numpy(static_pixel_indices)
+
+    # indices of the train frames that are trained on and of the reference frames whose scores give the statistics of the
+    # aggregate evaluation and the GMMs, None for all frames
+    train_frames = reference_frames = None
+    if args.coreset is not None:
+        with distributed_utils.main_process_first():
+            coreset_frames = load_coreset(data_train, video_lengths["train"], args.coreset, size=args.coreset_size, threshold=args.coreset_threshold,
+                                          frame_shape=frame_shape if static_pixel_indices is None else None, factor=args.coreset_downsample,
+                                          cache_path=coreset_cache_path(args.video_dir or data_dir, args.coreset, args.coreset_size, args.coreset_threshold,
+                                                                        args.coreset_downsample, resolution=args.resolution,
+                                                                        static_pixel_threshold=args.static_pixel_threshold,
+                                                                        video_stride=args.video_stride if args.video_dir is not None else 1))
+        print(f"coreset of {len(coreset_frames)} of {len(data_train)} train frames")
+        train_frames = coreset_frames if args.coreset_train else None
+        reference_frames = coreset_frames if args.coreset_reference else None
+
+    if not args.lazy:  # with --lazy data_train is a FrameStoreDataset
+        data_train = torch.Tensor(data_train)
     data_test = torch.Tensor(data_test)
 
+    # training samples, the frames or in patch mode the patches of all frames
+    data_train_samples, labels_train_samples = data_train, labels_train
+    if train_frames is not None:
+        data_train_samples, labels_train_samples = data_train[train_frames], labels_train[train_frames]
+    data_reference, labels_reference = data_train, labels_train
+    if reference_frames is not None:
+        data_reference, labels_reference = data_train[reference_frames], labels_train[reference_frames]
+    if args.patch_size:
+        n_patches = data_utils.num_patches(frame_shape, args.patch_size, args.patch_stride)
+        data_train_samples = data_utils.unfold_patches(data_train_samples, frame_shape, args.patch_size, args.patch_stride).reshape(-1, args.patch_size ** 2)
+        labels_train_samples = np.repeat(labels_train_samples, n_patches)
+    if args.temporal_frames > 1:
+        # windows of the frames of every video, strided views over the frames instead of stacked copies
+        temporal_device = args.device if args.device_resident else "cpu"
+        temporal_train = data_utils.TemporalWindowDataset(data_train, torch.Tensor(labels_train), video_lengths["train"], args.temporal_frames,
+                                                          args.temporal_mode, device=temporal_device)
+        temporal_test = data_utils.TemporalWindowDataset(data_test, torch.Tensor(labels_test), video_lengths["test"], args.temporal_frames,
+                                                         args.temporal_mode, device=temporal_device)
+    if args.lazy:
+        input_dim = data_train[0][0].numel()
+    else:
+        input_dim = data_train_samples.reshape(data_train_samples.shape[0], -1).shape[1] * args.temporal_frames
+
     data_train_mean = torch.Tensor(np.asarray([0.]))
     data_train_std = torch.Tensor(np.asarray([1.]))
     if not args.unstandardized:
@@ -60,18 +172,78 @@ def train_and_evaluate(args):
         # data_train_std = data_train.std()
 
         # stats component-wise
-        data_train_mean = data_train.mean(dim=0)
-        data_train_std = data_train.std(dim=0)
+        if args.temporal_frames > 1:
+            # moments of the windows, computed batch-wise without materializing them
+            moments = temporal_train.moments(args.batch_size, indices=train_frames)
+            data_train_mean, data_train_std = torch.Tensor(moments.mean), torch.Tensor(moments.std())
+        elif args.lazy:
+            # merged from the moments of the batches of one pass over the store
+            moments = data_utils.RunningMoments()
+            for x, _ in DataLoader(data_train, batch_size=args.batch_size, num_workers=args.lazy_workers):
+                moments.update(x.numpy())
+            data_train_mean, data_train_std = torch.Tensor(moments.mean), torch.Tensor(moments.std())
+        elif (args.resolution is not None and args.frame_store is None and args.video_dir is None and not args.patch_size and not args.distributed
+              and train_frames is None):
+            # merged from the moments of the videos in the frame cache, no pass over the train set
+            moments = load_train_moments(data_dir, args.resolution)
+            data_train_mean, data_train_std = torch.Tensor(moments.mean), torch.Tensor(moments.std())
+            if static_pixel_indices is not None:
+                data_train_mean, data_train_std = data_train_mean[static_pixel_indices], data_train_std[static_pixel_indices]
+        elif args.distributed:
+            # all-reduced over the shards of the ranks
+            train_start, train_end = distributed_utils.shard_bounds(len(data_train_samples))
+            data_train_mean, data_train_std = distributed_utils.distributed_mean_and_std(data_train_samples[train_start:train_end])
+        else:
+            data_train_mean = data_train_samples.mean(dim=0)
+            data_train_std = data_train_samples.std(dim=0)
 
     data_train_mean = data_train_mean.to(args.device)
     data_train_std = data_train_std.to(args.device)
 
-    dataset_train = TensorDataset(data_train, torch.Tensor(labels_train))
-    dataset_test = TensorDataset(data_test, torch.Tensor(labels_test))
-    dataloader_train = DataLoader(dataset_train, shuffle=True, batch_size=args.batch_size)
-    dataloader_test = DataLoader(dataset_test, shuffle=False, batch_size=args.batch_size)
-
-    if data_train.shape[1] == 2:
+    # every rank trains on its shard of the train set
+    if args.temporal_frames > 1:
+        train_sampler = DistributedSampler(range(len(data_train_samples)), shuffle=True) if args.distributed else None
+        dataloader_train = data_utils.TemporalWindowLoader(temporal_train, batch_size=args.batch_size, shuffle=True, sampler=train_sampler,
+                                                           indices=train_frames)
+        dataloader_test = data_utils.TemporalWindowLoader(temporal_test, batch_size=args.batch_size)
+    elif args.lazy:
+        # every chunk of the store is decompressed once per epoch, in shuffled chunk order
+        train_sampler = None
+        dataloader_train = DataLoader(data_train, batch_size=args.batch_size, sampler=ChunkShuffleSampler(data_train), num_workers=args.lazy_workers)
+        dataloader_test = data_utils.get_dataloader(data_test, torch.Tensor(labels_test), batch_size=args.batch_size, shuffle=False, device=args.device)
+    else:
+        train_sampler = DistributedSampler(data_train_samples, shuffle=True) if args.distributed else None
+        dataloader_train = data_utils.get_dataloader(data_train_samples, torch.Tensor(labels_train_samples), batch_size=args.batch_size, shuffle=True,
+                                                     device=args.device, device_resident=args.device_resident, uint8=args.uint8_data, sampler=train_sampler)
+        dataloader_test = data_utils.get_dataloader(data_test, torch.Tensor(labels_test), batch_size=args.batch_size, shuffle=False, device=args.device,
+                                                    device_resident=args.device_resident, uint8=args.uint8_data)
+    dataloader_train_eval = dataloader_train
+    if args.temporal_frames > 1 and reference_frames is not train_frames:
+        dataloader_train_eval = data_utils.TemporalWindowLoader(temporal_train, batch_size=args.batch_size, indices=reference_frames)
+    elif args.patch_size or reference_frames is not train_frames:
+        # in patch mode the patch scores are calculated and reduced per frame
+        dataloader_train_eval = data_utils.get_dataloader(data_reference, torch.Tensor(labels_reference), batch_size=args.batch_size, shuffle=False,
+                                                          device=args.device, device_resident=args.device_resident, uint8=args.uint8_data)
+    dataloader_test_eval = dataloader_test
+    if args.distributed and args.temporal_frames > 1:
+        # contiguous shards of the windows, the frames of the neighbouring shard are shared, not copied
+        reference_indices = torch.arange(len(data_train)) if reference_frames is None else torch.as_tensor(reference_frames)
+        train_start, train_end = distributed_utils.shard_bounds(len(data_reference))
+        test_start, test_end = distributed_utils.shard_bounds(len(data_test))
+        dataloader_train_eval = data_utils.TemporalWindowLoader(temporal_train, batch_size=args.batch_size, indices=reference_indices[train_start:train_end])
+        dataloader_test_eval = data_utils.TemporalWindowLoader(temporal_test, batch_size=args.batch_size, indices=torch.arange(test_start, test_end))
+    elif args.distributed:
+        # every rank scores a contiguous shard of the reference and test set, the scores are gathered to rank 0 in order
+        train_start, train_end = distributed_utils.shard_bounds(len(data_reference))
+        test_start, test_end = distributed_utils.shard_bounds(len(data_test))
+        dataloader_train_eval = data_utils.get_dataloader(data_reference[train_start:train_end], torch.Tensor(labels_reference[train_start:train_end]),
+                                                          batch_size=args.batch_size, shuffle=False, device=args.device,
+                                                          device_resident=args.device_resident, uint8=args.uint8_data)
+        dataloader_test_eval = data_utils.get_dataloader(data_test[test_start:test_end], torch.Tensor(labels_test[test_start:test_end]),
+                                                         batch_size=args.batch_size, shuffle=False, device=args.device,
+                                                         device_resident=args.device_resident, uint8=args.uint8_data)
+
+    if not args.lazy and data_train.shape[1] == 2:
         meshgrid_points = 200
         xx, yy = create_meshgrid_from_data(np.vstack([data_train, data_test]), n_points=meshgrid_points, meshgrid_offset=args.meshgrid_offset)
         data_manifold = np.hstack([xx.reshape(-1, 1), yy.reshape(-1, 1)])
@@ -81,25 +253,31 @@ def train_and_evaluate(args):
         dataloader_manifold = DataLoader(dataset_manifold, shuffle=False, batch_size=args.batch_size)
 
 
-    model = ScoreOrLogDensityNetwork(MLPs(input_dim=data_train.reshape(data_train.shape[0], -1).shape[1] + 1, # +1 for noise conditioning
-                                          units=args.units,
-                                          dropout=args.dropout,
-                                          layernorm=args.layernorm),
-                                     score_network=False).to(args.device)
-
-
-    if args.gradient_clipping:
-        clip_value = args.gradient_clipping  # e.g. 5e-1
-        for p in model.parameters():
-            p.register_hook(lambda grad: torch.clamp(grad, -clip_value, clip_value))
+    model_config = dict(input_dim=input_dim + 1, # +1 for noise conditioning
+                        units=args.units,
+                        dropout=args.dropout,
+                        layernorm=args.layernorm)
+    if args.score_network:
+        # MSMA/NCSN: the network outputs the (d + 1)-dimensional score, its head is factorized through score_head_rank units
+        model_config.update(output_dim=model_config["input_dim"], output_rank=args.score_head_rank or None)
+    model = ScoreOrLogDensityNetwork(MLPs(**model_config),
+                                     score_network=args.score_network,
+                                     analytic_score=args.analytic_score).to(args.device)
+    model_score = model.score
+    if args.distributed:
+        # gradients of the DSM loss are averaged across ranks in backward
+        model_score = distributed_utils.DistributedScore(model)
 
     optimizer = optim.Adam(model.parameters(), lr=args.lr, betas=(0.5, 0.9))
 
     scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=50, gamma=0.9)
-    log_path, summary_writer = utils.get_log_path_and_summary_writer(root_dir_runs="runs",
-                                                                     experiment_name=args.experiment_name,
-                                                                     args=args)
-    utils.save_current_experiment_source_code(log_path)
+    if distributed_utils.is_main_process():
+        log_path, summary_writer = utils.get_log_path_and_summary_writer(root_dir_runs="runs",
+                                                                         experiment_name=args.experiment_name,
+                                                                         args=args)
+        utils.save_current_experiment_source_code(log_path)
+    else:
+        log_path, summary_writer = None, distributed_utils.NullSummaryWriter()
 
     if args.plot_dataset:
         plt.figure(figsize=figsize)
@@ -118,15 +296,22 @@ def train_and_evaluate(args):
         plt.close()
 
 
+    # for components_ in [1, 3, 5, 7, 9]:
+    multiscale_gmm = MultiscaleGMM(components=[1, 3, 5], warm_start=not args.gmm_cold_start, subsample=args.gmm_subsample,
+                                   device=args.device)
+
     for epoch in range(args.epochs + 1):
         ################################################################################################################
         # train
         ################################################################################################################
-        with tqdm(dataloader_train) as tepoch:
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        with tqdm(dataloader_train, disable=not distributed_utils.is_main_process()) as tepoch:
             tepoch.set_description(f"Train Epoch {epoch}")
             model.train()
             loss_accumulate = 0
             loss_accumulate_train = utils.LossAccumulate()
+            gradient_telemetry = list()  # (max gradient, global gradient norm) device tensors of every batch
 
             for batch_idx, data in enumerate(tepoch):
                 x = data[0].to(args.device)
@@ -140,11 +325,12 @@ def train_and_evaluate(args):
                 # sample noise
                 noise = torch.randn_like(x, device=args.device) * sigma  # scale N(0, I) with sigma -> N(0, sigma I)
 
-                x = x.requires_grad_()
+                if not args.analytic_score:  # the analytic score needs no gradient w.r.t. the input
+                    x = x.requires_grad_()
                 x_ = x + noise  # add noise to data
 
                 lambda_factor = (sigma ** 2).ravel()
-                score_, log_density_ = model.score(torch.hstack([x_, sigma]), return_log_density=True)  # stack noisy data and sigma (conditioning)
+                score_, log_density_ = model_score(torch.hstack([x_, sigma]), return_log_density=True)  # stack noisy data and sigma (conditioning)
                 loss = torch.norm(score_[:, :-1] + noise / (sigma ** 2), dim=-1) ** 2  # -1 for excluding noise dim sigma condition
 
                 loss = lambda_factor.ravel() * loss
@@ -158,7 +344,7 @@ def train_and_evaluate(args):
 
                 loss_regularizer = torch.Tensor(np.asarray([0.])).to(args.device)
                 if args.beta:
-                    _, log_density_noise_free = model.score(torch.hstack([x, sigma]), return_log_density=True)  # stack clean data and sigma
+                    _, log_density_noise_free = model_score(torch.hstack([x, sigma]), return_log_density=True)  # stack clean data and sigma
                     loss_regularizer = args.beta * (log_density_noise_free ** 2).mean() / 2.
                     loss += loss_regularizer
 
@@ -168,11 +354,19 @@ def train_and_evaluate(args):
                 optimizer.zero_grad()
                 loss.backward()
 
-                all_grads = [torch.max(param.grad).item() for param in model.parameters() if param.grad is not None]
-                summary_writer.add_scalar(f'gradients/max_gradient', max(all_grads), epoch * len(tepoch) + batch_idx)
+                # clip gradients to [-gradient_clipping, gradient_clipping], e.g. 5e-1
+                gradient_telemetry.append(torch.stack(utils.clip_and_track_gradients(model.parameters(), args.gradient_clipping)))
                 optimizer.step()
                 loss_accumulate += loss.item()
 
+        # single host synchronization for the gradient telemetry of the epoch
+        for batch_idx, (max_gradient, global_norm) in enumerate(torch.stack(gradient_telemetry).tolist()):
+            summary_writer.add_scalar(f'gradients/max_gradient', max_gradient, epoch * len(dataloader_train) + batch_idx)
+            summary_writer.add_scalar(f'gradients/global_norm', global_norm, epoch * len(dataloader_train) + batch_idx)
+
+        if args.distributed:
+            # means over the batches of all ranks
+            loss_accumulate_train = distributed_utils.all_reduce_means(loss_accumulate_train)
         for k, noise in loss_accumulate_train.items():
             loss_accumulate_train[k] = np.asarray(noise).mean()
             if "loss" in k:
@@ -186,100 +380,87 @@ def train_and_evaluate(args):
         ################################################################################################################
         # evaluate
         ################################################################################################################
-        def calculate_scores(dataloader, return_scores_by_sigma=True, L=args.L):
+        def calculate_scores(dataloader, L=args.L):
             """
             This function calculates the log densities and score norms for the given dataloader.
             :param L: int or list of floats.
                     If int, then L is the number of sigmas linspaced from args.sigma_low to args.sigma_high to evaluate.
                     If list, then L is the list of sigmas to evaluate.
+            :return: sorted list of the L sigmas, (N, L, 2) array of scores, the last axis is ordered as eval_utils.SCORE_TYPES,
+                    and in patch mode the (N, P, L, 2) array of the patch scores the frame scores are reduced from, else None
             """
-            with tqdm(dataloader) as tepoch:
-                tepoch.set_description(f"Calculate noise free log-densities/score norms across sigmas")
-                model.eval()
-                anomaly_scores = dict()
-                scores_by_sigma = dict()
-                loss_accumulate = dict()
-
-                if L.__class__ == list().__class__:
-                    sigma_L = np.asarray(L).tolist()
-                else:
-                    sigma_L = np.linspace(args.sigma_low, args.sigma_high, L).tolist()
-                    # sigma_L = np.exp(np.asarray(sigma_L)).tolist()
-                sigma_L = list(map(lambda x: float(f"{x:.5f}"), sigma_L))
-
-                for sigma_ in sigma_L:
-                    score_id, log_density_id = f"score_norm_{sigma_}", f"log_density_{sigma_}" #, f"gibbs_boltzmann_{sigma_}"
-                    if log_density_id not in anomaly_scores:
-                        anomaly_scores[score_id] = list()
-                        anomaly_scores[log_density_id] = list()
-                        scores_by_sigma[sigma_] = {"log_density": list(), "score_norm": list()}
-                        loss_accumulate[score_id] = list()
-                        loss_accumulate[log_density_id] = list()
-
-                for batch_idx, (data, labels) in enumerate(tepoch):
-                    x = data.to(args.device)
-                    x = x.reshape(x.shape[0], -1)
-                    x = (x - data_train_mean) / (data_train_std + 1e-8)
-                    x = x.requires_grad_()
-
-                    for sigma_ in sigma_L:  # iterate every sigma for 1:L
-                        score_id, log_density_id = f"score_norm_{sigma_}", f"log_density_{sigma_}" #, f"gibbs_boltzmann_{sigma_}"
-
-                        model.zero_grad()
-                        lambda_factor = sigma_ ** 2  # this is a scalar
-                        score_, log_density_ = model.score(torch.hstack([x, sigma_ * torch.ones((x.shape[0], 1), device=x.device)]), return_log_density=True)  # evaluate clean sample at noise scale sigma_
-                        score_squared_norms = (torch.norm(score_[:, :-1], dim=1) ** 2)
-                        anomaly_scores[log_density_id] += log_density_.ravel().tolist()
-                        anomaly_scores[score_id] += (lambda_factor * score_squared_norms).ravel().tolist()
-                        # scores[gibss_id] += torch.exp(-log_density_.ravel()).tolist()
-
-                        scores_by_sigma[sigma_]["log_density"] += log_density_.ravel().tolist()
-                        scores_by_sigma[sigma_]["score_norm"] += score_squared_norms.ravel().tolist()
-
-            if return_scores_by_sigma:
-                anomaly_scores = scores_by_sigma
-            return anomaly_scores
+            sigma_L = eval_utils.get_sigmas(L, args.sigma_low, args.sigma_high)
+            if args.patch_size:
+                patch_scores = eval_utils.calculate_patch_scores(model, dataloader, sigma_L, data_train_mean, data_train_std, args.device,
+                                                                 frame_shape, args.patch_size, args.patch_stride)
+                return sigma_L, eval_utils.reduce_patch_scores(patch_scores, args.patch_reduction), patch_scores
+            return sigma_L, eval_utils.calculate_scores(model, dataloader, sigma_L, data_train_mean, data_train_std, args.device), None
 
         if epoch % 5 == 0:
             # anomaly scores from test set
-            scores_test = calculate_scores(dataloader_test, return_scores_by_sigma=True)
-
+            test_sigmas, scores_test, patch_scores_test = calculate_scores(dataloader_test_eval)
+            # anomaly scores from the train set or its coreset, used for calculating statistics and for GMM fitting
+            _, scores_train, _ = calculate_scores(dataloader_train_eval)
+            if args.distributed:
+                # scores of the shards of all ranks, in dataset order on rank 0
+                scores_test = distributed_utils.gather_shards(scores_test, len(data_test))
+                scores_train = distributed_utils.gather_shards(scores_train, len(data_reference))
+                if patch_scores_test is not None:
+                    patch_scores_test = distributed_utils.gather_shards(patch_scores_test, len(data_test))
+
+        if epoch % 5 == 0 and distributed_utils.is_main_process():
             ############################################################################################################
             # AGGREGATE evaluation
             ############################################################################################################
-            # anomaly scores from train set, used for calculating statistics and for GMM fitting
-            scores_train = calculate_scores(dataloader_train, return_scores_by_sigma=True)
 
-            anomaly_score_names = list(scores_train.values())[0].keys()  # log_density, score_norm
-            test_sigmas = list(sorted(scores_train.keys()))  # sigmas 1:L
+            anomaly_score_names = eval_utils.SCORE_TYPES  # log_density, score_norm
+            has_log_density = not args.score_network  # score networks only provide score norms
+            if not has_log_density:
+                anomaly_score_names = ["score_norm"]
 
             # calculate statistics for max, median, mean of standardized scores
             auc_roc_aggregate = dict()
+            aggregate_scores = dict()  # (score_type, aggregate) -> (N,) aggregated test scores
+            multiscale_data_train, multiscale_data_test = dict(), dict()
             for score_type_ in anomaly_score_names:
+                score_type_idx = eval_utils.SCORE_TYPES.index(score_type_)
                 # L-dimensional feature vectors
-                multiscale_data_train_ = np.asarray([scores_train[sigma_][score_type_] for sigma_ in test_sigmas]).T
-                multiscale_data_test_ = np.asarray([scores_test[sigma_][score_type_] for sigma_ in test_sigmas]).T
+                multiscale_data_train_ = scores_train[:, :, score_type_idx]
+                multiscale_data_test_ = scores_test[:, :, score_type_idx]
+                multiscale_data_train[score_type_] = multiscale_data_train_
+                multiscale_data_test[score_type_] = multiscale_data_test_
 
                 ms_mean = multiscale_data_train_.mean(axis=0)
                 ms_std = multiscale_data_train_.std(axis=0)
 
                 multiscale_data_test_standardized = (multiscale_data_test_ - ms_mean) / (ms_std + 1e-8)
 
-                auc_roc_aggregate[f"{score_type_}"] = dict()
-                auc_roc_aggregate[f"{score_type_}"]["max"] = roc_auc_score(labels_test, multiscale_data_test_standardized.max(axis=1))
-                auc_roc_aggregate[f"{score_type_}"]["median"] = roc_auc_score(labels_test, np.median(multiscale_data_test_standardized, axis=1))
-                auc_roc_aggregate[f"{score_type_}"]["mean"] = roc_auc_score(labels_test, multiscale_data_test_standardized.mean(axis=1))
-
-                # GMM fit - takes a while:
-                if args.gmm:
-                    # for components_ in [1, 3, 5, 7, 9]:
-                    for components_ in [1, 3, 5]:
-                        # fit L-dimensional TRAIN feature vectors with GMM
-                        gmm = mixture.GaussianMixture(n_components=components_, covariance_type='full').fit(multiscale_data_train_)
-                        # evaluate L-dimensional TEST feature vectors
-                        ll_scores = gmm.score_samples(multiscale_data_test_)
+                aggregate_scores[(score_type_, "max")] = multiscale_data_test_standardized.max(axis=1)
+                aggregate_scores[(score_type_, "median")] = np.median(multiscale_data_test_standardized, axis=1)
+                aggregate_scores[(score_type_, "mean")] = multiscale_data_test_standardized.mean(axis=1)
+
+            # GMM fit - warm-started from the previous evaluation, all score types and components fitted in one batched EM
+            if args.gmm:
+                # fit L-dimensional TRAIN feature vectors with GMMs
+                multiscale_gmm.fit(multiscale_data_train)
+                # evaluate L-dimensional TEST feature vectors with all GMMs at once
+                ll_scores = multiscale_gmm.score_samples(multiscale_data_test)
+                for score_type_ in anomaly_score_names:
+                    for components_ in multiscale_gmm.components:
                         # add NLL of GMM to final scores
-                        auc_roc_aggregate[f"{score_type_}"][f"gmm({components_})_nll"] = roc_auc_score(labels_test, -ll_scores)
+                        aggregate_scores[(score_type_, f"gmm({components_})_nll")] = -ll_scores[(score_type_, components_)]
+
+            # AUC-ROC of all aggregates in one pass
+            aggregate_keys = list(aggregate_scores.keys())
+            aggregate_aucs = eval_utils.roc_auc_scores(labels_test, np.stack([aggregate_scores[key] for key in aggregate_keys], axis=1))
+            for (score_type_, agg_type_), auc_ in zip(aggregate_keys, aggregate_aucs.tolist()):
+                auc_roc_aggregate.setdefault(f"{score_type_}", dict())[agg_type_] = auc_
+            if args.gmm:
+                for score_type_ in anomaly_score_names:
+                    # number of components selected by BIC on the train scores
+                    bic_components = multiscale_gmm.best_components(score_type_)
+                    auc_roc_aggregate[f"{score_type_}"]["gmm(bic)_nll"] = auc_roc_aggregate[f"{score_type_}"][f"gmm({bic_components})_nll"]
+                    summary_writer.add_scalar(f"gmm_bic_components/{score_type_}", bic_components, epoch)
 
             # add to tensorboard as bar charts comparing log-density vs score norm
             for score_type_ in anomaly_score_names:
@@ -293,13 +474,11 @@ def train_and_evaluate(args):
                 summary_writer.add_scalar(f"_roc_auc_best/_best_{score_type_}_aggregate", best_auc_aggregate, epoch)
 
             fig, ax = plt.subplots(figsize=figsize)
-            categories = list(auc_roc_aggregate['log_density'].keys())
-            log_density_values = list(auc_roc_aggregate['log_density'].values())
-            score_norm_values = list(auc_roc_aggregate['score_norm'].values())
+            categories = list(auc_roc_aggregate['score_norm'].keys())
             bar_width = 0.35
             index = np.arange(len(categories))
-            ax.bar(index, log_density_values, bar_width, label='log_density')
-            ax.bar(index + bar_width, score_norm_values, bar_width, label='score_norm')
+            for bar_idx, score_type_ in enumerate(anomaly_score_names):
+                ax.bar(index + bar_idx * bar_width, list(auc_roc_aggregate[score_type_].values()), bar_width, label=score_type_)
             ax.set_xlabel('Categories')
             ax.set_ylabel('AUC-ROC')
             ax.set_title('Comparison of log_density and score_norm')
@@ -316,18 +495,12 @@ def train_and_evaluate(args):
             best_sigma_log_density = 0
             best_auc_roc_score_norm = 0
             best_sigma_score_norm = 0
-            all_auc_roc_log_density = list()
-            all_auc_roc_score_norm = list()
-            for sigma in list(sorted(scores_test.keys())):
-                score_norms_ = np.asarray(scores_test[sigma]["score_norm"])
-                log_densities = np.asarray(scores_test[sigma]["log_density"])
-
-                auc_roc_log_density = roc_auc_score(labels_test, log_densities)
-                auc_roc_score_norm = roc_auc_score(labels_test, score_norms_)
-
-                all_auc_roc_log_density.append(auc_roc_log_density)
-                all_auc_roc_score_norm.append(auc_roc_score_norm)
-
+            # AUC-ROC of log-densities and score norms of all sigmas in one pass, (N, 2L) columns
+            individual_scores = np.concatenate([scores_test[:, :, 0], scores_test[:, :, 1]], axis=1)  # log_density, score_norm
+            individual_aucs = eval_utils.roc_auc_scores(labels_test, individual_scores).tolist()
+            all_auc_roc_log_density = individual_aucs[:len(test_sigmas)]
+            all_auc_roc_score_norm = individual_aucs[len(test_sigmas):]
+            for sigma, auc_roc_log_density, auc_roc_score_norm in zip(test_sigmas, all_auc_roc_log_density, all_auc_roc_score_norm):
                 if auc_roc_log_density > best_auc_roc_log_density:
                     best_auc_roc_log_density = auc_roc_log_density
                     best_sigma_log_density = sigma
@@ -335,30 +508,48 @@ def train_and_evaluate(args):
                     best_auc_roc_score_norm = auc_roc_score_norm
                     best_sigma_score_norm = sigma
 
-                summary_writer.add_scalar(f"roc_auc_log_density_individual/sigma_{sigma}", auc_roc_log_density, epoch)
+                if has_log_density:
+                    summary_writer.add_scalar(f"roc_auc_log_density_individual/sigma_{sigma}", auc_roc_log_density, epoch)
                 summary_writer.add_scalar(f"roc_auc_score_norm_individual/sigma_{sigma}", auc_roc_score_norm, epoch)
 
-            summary_writer.add_scalar(f"_roc_auc_best/_best_log_density_individual", best_auc_roc_log_density, epoch)
+            if has_log_density:
+                summary_writer.add_scalar(f"_roc_auc_best/_best_log_density_individual", best_auc_roc_log_density, epoch)
             summary_writer.add_scalar(f"_roc_auc_best/_best_score_norm_individual", best_auc_roc_score_norm, epoch)
 
             fig, ax = plt.subplots(figsize=figsize)
-            ax.plot(list(sorted(scores_test.keys())), all_auc_roc_log_density, label="log density")
-            ax.plot(list(sorted(scores_test.keys())), all_auc_roc_score_norm, label="score norm")
+            if has_log_density:
+                ax.plot(test_sigmas, all_auc_roc_log_density, label="log density")
+            ax.plot(test_sigmas, all_auc_roc_score_norm, label="score norm")
             ax.legend()
             ax.set_xlabel("Sigma")
             ax.set_ylabel("AUC-ROC")
-            ax.set_xlim([list(sorted(scores_test.keys()))[0], list(sorted(scores_test.keys()))[-1]])
+            ax.set_xlim([test_sigmas[0], test_sigmas[-1]])
             ax.set_ylim([0, 1])
             summary_writer.add_figure(f"_roc_auc_individual", fig, epoch)
             plt.close()
 
-
-        if epoch % 5 == 0 and args.plot_dataset and data_train.shape[1] == 2:
-            # scores_manifold = calculate_scores(dataloader_manifold, return_scores_by_sigma=True, L=3)
-            scores_manifold = calculate_scores(dataloader_manifold, return_scores_by_sigma=True, L=[1e-3, 1e-2, 1e-1, 0.5, 1.])
-            # scores_manifold = calculate_scores(dataloader_manifold, return_scores_by_sigma=True, L=5)
-            for sigma_, scores_ in scores_manifold.items():
-                for log_density_score_norm, data_ in scores_.items():
+            if patch_scores_test is not None:
+                # patch-level anomaly map of the score norms of the most anomalous test frame at the best sigma
+                sigma_idx = test_sigmas.index(best_sigma_score_norm)
+                frame_idx = int(np.argmax(scores_test[:, sigma_idx, 1]))
+                anomaly_map = data_utils.fold_patch_scores(patch_scores_test[frame_idx:frame_idx + 1, :, sigma_idx, 1], frame_shape,
+                                                           args.patch_size, args.patch_stride)[0]
+                fig, ax = plt.subplots(figsize=figsize)
+                ax.imshow(data_test[frame_idx].reshape(frame_shape), cmap="gray")
+                image = ax.imshow(anomaly_map, cmap="jet", alpha=0.4)
+                fig.colorbar(image, ax=ax, label="score_norm")
+                ax.set_title(f"test frame {frame_idx} (label {int(labels_test[frame_idx])}), sigma {best_sigma_score_norm}")
+                summary_writer.add_figure(f"_anomaly_map", fig, epoch)
+                plt.close()
+
+
+        if epoch % 5 == 0 and args.plot_dataset and data_train.shape[1] == 2 and distributed_utils.is_main_process():
+            # manifold_sigmas, scores_manifold = calculate_scores(dataloader_manifold, L=3)
+            manifold_sigmas, scores_manifold, _ = calculate_scores(dataloader_manifold, L=[1e-3, 1e-2, 1e-1, 0.5, 1.])
+            # manifold_sigmas, scores_manifold = calculate_scores(dataloader_manifold, L=5)
+            for sigma_idx, sigma_ in enumerate(manifold_sigmas):
+                for score_type_idx, log_density_score_norm in enumerate(eval_utils.SCORE_TYPES):
+                    data_ = scores_manifold[:, sigma_idx, score_type_idx]
                     plt.figure(figsize=figsize)
                     data_ = np.asarray(data_).reshape(meshgrid_points, meshgrid_points)
                     plotting_utils.plot_mesh(plt, xx, yy, data_, cmap=cmap_mesh, colorbar_label=f"{log_density_score_norm}")
@@ -382,7 +573,18 @@ def train_and_evaluate(args):
                     summary_writer.add_figure(f"{log_density_score_norm}_with_data/sigma_{sigma_}", plt.gcf(), epoch)
                     plt.close()
 
+        # the other ranks wait for the AUC-ROC/GMM evaluation of rank 0
+        distributed_utils.barrier()
+
+    if args.save_checkpoint and distributed_utils.is_main_process():
+        save_checkpoint(f"{log_path}/checkpoint.pt", model, dict(model_config, score_network=args.score_network), data_train_mean, data_train_std,
+                        sigma_low=args.sigma_low, sigma_high=args.sigma_high, L=args.L,
+                        patch_size=args.patch_size, patch_stride=args.patch_stride, patch_reduction=args.patch_reduction, frame_shape=frame_shape,
+                        static_pixel_threshold=args.static_pixel_threshold, static_pixel_indices=static_pixel_indices, resolution=args.resolution,
+                        temporal_frames=args.temporal_frames, temporal_mode=args.temporal_mode)
+
     summary_writer.flush()
+    distributed_utils.cleanup()
 
 
 if __name__ == '__main__':
@@ -393,6 +595,11 @@ if __name__ == '__main__':
     parser.add_argument("--epochs", type=int, default=10, help='')
     parser.add_argument("--lr", type=float, default=5e-4, help='')
     parser.add_argument("--batch_size", type=int, default=2048, help='')
+    parser.add_argument('--device_resident', action='store_true', help='keep the datasets on the device and batch by indexing, '
+                                                                      'falls back to a pinned-memory prefetching loader if they do not fit')
+    parser.set_defaults(device_resident=False)
+    parser.add_argument('--uint8_data', action='store_true', help='with --device_resident, store the frames as uint8 instead of float32')
+    parser.set_defaults(uint8_data=False)
     parser.add_argument('--units', nargs='+', default=[4096, 4096], help='', type=int)
     parser.add_argument('--sigma_low', type=float, default=1e-3)
     parser.add_argument('--sigma_high', type=float, default=1.)
@@ -407,10 +614,63 @@ if __name__ == '__main__':
     parser.set_defaults(layernorm=False)
     parser.add_argument('--gmm', action='store_true', help="fit GMM to log-density scores, takes a while")
     parser.set_defaults(gmm=False)
+    parser.add_argument('--gmm_subsample', type=int, default=None, help="fit the GMMs on at most this many train score vectors")
+    parser.add_argument('--gmm_cold_start', action='store_true', help="refit the GMMs from scratch instead of warm-starting from the previous evaluation")
+    parser.set_defaults(gmm_cold_start=False)
     parser.add_argument('--gradient_clipping', type=float, default=None, help='value for gradient clipping')
     parser.add_argument("--meshgrid_offset", type=float, default=10., help='')
     parser.add_argument("--L", type=int, default=16, help='number of sigmas to evaluate')
     parser.add_argument('--beta', type=float, default=None, help="factor for regularizing log-density")
+    parser.add_argument('--save_checkpoint', action='store_true', help="save model and standardization statistics to <log_path>/checkpoint.pt after training")
+    parser.set_defaults(save_checkpoint=False)
+    parser.add_argument('--analytic_score', action='store_true', help="compute the score with an explicit backward pass through the MLP "
+                                                                      "instead of autograd, training needs no double backward")
+    parser.set_defaults(analytic_score=False)
+    parser.add_argument('--score_network', action='store_true', help="train a score network (MSMA/NCSN) that outputs the score directly, "
+                                                                     "no double backward, evaluated on score norms only")
+    parser.set_defaults(score_network=False)
+    parser.add_argument('--score_head_rank', type=int, default=512, help="rank of the d-dimensional output layer of the score network, 0 for full rank")
+    parser.add_argument('--patch_size', type=int, default=None, help="patch mode: train on and score patch_size x patch_size patches of the frames")
+    parser.add_argument('--patch_stride', type=int, default=None, help="stride of the patches, defaults to patch_size (non-overlapping)")
+    parser.add_argument('--patch_reduction', type=str, default="max", help="frame score from the patch scores, 'max' or a quantile, e.g. 0.99")
+    parser.add_argument("--frame_shape", nargs=2, type=int, default=[240, 360], help='height and width of the full resolution frames')
+    parser.add_argument('--resolution', type=int, default=None, help="downsampling factor of the frames, e.g. 2, 4 or 8, "
+                                                                      "loaded from the area-averaged resolution pyramid of the frame cache")
+    parser.add_argument('--frame_store', type=str, default=None, help="read the frames from a frame store written by frame_store.py "
+                                                                      "instead of the .tif files")
+    parser.add_argument('--lazy', action='store_true', help="with --frame_store, decompress the train frames chunk by chunk while training "
+                                                            "instead of loading them into memory")
+    parser.set_defaults(lazy=False)
+    parser.add_argument('--lazy_workers', type=int, default=0, help="with --lazy, DataLoader worker processes decompressing the chunks")
+    parser.add_argument('--video_dir', type=str, default=None, help="read the frames from video files in <video_dir>/Train and <video_dir>/Test, "
+                                                                    "resized to --frame_shape / --resolution")
+    parser.add_argument('--video_stride', type=int, default=1, help="with --video_dir, keep every video_stride-th frame")
+    parser.add_argument('--temporal_frames', type=int, default=1, help="number of consecutive frames of an input, the first frame of a video "
+                                                                       "is repeated for the first inputs")
+    parser.add_argument('--temporal_mode', type=str, default="frames", choices=data_utils.TEMPORAL_MODES,
+                        help="with --temporal_frames, stack the frames or the last frame and the differences of consecutive frames")
+    parser.add_argument('--coreset', type=str, default=None, choices=data_utils.CORESET_METHODS,
+                        help="select a coreset of the train frames, k_center (--coreset_size) or frame_difference (--coreset_threshold), cached in cache/")
+    parser.add_argument('--coreset_size', type=float, default=0.1, help="with --coreset k_center, fraction of the train frames selected")
+    parser.add_argument('--coreset_threshold', type=float, default=0.01, help="with --coreset frame_difference, minimum mean absolute difference "
+                                                                              "of a kept frame to the last kept frame of its video")
+    parser.add_argument('--coreset_downsample', type=int, default=4, help="downsampling factor of the frames compared by the coreset selection")
+    parser.add_argument('--coreset_train', action='store_true', help="train on the coreset instead of all train frames")
+    parser.set_defaults(coreset_train=False)
+    parser.add_argument('--coreset_reference', action='store_true', help="take the reference statistics of the aggregate evaluation "
+                                                                         "and the GMMs from the scores of the coreset")
+    parser.set_defaults(coreset_reference=False)
+    parser.add_argument('--static_pixel_threshold', type=float, default=None, help="drop pixels with a std over the training frames "
+                                                                                   "of at most this value, e.g. 0.02, the mask is cached in cache/")
+    parser.add_argument('--distributed', action='store_true', help="data-parallel training with DistributedDataParallel, "
+                                                                   "spawns --nprocs local processes unless started by torchrun")
+    parser.set_defaults(distributed=False)
+    parser.add_argument('--nprocs', type=int, default=2, help="number of local processes with --distributed without torchrun")
+    parser.add_argument('--dist_backend', type=str, default="gloo", help="torch.distributed backend, gloo for CPU nodes")
+    parser.add_argument('--threads_per_process', type=int, default=None, help="intra-op threads per process, defaults to cores / local processes")
 
     args = parser.parse_args()
-    train_and_evaluate(args)
+    if args.distributed:
+        distributed_utils.launch(train_and_evaluate, args, nprocs=args.nprocs)
+    else:
+        train_and_evaluate(args)
@@ -20,13 +20,14 @@ The individual sigma evaluation is based on the AUC-ROC of the scores for each s
 import numpy as np
 import argparse
 import utils
+import data_utils
 import torch
-from models import MLPs, ScoreOrLogDensityNetwork
+from models import MLPs, ScoreOrLogDensityNetwork, save_checkpoint
 import torch.optim as optim
 from torch.utils.data import TensorDataset, DataLoader
-from sklearn.metrics import roc_auc_score
+import eval_utils
 from tqdm import tqdm
-from sklearn import mixture
+from gmm_utils import MultiscaleGMM
 import matplotlib.pyplot as plt
 from uscd_dataset_loader import get_dataset, create_meshgrid_from_data
 torch.cuda.empty_cache() # uncomment this if you have GPU on your device
@@ -56,6 +57,8 @@ max_roc_auc_score_norm_individual = -np.inf
 def train_and_evaluate(args):
     global max_roc_auc_log_density_aggregate, max_roc_auc_score_norm_aggregate
     global max_roc_auc_log_density_individual, max_roc_auc_score_norm_individual
+    if args.score_network and args.beta:
+        raise ValueError("--beta regularizes the log-density, which score networks do not model")
 
     # zeros are normal, ones are anomalous
     data_train, labels_train, data_test, labels_test, id_to_type = get_dataset(data_dir,m_file_path)
@@ -77,10 +80,10 @@ def train_and_evaluate(args):
     data_train_mean = data_train_mean.to(args.device)
     data_train_std = data_train_std.to(args.device)
 
-    dataset_train = TensorDataset(data_train, torch.Tensor(labels_train))
-    dataset_test = TensorDataset(data_test, torch.Tensor(labels_test))
-    dataloader_train = DataLoader(dataset_train, shuffle=True, batch_size=args.batch_size)
-    dataloader_test = DataLoader(dataset_test, shuffle=False, batch_size=args.batch_size)
+    dataloader_train = data_utils.get_dataloader(data_train, torch.Tensor(labels_train), batch_size=args.batch_size, shuffle=True, device=args.device,
+                                                 device_resident=args.device_resident, uint8=args.uint8_data)
+    dataloader_test = data_utils.get_dataloader(data_test, torch.Tensor(labels_test), batch_size=args.batch_size, shuffle=False, device=args.device,
+                                                device_resident=args.device_resident, uint8=args.uint8_data)
 
     if data_train.shape[1] == 2:
         meshgrid_points = 200
@@ -92,18 +95,18 @@ def train_and_evaluate(args):
         dataloader_manifold = DataLoader(dataset_manifold, shuffle=False, batch_size=args.batch_size)
 
 
-    model = ScoreOrLogDensityNetwork(MLPs(input_dim=data_train.reshape(data_train.shape[0], -1).shape[1] + 1, # +1 for noise conditioning
-                                          units=args.units,
-                                          dropout=args.dropout,
-                                          layernorm=args.layernorm),
-                                     score_network=False).to(args.device)
+    model_config = dict(input_dim=data_train.reshape(data_train.shape[0], -1).shape[1] + 1, # +1 for noise conditioning
+                        units=args.units,
+                        dropout=args.dropout,
+                        layernorm=args.layernorm)
+    if args.score_network:
+        # MSMA/NCSN: the network outputs the (d + 1)-dimensional score, its head is factorized through score_head_rank units
+        model_config.update(output_dim=model_config["input_dim"], output_rank=args.score_head_rank or None)
+    model = ScoreOrLogDensityNetwork(MLPs(**model_config),
+                                     score_network=args.score_network,
+                                     analytic_score=args.analytic_score).to(args.device)
 
 
-    if args.gradient_clipping:
-        clip_value = args.gradient_clipping  # e.g. 5e-1
-        for p in model.parameters():
-            p.register_hook(lambda grad: torch.clamp(grad, -clip_value, clip_value))
-
     optimizer = optim.Adam(model.parameters(), lr=args.lr, betas=(0.5, 0.9))
 
     scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=50, gamma=0.9)
@@ -129,6 +132,10 @@ def train_and_evaluate(args):
         plt.close()
 
 
+    # for components_ in [1, 3, 5, 7, 9]:
+    multiscale_gmm = MultiscaleGMM(components=[1, 3, 5], warm_start=not args.gmm_cold_start, subsample=args.gmm_subsample,
+                                   device=args.device)
+
     for epoch in range(args.epochs + 1):
         ################################################################################################################
         # train
@@ -138,6 +145,7 @@ def train_and_evaluate(args):
             model.train()
             loss_accumulate = 0
             loss_accumulate_train = utils.LossAccumulate()
+            gradient_telemetry = list()  # (max gradient, global gradient norm) device tensors of every batch
 
             for batch_idx, data in enumerate(tepoch):
                 x = data[0].to(args.device)
@@ -151,7 +159,8 @@ def train_and_evaluate(args):
                 # sample noise
                 noise = torch.randn_like(x, device=args.device) * sigma  # scale N(0, I) with sigma -> N(0, sigma I)
 
-                x = x.requires_grad_()
+                if not args.analytic_score:  # the analytic score needs no gradient w.r.t. the input
+                    x = x.requires_grad_()
                 x_ = x + noise  # add noise to data
                 
                 sigma_cpu = sigma.cpu()
@@ -181,11 +190,16 @@ def train_and_evaluate(args):
                 optimizer.zero_grad()
                 loss.backward()
 
-                all_grads = [torch.max(param.grad).item() for param in model.parameters() if param.grad is not None]
-                summary_writer.add_scalar(f'gradients/max_gradient', max(all_grads), epoch * len(tepoch) + batch_idx)
+                # clip gradients to [-gradient_clipping, gradient_clipping], e.g. 5e-1
+                gradient_telemetry.append(torch.stack(utils.clip_and_track_gradients(model.parameters(), args.gradient_clipping)))
                 optimizer.step()
                 loss_accumulate += loss.item()
 
+        # single host synchronization for the gradient telemetry of the epoch
+        for batch_idx, (max_gradient, global_norm) in enumerate(torch.stack(gradient_telemetry).tolist()):
+            summary_writer.add_scalar(f'gradients/max_gradient', max_gradient, epoch * len(dataloader_train) + batch_idx)
+            summary_writer.add_scalar(f'gradients/global_norm', global_norm, epoch * len(dataloader_train) + batch_idx)
+
         for k, noise in loss_accumulate_train.items():
             loss_accumulate_train[k] = np.asarray(noise).mean()
             if "loss" in k:
@@ -199,104 +213,75 @@ def train_and_evaluate(args):
         ################################################################################################################
         # evaluate
         ################################################################################################################
-        def calculate_scores(dataloader, return_scores_by_sigma=True, L=args.L):
+        def calculate_scores(dataloader, L=args.L):
             """
             This function calculates the log densities and score norms for the given dataloader.
             :param L: int or list of floats.
                     If int, then L is the number of sigmas linspaced from args.sigma_low to args.sigma_high to evaluate.
                     If list, then L is the list of sigmas to evaluate.
+            :return: sorted list of the L sigmas and (N, L, 2) array of scores, the last axis is ordered as eval_utils.SCORE_TYPES
             """
-            with tqdm(dataloader) as tepoch:
-                tepoch.set_description(f"Calculate noise free log-densities/score norms across sigmas")
-                model.eval()
-                anomaly_scores = dict()
-                scores_by_sigma = dict()
-                loss_accumulate = dict()
-
-                if L.__class__ == list().__class__:
-                    sigma_L = np.asarray(L).tolist()
-                else:
-                    sigma_L = np.linspace(args.sigma_low, args.sigma_high, L).tolist()
-                    # sigma_L = np.exp(np.asarray(sigma_L)).tolist()
-                sigma_L = list(map(lambda x: float(f"{x:.5f}"), sigma_L))
-
-                for sigma_ in sigma_L:
-                    score_id, log_density_id = f"score_norm_{sigma_}", f"log_density_{sigma_}" #, f"gibbs_boltzmann_{sigma_}"
-                    if log_density_id not in anomaly_scores:
-                        anomaly_scores[score_id] = list()
-                        anomaly_scores[log_density_id] = list()
-                        scores_by_sigma[sigma_] = {"log_density": list(), "score_norm": list()}
-                        loss_accumulate[score_id] = list()
-                        loss_accumulate[log_density_id] = list()
-
-                for batch_idx, (data, labels) in enumerate(tepoch):
-                    x = data.to(args.device)
-                    x = x.reshape(x.shape[0], -1)
-                    x = (x - data_train_mean) / (data_train_std + 1e-8)
-                    x = x.requires_grad_()
-
-                    for sigma_ in sigma_L:  # iterate every sigma for 1:L
-                        score_id, log_density_id = f"score_norm_{sigma_}", f"log_density_{sigma_}" #, f"gibbs_boltzmann_{sigma_}"
-
-                        model.zero_grad()
-
-                        
-                        sigma_cpu_new = torch.tensor(sigma_).cpu()
-                        lambda_factor_updated = (sigma_cpu_new ** 2) * np.exp(-((sigma_cpu_new - sigma_0_cpu) ** 2) / (2 * sigma_spread_cpu ** 2))
-                        lambda_factor = lambda_factor_updated.ravel().to(args.device) # this is a scalar
-                        score_, log_density_ = model.score(torch.hstack([x, sigma_ * torch.ones((x.shape[0], 1), device=x.device)]), return_log_density=True)  # evaluate clean sample at noise scale sigma_
-                        score_squared_norms = (torch.norm(score_[:, :-1], dim=1) ** 2)
-                        anomaly_scores[log_density_id] += log_density_.ravel().tolist()
-                        anomaly_scores[score_id] += (lambda_factor * score_squared_norms).ravel().tolist()
-                        # scores[gibss_id] += torch.exp(-log_density_.ravel()).tolist()
-
-                        scores_by_sigma[sigma_]["log_density"] += log_density_.ravel().tolist()
-                        scores_by_sigma[sigma_]["score_norm"] += score_squared_norms.ravel().tolist()
-
-            if return_scores_by_sigma:
-                anomaly_scores = scores_by_sigma
-            return anomaly_scores
+            sigma_L = eval_utils.get_sigmas(L, args.sigma_low, args.sigma_high)
+            return sigma_L, eval_utils.calculate_scores(model, dataloader, sigma_L, data_train_mean, data_train_std, args.device)
 
         if epoch % 5 == 0:
             # anomaly scores from test set
-            scores_test = calculate_scores(dataloader_test, return_scores_by_sigma=True)
+            test_sigmas, scores_test = calculate_scores(dataloader_test)
 
             ############################################################################################################
             # AGGREGATE evaluation
             ############################################################################################################
             # anomaly scores from train set, used for calculating statistics and for GMM fitting
-            scores_train = calculate_scores(dataloader_train, return_scores_by_sigma=True)
+            _, scores_train = calculate_scores(dataloader_train)
 
-            anomaly_score_names = list(scores_train.values())[0].keys()  # log_density, score_norm
-            test_sigmas = list(sorted(scores_train.keys()))  # sigmas 1:L
+            anomaly_score_names = eval_utils.SCORE_TYPES  # log_density, score_norm
+            has_log_density = not args.score_network  # score networks only provide score norms
+            if not has_log_density:
+                anomaly_score_names = ["score_norm"]
 
             # calculate statistics for max, median, mean of standardized scores
             auc_roc_aggregate = dict()
+            aggregate_scores = dict()  # (score_type, aggregate) -> (N,) aggregated test scores
+            multiscale_data_train, multiscale_data_test = dict(), dict()
             for score_type_ in anomaly_score_names:
+                score_type_idx = eval_utils.SCORE_TYPES.index(score_type_)
                 # L-dimensional feature vectors
-                multiscale_data_train_ = np.asarray([scores_train[sigma_][score_type_] for sigma_ in test_sigmas]).T
-                multiscale_data_test_ = np.asarray([scores_test[sigma_][score_type_] for sigma_ in test_sigmas]).T
+                multiscale_data_train_ = scores_train[:, :, score_type_idx]
+                multiscale_data_test_ = scores_test[:, :, score_type_idx]
+                multiscale_data_train[score_type_] = multiscale_data_train_
+                multiscale_data_test[score_type_] = multiscale_data_test_
 
                 ms_mean = multiscale_data_train_.mean(axis=0)
                 ms_std = multiscale_data_train_.std(axis=0)
 
                 multiscale_data_test_standardized = (multiscale_data_test_ - ms_mean) / (ms_std + 1e-8)
 
-                auc_roc_aggregate[f"{score_type_}"] = dict()
-                auc_roc_aggregate[f"{score_type_}"]["max"] = roc_auc_score(labels_test, multiscale_data_test_standardized.max(axis=1))
-                auc_roc_aggregate[f"{score_type_}"]["median"] = roc_auc_score(labels_test, np.median(multiscale_data_test_standardized, axis=1))
-                auc_roc_aggregate[f"{score_type_}"]["mean"] = roc_auc_score(labels_test, multiscale_data_test_standardized.mean(axis=1))
-
-                # GMM fit - takes a while:
-                if args.gmm:
-                    # for components_ in [1, 3, 5, 7, 9]:
-                    for components_ in [1, 3, 5]:
-                        # fit L-dimensional TRAIN feature vectors with GMM
-                        gmm = mixture.GaussianMixture(n_components=components_, covariance_type='full').fit(multiscale_data_train_)
-                        # evaluate L-dimensional TEST feature vectors
-                        ll_scores = gmm.score_samples(multiscale_data_test_)
+                aggregate_scores[(score_type_, "max")] = multiscale_data_test_standardized.max(axis=1)
+                aggregate_scores[(score_type_, "median")] = np.median(multiscale_data_test_standardized, axis=1)
+                aggregate_scores[(score_type_, "mean")] = multiscale_data_test_standardized.mean(axis=1)
+
+            # GMM fit - warm-started from the previous evaluation, all score types and components fitted in one batched EM
+            if args.gmm:
+                # fit L-dimensional TRAIN feature vectors with GMMs
+                multiscale_gmm.fit(multiscale_data_train)
+                # evaluate L-dimensional TEST feature vectors with all GMMs at once
+                ll_scores = multiscale_gmm.score_samples(multiscale_data_test)
+                for score_type_ in anomaly_score_names:
+                    for components_ in multiscale_gmm.components:
                         # add NLL of GMM to final scores
-                        auc_roc_aggregate[f"{score_type_}"][f"gmm({components_})_nll"] = roc_auc_score(labels_test, -ll_scores)
+                        aggregate_scores[(score_type_, f"gmm({components_})_nll")] = -ll_scores[(score_type_, components_)]
+
+            # AUC-ROC of all aggregates in one pass
+            aggregate_keys = list(aggregate_scores.keys())
+            aggregate_aucs = eval_utils.roc_auc_scores(labels_test, np.stack([aggregate_scores[key] for key in aggregate_keys], axis=1))
+            for (score_type_, agg_type_), auc_ in zip(aggregate_keys, aggregate_aucs.tolist()):
+                auc_roc_aggregate.setdefault(f"{score_type_}", dict())[agg_type_] = auc_
+            if args.gmm:
+                for score_type_ in anomaly_score_names:
+                    # number of components selected by BIC on the train scores
+                    bic_components = multiscale_gmm.best_components(score_type_)
+                    auc_roc_aggregate[f"{score_type_}"]["gmm(bic)_nll"] = auc_roc_aggregate[f"{score_type_}"][f"gmm({bic_components})_nll"]
+                    summary_writer.add_scalar(f"gmm_bic_components/{score_type_}", bic_components, epoch)
 
             # add to tensorboard as bar charts comparing log-density vs score norm
             for score_type_ in anomaly_score_names:
@@ -315,13 +300,11 @@ def train_and_evaluate(args):
                 summary_writer.add_scalar(f"_roc_auc_best/_best_{score_type_}_aggregate", best_auc_aggregate, epoch)
 
             fig, ax = plt.subplots(figsize=figsize)
-            categories = list(auc_roc_aggregate['log_density'].keys())
-            log_density_values = list(auc_roc_aggregate['log_density'].values())
-            score_norm_values = list(auc_roc_aggregate['score_norm'].values())
+            categories = list(auc_roc_aggregate['score_norm'].keys())
             bar_width = 0.35
             index = np.arange(len(categories))
-            ax.bar(index, log_density_values, bar_width, label='log_density')
-            ax.bar(index + bar_width, score_norm_values, bar_width, label='score_norm')
+            for bar_idx, score_type_ in enumerate(anomaly_score_names):
+                ax.bar(index + bar_idx * bar_width, list(auc_roc_aggregate[score_type_].values()), bar_width, label=score_type_)
             ax.set_xlabel('Categories')
             ax.set_ylabel('AUC-ROC')
             ax.set_title('Comparison of log_density and score_norm')
@@ -338,22 +321,17 @@ def train_and_evaluate(args):
             best_sigma_log_density = 0
             best_auc_roc_score_norm = 0
             best_sigma_score_norm = 0
-            all_auc_roc_log_density = list()
-            all_auc_roc_score_norm = list()
-            for sigma in list(sorted(scores_test.keys())):
-                score_norms_ = np.asarray(scores_test[sigma]["score_norm"])
-                log_densities = np.asarray(scores_test[sigma]["log_density"])
-
-                auc_roc_log_density = roc_auc_score(labels_test, log_densities)
-                auc_roc_score_norm = roc_auc_score(labels_test, score_norms_)
-
+            # AUC-ROC of log-densities and score norms of all sigmas in one pass, (N, 2L) columns
+            individual_scores = np.concatenate([scores_test[:, :, 0], scores_test[:, :, 1]], axis=1)  # log_density, score_norm
+            individual_aucs = eval_utils.roc_auc_scores(labels_test, individual_scores).tolist()
+            all_auc_roc_log_density = individual_aucs[:len(test_sigmas)]
+            all_auc_roc_score_norm = individual_aucs[len(test_sigmas):]
+            for sigma, auc_roc_log_density, auc_roc_score_norm in zip(test_sigmas, all_auc_roc_log_density, all_auc_roc_score_norm):
                 # Track maximum AUC-ROC for individual sigmas
-                max_roc_auc_log_density_individual = max(max_roc_auc_log_density_individual, auc_roc_log_density)
+                if has_log_density:
+                    max_roc_auc_log_density_individual = max(max_roc_auc_log_density_individual, auc_roc_log_density)
                 max_roc_auc_score_norm_individual = max(max_roc_auc_score_norm_individual, auc_roc_score_norm)
 
-                all_auc_roc_log_density.append(auc_roc_log_density)
-                all_auc_roc_score_norm.append(auc_roc_score_norm)
-
                 if auc_roc_log_density > best_auc_roc_log_density:
                     best_auc_roc_log_density = auc_roc_log_density
                     best_sigma_log_density = sigma
@@ -361,30 +339,34 @@ def train_and_evaluate(args):
                     best_auc_roc_score_norm = auc_roc_score_norm
                     best_sigma_score_norm = sigma
 
-                summary_writer.add_scalar(f"roc_auc_log_density_individual/sigma_{sigma}", auc_roc_log_density, epoch)
+                if has_log_density:
+                    summary_writer.add_scalar(f"roc_auc_log_density_individual/sigma_{sigma}", auc_roc_log_density, epoch)
                 summary_writer.add_scalar(f"roc_auc_score_norm_individual/sigma_{sigma}", auc_roc_score_norm, epoch)
 
-            summary_writer.add_scalar(f"_roc_auc_best/_best_log_density_individual", best_auc_roc_log_density, epoch)
+            if has_log_density:
+                summary_writer.add_scalar(f"_roc_auc_best/_best_log_density_individual", best_auc_roc_log_density, epoch)
             summary_writer.add_scalar(f"_roc_auc_best/_best_score_norm_individual", best_auc_roc_score_norm, epoch)
 
             fig, ax = plt.subplots(figsize=figsize)
-            ax.plot(list(sorted(scores_test.keys())), all_auc_roc_log_density, label="log density")
-            ax.plot(list(sorted(scores_test.keys())), all_auc_roc_score_norm, label="score norm")
+            if has_log_density:
+                ax.plot(test_sigmas, all_auc_roc_log_density, label="log density")
+            ax.plot(test_sigmas, all_auc_roc_score_norm, label="score norm")
             ax.legend()
             ax.set_xlabel("Sigma")
             ax.set_ylabel("AUC-ROC")
-            ax.set_xlim([list(sorted(scores_test.keys()))[0], list(sorted(scores_test.keys()))[-1]])
+            ax.set_xlim([test_sigmas[0], test_sigmas[-1]])
             ax.set_ylim([0, 1])
             summary_writer.add_figure(f"_roc_auc_individual", fig, epoch)
             plt.close()
 
 
         if epoch % 5 == 0 and args.plot_dataset and data_train.shape[1] == 2:
-            # scores_manifold = calculate_scores(dataloader_manifold, return_scores_by_sigma=True, L=3)
-            scores_manifold = calculate_scores(dataloader_manifold, return_scores_by_sigma=True, L=[1e-3, 1e-2, 1e-1, 0.5, 1.])
-            # scores_manifold = calculate_scores(dataloader_manifold, return_scores_by_sigma=True, L=5)
-            for sigma_, scores_ in scores_manifold.items():
-                for log_density_score_norm, data_ in scores_.items():
+            # manifold_sigmas, scores_manifold = calculate_scores(dataloader_manifold, L=3)
+            manifold_sigmas, scores_manifold = calculate_scores(dataloader_manifold, L=[1e-3, 1e-2, 1e-1, 0.5, 1.])
+            # manifold_sigmas, scores_manifold = calculate_scores(dataloader_manifold, L=5)
+            for sigma_idx, sigma_ in enumerate(manifold_sigmas):
+                for score_type_idx, log_density_score_norm in enumerate(eval_utils.SCORE_TYPES):
+                    data_ = scores_manifold[:, sigma_idx, score_type_idx]
                     plt.figure(figsize=figsize)
                     data_ = np.asarray(data_).reshape(meshgrid_points, meshgrid_points)
                     plotting_utils.plot_mesh(plt, xx, yy, data_, cmap=cmap_mesh, colorbar_label=f"{log_density_score_norm}")
@@ -415,6 +397,10 @@ def train_and_evaluate(args):
     print("Max _roc_auc_best/_best_log_density_individual:", max_roc_auc_log_density_individual)
     print("Max _roc_auc_best/_best_score_norm_individual:", max_roc_auc_score_norm_individual)
 
+    if args.save_checkpoint:
+        save_checkpoint(f"{log_path}/checkpoint.pt", model, dict(model_config, score_network=args.score_network), data_train_mean, data_train_std,
+                        sigma_low=args.sigma_low, sigma_high=args.sigma_high, L=args.L)
+
     summary_writer.flush()
 
 
@@ -426,6 +412,11 @@ if __name__ == '__main__':
     parser.add_argument("--epochs", type=int, default=500, help='')
     parser.add_argument("--lr", type=float, default=5e-4, help='')
     parser.add_argument("--batch_size", type=int, default=2048, help='')
+    parser.add_argument('--device_resident', action='store_true', help='keep the datasets on the device and batch by indexing, '
+                                                                      'falls back to a pinned-memory prefetching loader if they do not fit')
+    parser.set_defaults(device_resident=False)
+    parser.add_argument('--uint8_data', action='store_true', help='with --device_resident, store the frames as uint8 instead of float32')
+    parser.set_defaults(uint8_data=False)
     parser.add_argument('--units', nargs='+', default=[4096, 4096], help='', type=int)
     parser.add_argument('--sigma_low', type=float, default=1e-3)
     parser.add_argument('--sigma_high', type=float, default=1.)
@@ -440,10 +431,22 @@ if __name__ == '__main__':
     parser.set_defaults(layernorm=False)
     parser.add_argument('--gmm', action='store_true', help="fit GMM to log-density scores, takes a while")
     parser.set_defaults(gmm=False)
+    parser.add_argument('--gmm_subsample', type=int, default=None, help="fit the GMMs on at most this many train score vectors")
+    parser.add_argument('--gmm_cold_start', action='store_true', help="refit the GMMs from scratch instead of warm-starting from the previous evaluation")
+    parser.set_defaults(gmm_cold_start=False)
     parser.add_argument('--gradient_clipping', type=float, default=None, help='value for gradient clipping')
     parser.add_argument("--meshgrid_offset", type=float, default=10., help='')
     parser.add_argument("--L", type=int, default=16, help='number of sigmas to evaluate')
     parser.add_argument('--beta', type=float, default=None, help="factor for regularizing log-density")
+    parser.add_argument('--save_checkpoint', action='store_true', help="save model and standardization statistics to <log_path>/checkpoint.pt after training")
+    parser.set_defaults(save_checkpoint=False)
+    parser.add_argument('--analytic_score', action='store_true', help="compute the score with an explicit backward pass through the MLP "
+                                                                      "instead of autograd, training needs no double backward")
+    parser.set_defaults(analytic_score=False)
+    parser.add_argument('--score_network', action='store_true', help="train a score network (MSMA/NCSN) that outputs the score directly, "
+                                                                     "no double backward, evaluated on score norms only")
+    parser.set_defaults(score_network=False)
+    parser.add_argument('--score_head_rank', type=int, default=512, help="rank of the d-dimensional output layer of the score network, 0 for full rank")
 
     args = parser.parse_args()
     train_and_evaluate(args)
@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import os
+import copy
 
 """
       score network: input_dim == output_dim 
@@ -9,6 +10,20 @@ log-density network: input_dim == n, output_dim == 1
 
 noise conditioned: input_dim == n + 1
 """
+class LowRankLinear(nn.Module):
+    def __init__(self, in_features, out_features, rank):
+        """
+        nn.Linear with the weight factorized as (out_features, rank) x (rank, in_features),
+        used as the d-dimensional output head of score networks on high-dimensional inputs.
+        """
+        super().__init__()
+        self.down = nn.Linear(in_features, rank, bias=False)
+        self.up = nn.Linear(rank, out_features)
+
+    def forward(self, x):
+        return self.up(self.down(x))
+
+
 class MLPs(nn.Module):
     def __init__(
             self,
@@ -17,8 +32,12 @@ class MLPs(nn.Module):
             units=[4096, 4096],
             layernorm=False,
             dropout=None,
-            last_activation=nn.Identity()
+            last_activation=nn.Identity(),
+            output_rank=None
     ):
+        """
+        :param output_rank: if given and smaller than the dimensions of the output layer, the output layer is a LowRankLinear
+        """
         super().__init__()
         layers = []
         in_dim = input_dim
@@ -40,7 +59,10 @@ class MLPs(nn.Module):
             ])
             in_dim = out_dim
 
-        layers.append(nn.Linear(in_dim, output_dim))
+        if output_rank is not None and output_rank < min(in_dim, output_dim):
+            layers.append(LowRankLinear(in_dim, output_dim, output_rank))
+        else:
+            layers.append(nn.Linear(in_dim, output_dim))
         layers.append(last_activation)
         self.network = nn.Sequential(*layers)
 
@@ -50,7 +72,7 @@ class MLPs(nn.Module):
 
 # --- log-density model ---
 class ScoreOrLogDensityNetwork(nn.Module):
-    def __init__(self, net, score_network=False):
+    def __init__(self, net, score_network=False, analytic_score=False):
         """
         For standard MULDE use ScoreOrLogDensityNetwork(MLPs(input_dim=d+1, output_dim=1, units=[4096, 4096]))
         For MSMA/NCSN use ScoreOrLogDensityNetwork(MLPs(input_dim=d+1, output_dim=d, units=[4096, 4096]), use score_network=True)
@@ -65,10 +87,16 @@ class ScoreOrLogDensityNetwork(nn.Module):
                 In this case the grad(-log-density(x)) is not computed, but the output of the network is returned.
                 d -> d mapping instead of d -> 1. Defaults to False.
                 This is used for the MSMA model.
+            analytic_score (bool, optional): If True and net is an MLPs, the score is computed with an explicit backward pass
+                (mlp_forward_and_input_gradient) instead of torch.autograd.grad(..., create_graph=True),
+                training then needs a single backward pass instead of a double backward. Defaults to False.
         """
         super().__init__()
         self.network = net
         self.is_score_network = score_network
+        self.analytic_score = analytic_score
+        # set by fold_standardization: maps the gradient w.r.t. the raw input back to the standardized input space
+        self.register_buffer("score_scale", None)
 
     def forward(self, x):
         return self.network(x)
@@ -79,17 +107,87 @@ class ScoreOrLogDensityNetwork(nn.Module):
             score = self.network(x)  # log-density network is actually the score network. n_in (+ 1) == n_out
             if return_log_density:  # in order to preserve the coding interface, return zeros for log-densities
                 log_density = torch.zeros_like(score[:, 0][:, None])
+        elif self.analytic_score and isinstance(self.network, MLPs):
+            log_density, grad = mlp_forward_and_input_gradient(self.network.network, x)
+            score = -grad  # grad(-log-density(x))
+            if self.score_scale is not None:
+                score = score * self.score_scale
         else:  # actual MULDE model
             x = x.requires_grad_()
             log_density = self.network(x)
             logp = -log_density.sum()
             score = torch.autograd.grad(logp, x, create_graph=True)[0]  # grad(-log-density(x))
+            if self.score_scale is not None:
+                score = score * self.score_scale
 
         if return_log_density:
             return score, log_density
         else:
             return score
 
+    def supports_shared_projection(self):
+        """ True for MULDE log-density MLPs, see multiscale_log_density_and_score_norm """
+        return (not self.is_score_network and isinstance(self.network, MLPs)
+                and isinstance(self.network.network[0], nn.Sequential) and isinstance(self.network.network[0][0], nn.Linear))
+
+    def score_norm_gram(self):
+        """
+        Gram matrix W_x diag(score_scale^2) W_x^T of the data columns W_x of the first layer, (H, H).
+        The squared score norm of a sample is g^T G g with g the gradient w.r.t. the first pre-activation,
+        which is cheaper than g^T W_x when the number of hidden units H is smaller than the input dimension d.
+        :return: the Gram matrix, or None if H >= d and the score is cheaper to compute directly
+        """
+        linear = self.network.network[0][0]
+        d = linear.in_features - 1
+        if linear.out_features >= d:
+            return None
+        with torch.no_grad():
+            weight_x = linear.weight[:, :d]
+            if self.score_scale is not None:
+                weight_x = weight_x * self.score_scale[:d]
+            return weight_x @ weight_x.T
+
+    def multiscale_log_density_and_score_norm(self, x, sigmas, gram=None):
+        """
+        Noise free log-densities and squared score norms (without the sigma dimension) of x at every sigma.
+        The first layer's projection of the data W_x x + b is computed once and shared by all sigmas, which only add
+        sigma * w_sigma, the column of the noise conditioning. Only available for MULDE log-density MLPs.
+
+        :param x: (N, d) inputs
+        :param sigmas: (L,) tensor of noise scales
+        :param gram: optional result of score_norm_gram, used for the score norms if given
+        :return: (N, L) log-densities and (N, L) squared score norms
+        """
+        mlp = self.network.network
+        first_block, linear = mlp[0], mlp[0][0]
+        d = linear.in_features - 1
+        weight_x, weight_sigma = linear.weight[:, :d], linear.weight[:, d]
+        N, L, H = x.shape[0], sigmas.shape[0], linear.out_features
+
+        with torch.no_grad():
+            projection = x @ weight_x.T + linear.bias  # (N, H), shared by all sigmas
+            pre_activation = (projection[:, None, :] + sigmas[None, :, None] * weight_sigma).reshape(N * L, H)
+        if self.analytic_score:
+            with torch.no_grad():
+                # gradient of +log-density, the sign drops out of the squared norm
+                log_density, grad_pre = mlp_forward_and_input_gradient(list(first_block[1:]) + list(mlp[1:]), pre_activation)
+        else:
+            with torch.enable_grad():
+                pre_activation.requires_grad_()
+                log_density = mlp[1:](first_block[1:](pre_activation))  # (N * L, 1)
+                # gradient of -log-density w.r.t. the first pre-activation, the score is grad_pre @ W_x
+                grad_pre = torch.autograd.grad(-log_density.sum(), pre_activation)[0]
+
+        with torch.no_grad():
+            if gram is not None:
+                score_norm = ((grad_pre @ gram) * grad_pre).sum(dim=1)
+            else:
+                score = grad_pre @ weight_x
+                if self.score_scale is not None:
+                    score = score * self.score_scale[:d]
+                score_norm = (score ** 2).sum(dim=1)
+        return log_density.detach().reshape(N, L), score_norm.reshape(N, L)
+
     def save(self, path):
         os.makedirs(os.path.dirname(path), exist_ok=True)
         torch.save(self.state_dict(), path)
@@ -97,3 +195,134 @@ class ScoreOrLogDensityNetwork(nn.Module):
     def load(self, path):
         self.load_state_dict(torch.load(path))
         return self
+
+
+def _gelu_derivative(z):
+    # d/dz z * Phi(z) = Phi(z) + z * phi(z)
+    return 0.5 * (1. + torch.erf(z * 0.7071067811865476)) + z * torch.exp(-0.5 * z ** 2) * 0.3989422804014327
+
+
+class GELUBackward(torch.autograd.Function):
+    """
+    grad * GELU'(z) of the explicit backward pass, with a hand-derived backward for training through the score:
+    only grad and z are saved instead of the graph of the erf/exp expression, GELU''(z) = phi(z) * (2 - z^2).
+    """
+    @staticmethod
+    def forward(ctx, grad, z):
+        ctx.save_for_backward(grad, z)
+        return grad * _gelu_derivative(z)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad, z = ctx.saved_tensors
+        pdf = torch.exp(-0.5 * z ** 2) * 0.3989422804014327
+        return grad_output * _gelu_derivative(z), grad_output * grad * pdf * (2. - z ** 2)
+
+
+def mlp_forward_and_input_gradient(layers, x):
+    """
+    Output of a stack of MLPs layers and the gradient of its sum w.r.t. the input, with the backward pass written out
+    explicitly instead of using autograd, so that it can be traced into graphs without autograd (TorchScript, ONNX).
+    The pre-activations of the forward pass are reused by the backward pass. With gradients enabled the result is
+    differentiable w.r.t. the parameters, e.g. for training with the DSM loss without a double backward.
+    Supports nn.Linear, nn.LayerNorm, exact nn.GELU, nn.Identity and nn.Dropout (the mask is applied in both passes).
+
+    :param layers: nn.Sequential or list of layers, nested nn.Sequential blocks are flattened
+    :param x: (N, d_in)
+    :return: (N, d_out) outputs and (N, d_in) gradient of outputs.sum() w.r.t. x
+    """
+    flat_layers = list()
+    for layer in layers:
+        flat_layers.extend(layer if isinstance(layer, nn.Sequential) else [layer])
+
+    cache = list()  # values needed by the backward pass of every layer
+    h = x
+    for layer in flat_layers:
+        if isinstance(layer, nn.Linear):
+            cache.append(None)
+            h = nn.functional.linear(h, layer.weight, layer.bias)
+        elif isinstance(layer, nn.LayerNorm):
+            mean = h.mean(dim=-1, keepdim=True)
+            inv_std = torch.rsqrt(((h - mean) ** 2).mean(dim=-1, keepdim=True) + layer.eps)
+            h_normalized = (h - mean) * inv_std
+            cache.append((h_normalized, inv_std))
+            h = h_normalized * layer.weight + layer.bias if layer.elementwise_affine else h_normalized
+        elif isinstance(layer, nn.GELU) and layer.approximate == "none":
+            cache.append(h)
+            h = nn.functional.gelu(h)
+        elif isinstance(layer, nn.Dropout) and layer.training and layer.p > 0:
+            mask = (torch.rand_like(h) >= layer.p).to(h.dtype) / (1. - layer.p)
+            cache.append(mask)
+            h = h * mask
+        elif isinstance(layer, (nn.Identity, nn.Dropout)):
+            cache.append(None)
+        else:
+            raise ValueError(f"mlp_forward_and_input_gradient does not support {layer}")
+
+    grad = torch.ones_like(h)
+    for layer, cached in zip(reversed(flat_layers), reversed(cache)):
+        if isinstance(layer, nn.Linear):
+            grad = grad @ layer.weight
+        elif isinstance(layer, nn.LayerNorm):
+            h_normalized, inv_std = cached
+            if layer.elementwise_affine:
+                grad = grad * layer.weight
+            grad = inv_std * (grad - grad.mean(dim=-1, keepdim=True) - h_normalized * (grad * h_normalized).mean(dim=-1, keepdim=True))
+        elif isinstance(layer, nn.GELU):
+            z = cached
+            if torch.is_grad_enabled() and (z.requires_grad or grad.requires_grad):
+                grad = GELUBackward.apply(grad, z)
+            else:  # plain tensor operations for tracing
+                grad = grad * _gelu_derivative(z)
+        elif isinstance(layer, nn.Dropout) and cached is not None:
+            grad = grad * cached
+    return h, grad
+
+
+def first_linear(model):
+    return next(module for module in model.modules() if isinstance(module, nn.Linear))
+
+
+def fold_standardization(model, data_train_mean, data_train_std, eps=1e-8, input_scale=1.):
+    """
+    Folds the input standardization (x * input_scale - mean) / (std + eps) into the weights and bias of the first nn.Linear,
+    so that the returned model consumes raw inputs, e.g. input_scale=1/255 for pixels in [0, 255].
+    The log-densities are unchanged; the score is rescaled by score_scale, so it is still the score w.r.t. the standardized input.
+    The last input dimension (noise conditioning sigma) is left untouched.
+
+    :return: a standardization-folded copy of the ScoreOrLogDensityNetwork
+    """
+    folded = copy.deepcopy(model)
+    linear = first_linear(folded.network)
+    d = linear.in_features - 1
+    scale = torch.ones(d, device=linear.weight.device) * input_scale / (data_train_std.to(linear.weight.device) + eps)  # (d,)
+    shift = data_train_mean.to(linear.weight.device) / (data_train_std.to(linear.weight.device) + eps) * torch.ones(d, device=linear.weight.device)  # (d,)
+    with torch.no_grad():
+        linear.bias -= linear.weight[:, :d] @ shift
+        linear.weight[:, :d] *= scale[None, :]
+    folded.score_scale = torch.cat([1. / scale, torch.ones(1, device=scale.device)])
+    return folded
+
+
+def save_checkpoint(path, model, model_config, data_train_mean, data_train_std, **kwargs):
+    """
+    :param model_config: keyword arguments of MLPs and score_network, used by load_checkpoint to rebuild the model
+    :param kwargs: further entries, e.g. sigma_low, sigma_high, L
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.save(dict(state_dict=model.state_dict(), model_config=model_config,
+                    data_train_mean=data_train_mean.cpu(), data_train_std=data_train_std.cpu(), **kwargs), path)
+
+
+def load_checkpoint(path, device="cpu"):
+    """
+    :return: ScoreOrLogDensityNetwork in eval mode and the checkpoint dict
+    """
+    checkpoint = torch.load(path, map_location=device)
+    model_config = dict(checkpoint["model_config"])
+    score_network = model_config.pop("score_network", False)
+    model = ScoreOrLogDensityNetwork(MLPs(**model_config), score_network=score_network)
+    if checkpoint["state_dict"].get("score_scale") is not None:
+        model.score_scale = torch.empty_like(checkpoint["state_dict"]["score_scale"])
+    model.load_state_dict(checkpoint["state_dict"])
+    return model.to(device).eval(), checkpoint
@@ -0,0 +1,220 @@
+"""
+Structured pruning of the hidden units of a model trained with --save_checkpoint
+
+# keep 50%, 25% and 12.5% of the units of every hidden layer, ranked by weight magnitude, fine-tune each for 5 epochs
+python prune.py --checkpoint runs/MULDE/<timestamp>/checkpoint.pt --keep_ratios 0.5 0.25 0.125
+
+# rank the units by their mean absolute activation on training frames
+python prune.py --checkpoint runs/MULDE/<timestamp>/checkpoint.pt --keep_ratios 0.25 --criterion activation --finetune_epochs 10
+
+Every pruned model is a smaller dense MLPs, fine-tuned with the DSM objective of main.py, saved to
+<log_path>/checkpoint_keep_<ratio>.pt and reported with its per-sigma AUC-ROC and FLOPs per frame.
+"""
+
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from tqdm import tqdm
+import utils
+import eval_utils
+from models import MLPs, ScoreOrLogDensityNetwork, load_checkpoint, save_checkpoint
+from uscd_dataset_loader import get_checkpoint_dataset
+
+data_dir = "UCSD_Anomaly_Dataset.v1p2/UCSDped2"
+m_file_path = "UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test/UCSDped2.m"
+
+
+def hidden_blocks(model):
+    """ hidden blocks (Linear, LayerNorm, GELU, Dropout) of the MLPs and the output Linear """
+    layers = model.network.network
+    return [layer for layer in layers if isinstance(layer, nn.Sequential)], next(layer for layer in layers if isinstance(layer, nn.Linear))
+
+
+def flops_per_frame(model, L):
+    """
+    multiply-adds x 2 of the Linear layers for the multiscale scores of one frame at L sigmas,
+    the data projection of the first layer is shared by all sigmas (see multiscale_log_density_and_score_norm)
+    """
+    blocks, output_linear = hidden_blocks(model)
+    linears = [block[0] for block in blocks] + [output_linear]
+    first = 2 * (linears[0].in_features - 1) * linears[0].out_features
+    per_sigma = sum(2 * linear.in_features * linear.out_features for linear in linears[1:]) + 2 * linears[0].out_features
+    return first + L * per_sigma
+
+
+def unit_importance(model, criterion, data=None, sigma_L=None, batch_size=256):
+    """
+    :param criterion: "magnitude": L2-norm of the incoming weights times L2-norm of the outgoing weights of a unit,
+            "activation": mean absolute activation on the (standardized) data at the sigmas times L2-norm of the outgoing weights
+    :return: list of (H_i,) importance tensors, one per hidden block
+    """
+    blocks, output_linear = hidden_blocks(model)
+    next_linears = [block[0] for block in blocks[1:]] + [output_linear]
+    outgoing = [linear.weight.detach().norm(dim=0) for linear in next_linears]
+    if criterion == "magnitude":
+        return [block[0].weight.detach().norm(dim=1) * outgoing_ for block, outgoing_ in zip(blocks, outgoing)]
+
+    activations = [torch.zeros(block[0].out_features, device=block[0].weight.device) for block in blocks]
+    hooks = [block.register_forward_hook(lambda module, inputs, output, i=i: activations[i].add_(output.abs().sum(dim=0)))
+             for i, block in enumerate(blocks)]
+    sigmas = torch.tensor(sigma_L, device=data.device)
+    model.eval()
+    with torch.no_grad():
+        for start in range(0, len(data), batch_size):
+            x = data[start:start + batch_size]
+            for sigma in sigmas:
+                model(torch.hstack([x, sigma * torch.ones((x.shape[0], 1), device=x.device)]))
+    for hook in hooks:
+        hook.remove()
+    return [activation / (len(data) * len(sigma_L)) * outgoing_ for activation, outgoing_ in zip(activations, outgoing)]
+
+
+def prune_units(model, model_config, keep_indices):
+    """
+    Physically removes hidden units, the result is a dense MLPs with len(keep_indices[i]) units in block i.
+    Removing units changes the statistics of a LayerNorm over the units, which is compensated by fine-tuning.
+
+    :param keep_indices: list of sorted index tensors of the units kept in every hidden block
+    :return: pruned ScoreOrLogDensityNetwork and its model_config
+    """
+    pruned_config = dict(model_config, units=[len(indices) for indices in keep_indices])
+    pruned = ScoreOrLogDensityNetwork(MLPs(**pruned_config), score_network=False).to(next(model.parameters()).device)
+    blocks, output_linear = hidden_blocks(model)
+    pruned_blocks, pruned_output_linear = hidden_blocks(pruned)
+
+    with torch.no_grad():
+        input_indices = torch.arange(blocks[0][0].in_features)
+        for block, pruned_block, indices in zip(blocks, pruned_blocks, keep_indices):
+            pruned_block[0].weight.copy_(block[0].weight[indices][:, input_indices])
+            pruned_block[0].bias.copy_(block[0].bias[indices])
+            if isinstance(block[1], nn.LayerNorm):
+                pruned_block[1].weight.copy_(block[1].weight[indices])
+                pruned_block[1].bias.copy_(block[1].bias[indices])
+            input_indices = indices
+        pruned_output_linear.weight.copy_(output_linear.weight[:, input_indices])
+        pruned_output_linear.bias.copy_(output_linear.bias)
+    return pruned, pruned_config
+
+
+def finetune(model, dataloader_train, data_train_mean, data_train_std, args, summary_writer, tag):
+    """ fine-tunes with the denoising score matching loss and the optional log-density regularizer of main.py """
+    optimizer = optim.Adam(model.parameters(), lr=args.lr, betas=(0.5, 0.9))
+    for epoch in range(args.finetune_epochs):
+        with tqdm(dataloader_train) as tepoch:
+            tepoch.set_description(f"Fine-tune {tag} Epoch {epoch}")
+            model.train()
+            loss_accumulate_train = utils.LossAccumulate()
+            for data in tepoch:
+                x = data[0].to(args.device)
+                x = x.reshape(x.shape[0], -1)
+                x = (x - data_train_mean) / (data_train_std + 1e-8)
+
+                sigma = torch.Tensor(np.exp(np.random.uniform(np.log(args.sigma_low), np.log(args.sigma_high), x.size(0)))).unsqueeze(1).to(args.device)
+                noise = torch.randn_like(x, device=args.device) * sigma
+                x = x.requires_grad_()
+                x_ = x + noise
+
+                lambda_factor = (sigma ** 2).ravel()
+                score_ = model.score(torch.hstack([x_, sigma]))
+                loss = torch.norm(score_[:, :-1] + noise / (sigma ** 2), dim=-1) ** 2
+                loss = (lambda_factor * loss).mean() / 2.
+                if args.beta:
+                    _, log_density_noise_free = model.score(torch.hstack([x, sigma]), return_log_density=True)
+                    loss += args.beta * (log_density_noise_free ** 2).mean() / 2.
+
+                optimizer.zero_grad()
+                loss.backward()
+                utils.clip_and_track_gradients(model.parameters(), args.gradient_clipping)
+                optimizer.step()
+                loss_accumulate_train["loss_dsm_reg"].append(loss.item())
+
+        summary_writer.add_scalar(f'loss_finetune_{tag}/loss_dsm_reg', np.asarray(loss_accumulate_train["loss_dsm_reg"]).mean(), epoch)
+    model.eval()
+    return model
+
+
+def prune(args):
+    model, checkpoint = load_checkpoint(args.checkpoint, device=args.device)
+    if checkpoint.get("standardization_folded"):
+        raise ValueError("pruning trains in the standardized input space, use the checkpoint.pt the folded checkpoint was exported from")
+    model_config = dict(checkpoint["model_config"])
+    model_config.pop("score_network", None)
+    data_train_mean, data_train_std = checkpoint["data_train_mean"].to(args.device), checkpoint["data_train_std"].to(args.device)
+    args.sigma_low = checkpoint.get("sigma_low", 1e-3) if args.sigma_low is None else args.sigma_low
+    args.sigma_high = checkpoint.get("sigma_high", 1.) if args.sigma_high is None else args.sigma_high
+    sigma_L = eval_utils.get_sigmas(checkpoint.get("L", 16), args.sigma_low, args.sigma_high)
+    L = len(sigma_L)
+
+    data_train, labels_train, data_test, labels_test, _, video_lengths = get_checkpoint_dataset(data_dir, m_file_path, checkpoint)
+    dataloader_train = eval_utils.checkpoint_dataloader(checkpoint, data_train, labels_train, args.batch_size, shuffle=True, device=args.device,
+                                                        device_resident=args.device_resident, samples=True, video_lengths=video_lengths["train"])
+    dataloader_test = eval_utils.checkpoint_dataloader(checkpoint, data_test, labels_test, args.batch_size, device=args.device,
+                                                       video_lengths=video_lengths["test"])
+
+    calibration_data = None
+    if args.criterion == "activation":
+        torch.manual_seed(args.seed)
+        calibration_data = next(iter(eval_utils.checkpoint_dataloader(checkpoint, data_train, labels_train, args.calibration_frames, shuffle=True,
+                                                                      samples=True, video_lengths=video_lengths["train"])))[0]
+        calibration_data = (calibration_data.to(args.device) - data_train_mean) / (data_train_std + 1e-8)
+    del data_train, data_test
+    importance = unit_importance(model, args.criterion, calibration_data, sigma_L)
+
+    log_path, summary_writer = utils.get_log_path_and_summary_writer(root_dir_runs="runs", experiment_name=args.experiment_name, args=args)
+    utils.save_current_experiment_source_code(log_path)
+
+    def evaluate(model_, tag):
+        aucs = eval_utils.per_sigma_aucs(model_, dataloader_test, labels_test, sigma_L, data_train_mean, data_train_std, args.device, checkpoint)
+        flops = flops_per_frame(model_, L)
+        for score_type_idx, score_type_ in enumerate(eval_utils.SCORE_TYPES):
+            for sigma, auc_ in zip(sigma_L, aucs[:, score_type_idx].tolist()):
+                summary_writer.add_scalar(f"roc_auc_{score_type_}_individual_{tag}/sigma_{sigma}", auc_, 0)
+        summary_writer.add_scalar(f"flops_per_frame/{tag}", flops, 0)
+        return aucs, flops
+
+    results = [("original", model_config["units"]) + evaluate(model, "original")]
+    for keep_ratio in args.keep_ratios:
+        keep_indices = [torch.sort(torch.topk(importance_, max(1, int(round(keep_ratio * len(importance_))))).indices).values
+                        for importance_ in importance]
+        pruned, pruned_config = prune_units(model, model_config, keep_indices)
+        tag = f"keep_{keep_ratio}"
+        results.append((f"{tag} pruned", pruned_config["units"]) + evaluate(pruned, f"{tag}_pruned"))
+        finetune(pruned, dataloader_train, data_train_mean, data_train_std, args, summary_writer, tag)
+        results.append((f"{tag} fine-tuned", pruned_config["units"]) + evaluate(pruned, f"{tag}_finetuned"))
+        save_checkpoint(f"{log_path}/checkpoint_{tag}.pt", pruned, dict(pruned_config, score_network=False), data_train_mean, data_train_std,
+                        sigma_low=args.sigma_low, sigma_high=args.sigma_high, L=checkpoint.get("L", 16),
+                        static_pixel_indices=checkpoint.get("static_pixel_indices"), resolution=checkpoint.get("resolution"),
+                        **{k: checkpoint[k] for k in eval_utils.CHECKPOINT_INPUT_KEYS if k in checkpoint})
+
+    # per-sigma AUC-ROC vs FLOPs
+    print(f"sigmas: {sigma_L}")
+    for name, units, aucs, flops in results:
+        print(f"{name} units {units}: {flops / 1e6:.1f} MFLOPs/frame at {L} sigmas ({flops / results[0][3]:.1%})")
+        for score_type_idx, score_type_ in enumerate(eval_utils.SCORE_TYPES):
+            print(f"    {score_type_} AUC-ROC: " + " ".join(f"{auc_:.4f}" for auc_ in aucs[:, score_type_idx].tolist()))
+    summary_writer.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True, help='checkpoint.pt saved with --save_checkpoint')
+    parser.add_argument("--experiment_name", type=str, default="MULDE_prune")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument('--keep_ratios', nargs='+', type=float, default=[0.5, 0.25], help='fractions of the units kept in every hidden layer')
+    parser.add_argument("--criterion", type=str, default="magnitude", choices=["magnitude", "activation"], help='ranking of the units')
+    parser.add_argument("--calibration_frames", type=int, default=512, help='training frames (patches in patch mode) for the activation statistics')
+    parser.add_argument("--finetune_epochs", type=int, default=5, help='')
+    parser.add_argument("--lr", type=float, default=5e-4, help='')
+    parser.add_argument("--batch_size", type=int, default=2048, help='')
+    parser.add_argument('--device_resident', action='store_true', help='keep the train set on the device and batch by indexing')
+    parser.set_defaults(device_resident=False)
+    parser.add_argument('--sigma_low', type=float, default=None, help='defaults to the sigma_low of the checkpoint')
+    parser.add_argument('--sigma_high', type=float, default=None, help='defaults to the sigma_high of the checkpoint')
+    parser.add_argument('--beta', type=float, default=None, help="factor for regularizing log-density")
+    parser.add_argument('--gradient_clipping', type=float, default=None, help='value for gradient clipping')
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    prune(args)
@@ -0,0 +1,187 @@
+"""
+Int8 log-density inference for a model trained with --save_checkpoint
+
+# dynamic quantization of the Linear layers, compare per-sigma AUC-ROC with fp32 on the test set and benchmark the throughput
+python quantize.py --checkpoint runs/MULDE/<timestamp>/checkpoint.pt
+
+# static quantization, activations calibrated on 512 training frames, save the quantized model
+python quantize.py --checkpoint runs/MULDE/<timestamp>/checkpoint.pt --mode static --calibration_frames 512 --output checkpoint_int8.pt
+
+Only the multiscale log-densities are computed, the score norms need gradients and are not available in int8.
+"""
+
+import argparse
+import copy
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+import data_utils
+import eval_utils
+from models import load_checkpoint
+from uscd_dataset_loader import get_checkpoint_dataset
+
+data_dir = "UCSD_Anomaly_Dataset.v1p2/UCSDped2"
+m_file_path = "UCSD_Anomaly_Dataset.v1p2/UCSDped2/Test/UCSDped2.m"
+
+
+class QuantizedLogDensityNetwork(nn.Module):
+    def __init__(self, model, mode="dynamic", calibration_data=None, calibration_sigmas=None):
+        """
+        Log-density network of a MULDE MLP (ScoreOrLogDensityNetwork with score_network=False) with int8 Linear layers.
+        The first Linear is split into the projection of the data, which is quantized and shared by all sigmas,
+        and the column of the noise conditioning, which stays in fp32 since its scale is far below the one of the standardized data.
+
+        :param model: trained ScoreOrLogDensityNetwork, not modified
+        :param mode: "dynamic" (int8 weights, activations quantized per batch), "static" (activation ranges calibrated) or "fp32"
+        :param calibration_data: (n, d) standardized training frames (raw for folded standardization), required for mode="static"
+        :param calibration_sigmas: sigmas used for calibrating the activations of the layers after the first one
+        """
+        super().__init__()
+        if not model.supports_shared_projection():
+            raise ValueError("int8 inference requires a MULDE log-density MLP, i.e. ScoreOrLogDensityNetwork(MLPs(...), score_network=False)")
+        layers = copy.deepcopy(model.network.network).cpu().eval()
+        first_block = layers[0]
+        linear = first_block[0]
+        d = linear.in_features - 1
+        self.input_projection = nn.Linear(d, linear.out_features)
+        with torch.no_grad():
+            self.input_projection.weight.copy_(linear.weight[:, :d])
+            self.input_projection.bias.copy_(linear.bias)
+        self.register_buffer("sigma_weight", linear.weight[:, d].detach().clone())  # (H,)
+        self.head = nn.Sequential(*first_block[1:], *layers[1:]).eval()  # activation of the first block and all following layers
+        self.mode = mode
+
+        if mode == "dynamic":
+            self.input_projection = torch.ao.quantization.quantize_dynamic(self.input_projection, {nn.Linear}, dtype=torch.qint8)
+            self.head = torch.ao.quantization.quantize_dynamic(self.head, {nn.Linear}, dtype=torch.qint8)
+        elif mode == "static":
+            if calibration_data is None:
+                raise ValueError("static quantization requires calibration_data")
+            self._quantize_static(calibration_data, calibration_sigmas if calibration_sigmas is not None else [1e-3, 1e-2, 1e-1, 1.])
+        elif mode != "fp32":
+            raise ValueError(f"Unknown quantization mode '{mode}', expected 'dynamic', 'static' or 'fp32'")
+
+    def _quantize_static(self, calibration_data, calibration_sigmas, batch_size=256):
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        input_projection = prepare_fx(self.input_projection, qconfig_mapping, example_inputs=(calibration_data[:1],))
+        head = prepare_fx(self.head, qconfig_mapping, example_inputs=(torch.zeros(1, self.sigma_weight.shape[0]),))
+        sigmas = torch.tensor(calibration_sigmas, dtype=calibration_data.dtype)
+        with torch.inference_mode():
+            for start in range(0, len(calibration_data), batch_size):
+                projection = input_projection(calibration_data[start:start + batch_size])  # observes the input and projection ranges
+                head(self._condition(projection, sigmas))
+        self.input_projection = convert_fx(input_projection)
+        self.head = convert_fx(head)
+
+    def _condition(self, projection, sigmas):
+        # (N, H) projection of the data -> (N * L, H) pre-activations of the first layer at every sigma
+        return (projection[:, None, :] + sigmas[None, :, None] * self.sigma_weight).reshape(-1, projection.shape[-1])
+
+    def forward(self, x, sigmas):
+        """
+        :param x: (N, d) standardized frames, raw frames for models with folded standardization
+        :param sigmas: (L,) tensor of noise scales
+        :return: (N, L) log-densities
+        """
+        return self.head(self._condition(self.input_projection(x), sigmas)).reshape(x.shape[0], len(sigmas))
+
+
+def calculate_log_densities(model, dataloader, sigma_L, data_train_mean, data_train_std, checkpoint):
+    """
+    :param dataloader: batches of frames of eval_utils.checkpoint_dataloader
+    :return: (N, L) numpy array of noise free log-densities of the QuantizedLogDensityNetwork at every sigma,
+            in patch mode reduced from the log-densities of the patches of every frame as in eval_utils.calculate_checkpoint_scores
+    """
+    log_densities = np.empty((len(dataloader.dataset), len(sigma_L)), dtype=np.float32)
+    sigmas = torch.tensor(sigma_L)
+    start = 0
+    with torch.inference_mode():
+        for data, _ in tqdm(dataloader, desc=f"Calculate {model.mode} log-densities across sigmas"):
+            x = data.reshape(data.shape[0], -1)
+            if checkpoint.get("patch_size"):
+                x = data_utils.unfold_patches(x, checkpoint["frame_shape"], checkpoint["patch_size"], checkpoint.get("patch_stride"))
+            x = x.reshape(-1, x.shape[-1])
+            x = eval_utils.standardize(x, data_train_mean, data_train_std)
+            log_density = model(x, sigmas).reshape(len(data), -1, len(sigma_L)).numpy()  # (B, P, L), P = 1 for whole frames
+            log_densities[start:start + len(data)] = eval_utils.reduce_patch_scores(log_density, checkpoint.get("patch_reduction", "max"))
+            start += len(data)
+    return log_densities
+
+
+def benchmark(model, x, sigmas, repeats=10):
+    """ :return: frames per second of the multiscale log-density at all sigmas """
+    with torch.inference_mode():
+        model(x, sigmas)  # warm-up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(x, sigmas)
+        return repeats * len(x) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True, help='checkpoint.pt saved with --save_checkpoint')
+    parser.add_argument("--mode", type=str, default="dynamic", choices=["dynamic", "static"])
+    parser.add_argument("--calibration_frames", type=int, default=512, help='number of random training frames (patches in patch mode) for static quantization')
+    parser.add_argument("--batch_size", type=int, default=256, help='')
+    parser.add_argument("--benchmark_repeats", type=int, default=10, help='')
+    parser.add_argument("--threads", type=int, default=None, help='intra-op threads, defaults to all cores')
+    parser.add_argument("--output", type=str, default=None, help='save the quantized model with torch.save')
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model, checkpoint = load_checkpoint(args.checkpoint, device="cpu")
+    data_train_mean, data_train_std = eval_utils.checkpoint_standardization(checkpoint)
+    sigma_L = eval_utils.get_sigmas(checkpoint.get("L", 16), checkpoint.get("sigma_low", 1e-3), checkpoint.get("sigma_high", 1.))
+
+    data_train, labels_train, data_test, labels_test, _, video_lengths = get_checkpoint_dataset(data_dir, m_file_path, checkpoint)
+    calibration_data = None
+    if args.mode == "static":
+        torch.manual_seed(args.seed)
+        calibration_data, _ = next(iter(eval_utils.checkpoint_dataloader(checkpoint, data_train, labels_train, args.calibration_frames, shuffle=True,
+                                                                         samples=True, video_lengths=video_lengths["train"])))
+        calibration_data = eval_utils.standardize(calibration_data, data_train_mean, data_train_std)
+    del data_train
+
+    fp32_model = QuantizedLogDensityNetwork(model, mode="fp32")
+    int8_model = QuantizedLogDensityNetwork(model, mode=args.mode, calibration_data=calibration_data, calibration_sigmas=sigma_L)
+
+    # accuracy: per-sigma AUC-ROC of the log-densities
+    dataloader_test = eval_utils.checkpoint_dataloader(checkpoint, data_test, labels_test, args.batch_size, video_lengths=video_lengths["test"])
+    log_densities_fp32 = calculate_log_densities(fp32_model, dataloader_test, sigma_L, data_train_mean, data_train_std, checkpoint)
+    log_densities_int8 = calculate_log_densities(int8_model, dataloader_test, sigma_L, data_train_mean, data_train_std, checkpoint)
+    auc_fp32 = eval_utils.roc_auc_scores(labels_test, log_densities_fp32)
+    auc_int8 = eval_utils.roc_auc_scores(labels_test, log_densities_int8)
+    for sigma, auc_fp32_, auc_int8_ in zip(sigma_L, auc_fp32.tolist(), auc_int8.tolist()):
+        print(f"sigma {sigma}: AUC-ROC fp32 {auc_fp32_:.4f}, int8 {auc_int8_:.4f} ({auc_int8_ - auc_fp32_:+.4f})")
+    relative_error = np.abs(log_densities_int8 - log_densities_fp32) / (np.abs(log_densities_fp32) + 1e-8)
+    print(f"log-density: median relative error {np.median(relative_error):.2e}, "
+          f"max AUC-ROC difference {np.abs(auc_int8 - auc_fp32).max():.4f}")
+
+    # throughput of the multiscale log-density of one batch of frames, in patch mode of their patches
+    frames = next(iter(dataloader_test))[0]
+    x = frames.reshape(len(frames), -1)
+    if checkpoint.get("patch_size"):
+        x = data_utils.unfold_patches(x, checkpoint["frame_shape"], checkpoint["patch_size"], checkpoint.get("patch_stride"))
+        x = x.reshape(-1, x.shape[-1])
+    x = eval_utils.standardize(x, data_train_mean, data_train_std)
+    sigmas = torch.tensor(sigma_L)
+    inputs_per_frame = len(x) / len(frames)
+    fps_fp32 = benchmark(fp32_model, x, sigmas, repeats=args.benchmark_repeats) / inputs_per_frame
+    fps_int8 = benchmark(int8_model, x, sigmas, repeats=args.benchmark_repeats) / inputs_per_frame
+    print(f"throughput at {len(sigma_L)} sigmas, batch size {len(frames)}, {torch.get_num_threads()} threads: "
+          f"fp32 {fps_fp32:.1f} frames/s, int8 {fps_int8:.1f} frames/s ({fps_int8 / fps_fp32:.2f}x)")
+
+    if args.output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        torch.save(dict(model=int8_model, data_train_mean=data_train_mean, data_train_std=data_train_std, sigma_L=sigma_L,
+                        input_scale=checkpoint.get("input_scale", 1.) if checkpoint.get("standardization_folded") else 1.), args.output)
+        print(f"{args.mode} int8 model saved to {args.output}")
@@ -0,0 +1,159 @@
+"""
+Successive-halving (ASHA) sweep over the hyper-parameters of main_novelty.py
+
+# sweep sigma_mean x std_dev x beta, evaluate rungs at epochs 5, 15, 45, 135, ... and keep the best third at every rung
+python sweep.py --sweep_sigma_mean 0.1 0.2 0.33 0.5 --sweep_std_dev 0.05 0.075 0.1 --sweep_beta 0 0.1 --grace_period 5 --reduction_factor 3
+
+# every argument of main_novelty.py is accepted and shared by all trials
+python sweep.py --sweep_sigma_mean 0.2 0.33 --epochs 100 --gmm --device cuda:0
+
+Trials run one after another. A trial reaching a rung is stopped unless its metric is within the top
+1/reduction_factor of all results recorded at that rung so far (asynchronous successive halving,
+Li et al. "A System for Massively Parallel Hyperparameter Tuning", 2020), so hopeless configurations are
+terminated after grace_period epochs instead of running the full epoch count.
+"""
+
+import itertools
+import copy
+import numpy as np
+import main_novelty
+
+roc_auc_best_metrics = ["_best_log_density_aggregate", "_best_score_norm_aggregate",
+                        "_best_log_density_individual", "_best_score_norm_individual"]
+
+
+class ASHAScheduler:
+    def __init__(self, max_epochs, grace_period=5, reduction_factor=3, metric="_best_log_density_aggregate", eval_every=5):
+        """
+        :param max_epochs: epochs of a trial that is never stopped
+        :param grace_period: epoch of the first rung, every trial trains at least this long
+        :param reduction_factor: only the best 1/reduction_factor of the trials are promoted at every rung
+        :param metric: one of the _roc_auc_best metrics reported by train_and_evaluate, or "max" for the best of them
+        :param eval_every: train_and_evaluate only evaluates every eval_every epochs, rungs are rounded up to it
+        """
+        if reduction_factor < 2:
+            raise ValueError(f"reduction_factor must be >= 2, got {reduction_factor}")
+        if metric not in roc_auc_best_metrics + ["max"]:
+            raise ValueError(f"Unknown metric '{metric}', expected one of {roc_auc_best_metrics + ['max']}")
+        self.metric = metric
+        self.reduction_factor = reduction_factor
+
+        self.rungs = list()
+        rung = max(grace_period, 1)
+        while rung < max_epochs:
+            rung_ = int(np.ceil(rung / eval_every) * eval_every)
+            if rung_ < max_epochs and rung_ not in self.rungs:
+                self.rungs.append(rung_)
+            rung *= reduction_factor
+        # results recorded at each rung by all trials so far
+        self.rung_results = {rung_: list() for rung_ in self.rungs}
+
+    def get_metric(self, roc_auc_best):
+        if self.metric == "max":
+            return max(roc_auc_best.values())
+        if self.metric not in roc_auc_best:
+            raise ValueError(f"metric '{self.metric}' is not reported by the trial, available are {sorted(roc_auc_best)}")
+        return roc_auc_best[self.metric]
+
+    def on_result(self, epoch, value):
+        """
+        Records the result of a trial and decides whether it is promoted to the next rung.
+        :return: True if the trial continues, False if it should be stopped
+        """
+        if epoch not in self.rung_results:
+            return True
+        recorded = self.rung_results[epoch]
+        recorded.append(value)
+        cutoff = np.percentile(recorded, (1 - 1 / self.reduction_factor) * 100)
+        return bool(value >= cutoff)
+
+
+class Trial:
+    def __init__(self, trial_id, config, scheduler):
+        self.trial_id = trial_id
+        self.config = config
+        self.scheduler = scheduler
+        self.results = dict()  # epoch -> _roc_auc_best metrics
+        self.stopped_at = None
+
+    def report(self, epoch, roc_auc_best):
+        """ called by train_and_evaluate after every evaluation """
+        self.results[epoch] = dict(roc_auc_best)
+        value = self.scheduler.get_metric(roc_auc_best)
+        promoted = self.scheduler.on_result(epoch, value)
+        if not promoted:
+            self.stopped_at = epoch
+        return promoted
+
+    def best(self):
+        if len(self.results) == 0:
+            return -np.inf
+        return max(self.scheduler.get_metric(r) for r in self.results.values())
+
+    def last_epoch(self):
+        return max(self.results.keys()) if len(self.results) > 0 else -1
+
+
+def run_sweep(args, search_space):
+    """
+    :param args: arguments of main_novelty.py shared by all trials
+    :param search_space: dict of argument name -> list of values, every combination is one trial
+    :return: list of finished Trials sorted by their best metric
+    """
+    if args.metric is None:
+        # score networks only report score norm metrics
+        args.metric = "_best_score_norm_aggregate" if args.score_network else "_best_log_density_aggregate"
+    if args.score_network and "log_density" in args.metric:
+        raise ValueError(f"--score_network trials report no log-density metrics, choose a score_norm metric or 'max' instead of '{args.metric}'")
+    scheduler = ASHAScheduler(max_epochs=args.epochs, grace_period=args.grace_period,
+                              reduction_factor=args.reduction_factor, metric=args.metric)
+    print(f"ASHA rungs at epochs {scheduler.rungs}")
+
+    names = list(search_space.keys())
+    configs = [dict(zip(names, values)) for values in itertools.product(*[search_space[n] for n in names])]
+    if args.shuffle_trials:
+        np.random.RandomState(args.sweep_seed).shuffle(configs)
+
+    trials = list()
+    for trial_id, config in enumerate(configs):
+        trial_args = copy.deepcopy(args)
+        for name, value in config.items():
+            setattr(trial_args, name, value)
+        if trial_args.beta == 0:
+            trial_args.beta = None
+        trial_args.experiment_name = f"{args.experiment_name}/trial_{trial_id}_" + "_".join(f"{k}_{v}" for k, v in config.items())
+
+        print(f"Trial {trial_id + 1}/{len(configs)}: {config}")
+        trial = Trial(trial_id, config, scheduler)
+        main_novelty.train_and_evaluate(trial_args, trial=trial)
+        trials.append(trial)
+
+    trials = sorted(trials, key=lambda t: t.best(), reverse=True)
+    total_epochs = sum(t.last_epoch() for t in trials)
+    print(f"Sweep finished, {total_epochs} epochs trained instead of {len(trials) * args.epochs}")
+    for trial in trials:
+        status = f"stopped at epoch {trial.stopped_at}" if trial.stopped_at is not None else "completed"
+        print(f"{args.metric}: {trial.best():.4f} {trial.config} ({status})")
+    return trials
+
+
+if __name__ == '__main__':
+    parser = main_novelty.get_parser()
+    parser.set_defaults(experiment_name="MULDE_sweep")
+    parser.add_argument('--sweep_sigma_mean', nargs='+', type=float, default=None, help='values of sigma_mean to sweep')
+    parser.add_argument('--sweep_std_dev', nargs='+', type=float, default=None, help='values of std_dev to sweep')
+    parser.add_argument('--sweep_beta', nargs='+', type=float, default=None, help='values of beta to sweep, 0 disables the regularizer')
+    parser.add_argument('--grace_period', type=int, default=5, help='epoch of the first rung')
+    parser.add_argument('--reduction_factor', type=int, default=3, help='keep the best 1/reduction_factor trials at every rung')
+    parser.add_argument('--metric', type=str, default=None, choices=roc_auc_best_metrics + ["max"],
+                        help='defaults to _best_log_density_aggregate, _best_score_norm_aggregate with --score_network')
+    parser.add_argument('--shuffle_trials', action='store_true', help='run the trials in random order')
+    parser.set_defaults(shuffle_trials=False)
+    parser.add_argument('--sweep_seed', type=int, default=0)
+
+    args = parser.parse_args()
+    search_space = {name: getattr(args, f"sweep_{name}") for name in ["sigma_mean", "std_dev", "beta"]
+                    if getattr(args, f"sweep_{name}") is not None}
+    if len(search_space) == 0:
+        parser.error("nothing to sweep, pass at least one of --sweep_sigma_mean, --sweep_std_dev, --sweep_beta")
+    run_sweep(args, search_space)
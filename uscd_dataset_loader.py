@@ -1,7 +1,16 @@
+import json
 import numpy as np
 import os
 import tifffile as tiff
+from data_utils import RunningMoments, CORESET_METHODS, k_center_greedy, frame_difference_selection
+from frame_store import FrameStore, FrameStoreDataset
 import re 
+import zlib
+
+# frame cache with its resolution pyramid (see update_frame_cache), cached static pixel masks (see load_static_pixel_mask) and coresets (see load_coreset)
+CACHE_DIR = "cache"
+# downsampling factors of the resolution pyramid
+PYRAMID_FACTORS = (1, 2, 4, 8)
 
 def parse_ground_truth_m_file(m_file_path):
     """
@@ -50,7 +59,362 @@ def get_label_for_frame(img_file, gt_frames):
 
     return 1 if frame_number in gt_frames else 0
 
-def get_dataset(data_dir, m_file_path, seed=None):
+def get_ground_truth_frames(folder, TestVideoFile):
+    """
+    Returns the anomalous frame numbers of a test video folder, e.g. 'Test001' -> TestVideoFile[0]['gt_frame'].
+    """
+    # Extract video index from folder name, e.g., 'Test1' -> 0
+    video_match = re.search(r'\d+', folder)
+    if video_match:
+        video_index = int(video_match.group()) - 1
+        # Ensure video_index is within bounds
+        if video_index < len(TestVideoFile):
+            return TestVideoFile[video_index]['gt_frame']
+        print(f"Warning: Video index {video_index} out of range for folder '{folder}'.")
+        return []
+    print(f"Warning: Could not extract video index from folder '{folder}'.")
+    return []
+
+def load_ucsd_video(folder_path, gt_frames=None):
+    """
+    Loads the .tif frames of one video folder.
+
+    Parameters:
+        folder_path (str): Folder of the .tif frames of the video.
+        gt_frames (list of int, optional): Anomalous frame numbers, None for training videos (all frames normal).
+
+    Returns:
+        tuple: (n, H * W) flattened frames divided by 255 and (n,) labels.
+    """
+    data = []
+    labels = []
+    for img_file in sorted(os.listdir(folder_path)):
+        if img_file.endswith('.tif'):
+            img_path = os.path.join(folder_path, img_file)
+            try:
+                img = tiff.imread(img_path)
+                img = img / 255.0  # Normalize pixel values
+                img_flattened = img.flatten()
+                data.append(img_flattened)
+
+                # Assign labels
+                if gt_frames is None:
+                    labels.append(0)  # All training frames are normal
+                else:
+                    label = get_label_for_frame(img_file, gt_frames)
+                    labels.append(label)
+            except tiff.TiffFileError as e:
+                print(f"Error reading {img_file}: {e}")
+                continue
+    return np.array(data), np.array(labels)
+
+def iter_ucsd_videos(path, TestVideoFile, train=True):
+    """
+    Iterates the videos (one folder of .tif frames per video) of a split in sorted order.
+
+    Parameters:
+        path (str): Train or Test directory of the dataset.
+        TestVideoFile (list of dict): Ground truth of the test videos, see parse_ground_truth_m_file.
+        train (bool): If True, all frames are labeled normal.
+
+    Yields:
+        tuple: Folder name, (n, H * W) flattened frames divided by 255 and (n,) labels of a video.
+    """
+    # Each folder represents each video
+    for folder in sorted(os.listdir(path)):
+        folder_path = os.path.join(path, folder)
+        if os.path.isdir(folder_path):
+            gt_frames = None if train else get_ground_truth_frames(folder, TestVideoFile)
+            data, labels = load_ucsd_video(folder_path, gt_frames)
+            if len(data):
+                yield folder, data, labels
+
+def load_ucsd_data(path, TestVideoFile, train=True, return_video_lengths=False):
+    """
+    Loads the .tif frames of all videos of a split, see iter_ucsd_videos.
+
+    Returns:
+        tuple: (N, H * W) flattened frames divided by 255 and (N,) labels,
+            with return_video_lengths also the list of the number of frames of every video.
+    """
+    data = []
+    labels = []
+    for _, frames, labels_ in iter_ucsd_videos(path, TestVideoFile, train=train):
+        data.append(frames)
+        labels.append(labels_)
+    video_lengths = [len(labels_) for labels_ in labels]
+    if not data:
+        data, labels = np.array([]), np.array([])
+    else:
+        data, labels = np.concatenate(data), np.concatenate(labels)
+    return (data, labels, video_lengths) if return_video_lengths else (data, labels)
+
+def pixel_std(data, chunk_size=256):
+    """
+    Computes the per-pixel standard deviation over frames in two passes over row chunks,
+    without the full-size temporary of data.std(axis=0).
+
+    Parameters:
+        data (np.ndarray): (N, D) flattened frames.
+
+    Returns:
+        np.ndarray: (D,) unbiased standard deviation of every pixel.
+    """
+    return RunningMoments.from_data(data, chunk_size=chunk_size).std()
+
+def data_checksum(data, chunk_size=256):
+    """
+    Returns a CRC32 checksum of the shape and the values of an array, computed over row chunks. Caches derived from
+    the training frames are keyed on it, so that they are recomputed when any frame changes, e.g. a rewritten video
+    with the same number of frames.
+    """
+    checksum = zlib.crc32(json.dumps(list(data.shape)).encode())
+    for start in range(0, len(data), chunk_size):
+        checksum = zlib.crc32(np.ascontiguousarray(data[start:start + chunk_size]).tobytes(), checksum)
+    return checksum
+
+def load_static_pixel_mask(data_train, threshold, cache_path=None):
+    """
+    Returns the indices of the pixels that vary across the training frames. With a static camera most pixels
+    only change by sensor noise and carry no information for the density model, dropping them shrinks the input.
+    The indices are cached and recomputed if the cached ones were computed on different training frames or with a
+    different threshold, see data_checksum.
+
+    Parameters:
+        data_train (np.ndarray): (N, D) flattened training frames.
+        threshold (float): Pixels with a standard deviation over the training frames of at most threshold are dropped.
+        cache_path (str, optional): .npz file the indices are cached in.
+
+    Returns:
+        np.ndarray: Sorted indices of the kept pixels.
+    """
+    checksum = data_checksum(data_train)
+    if cache_path is not None and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if "checksum" in cached and cached["checksum"] == checksum and cached["threshold"] == threshold:
+            return cached["indices"]
+
+    indices = np.flatnonzero(pixel_std(data_train) > threshold)
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        np.savez(cache_path, indices=indices, checksum=checksum, threshold=threshold)
+    return indices
+
+def static_pixel_cache_path(data_dir, threshold, cache_dir=CACHE_DIR, resolution=None):
+    suffix = f"_r{resolution}" if resolution not in (None, 1) else ""
+    return os.path.join(cache_dir, f"static_pixels_{os.path.basename(os.path.normpath(data_dir))}_{threshold}{suffix}.npz")
+
+def load_coreset(data_train, video_lengths, method="k_center", size=0.1, threshold=0.01, frame_shape=None, factor=4, cache_path=None):
+    """
+    Returns the indices of a representative subset of the training frames. Consecutive frames of a static camera are
+    nearly identical, training and reference statistics on a coreset cost a fraction of the full set.
+    The frames are compared after area downsampling, the indices are cached and recomputed if the cached ones were
+    computed on different training frames or videos or with different parameters, see data_checksum.
+
+    Parameters:
+        data_train (np.ndarray): (N, D) flattened training frames, consecutive per video.
+        video_lengths (list): Number of frames of every training video.
+        method (str): 'k_center' for a greedy k-center coreset of round(size * N) frames, 'frame_difference' to keep
+            the frames whose mean absolute difference to the last kept frame of the video exceeds threshold.
+        frame_shape (tuple, optional): (H, W) of the frames, None compares the frames without downsampling,
+            e.g. frames reduced to the non-static pixels.
+        factor (int): Downsampling factor of the frames compared.
+        cache_path (str, optional): .npz file the indices are cached in.
+
+    Returns:
+        np.ndarray: Sorted indices of the selected frames.
+    """
+    # the selection depends on the frames, the video boundaries and the parameters of the method
+    parameters = json.dumps(dict(method=method, size=size, threshold=threshold, frame_shape=frame_shape and list(frame_shape), factor=factor,
+                                 video_lengths=list(map(int, video_lengths))))
+    checksum = data_checksum(data_train)
+    if cache_path is not None and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if "checksum" in cached and cached["checksum"] == checksum and str(cached["parameters"]) == parameters:
+            return cached["indices"]
+
+    features = area_downsample(data_train, frame_shape, factor) if frame_shape is not None and factor > 1 else data_train
+    if method == "k_center":
+        indices = k_center_greedy(features, max(1, round(size * len(data_train))))
+    elif method == "frame_difference":
+        indices = frame_difference_selection(features, video_lengths, threshold)
+    else:
+        raise ValueError(f"Unknown coreset method '{method}', expected one of {CORESET_METHODS}")
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        np.savez(cache_path, indices=indices, checksum=checksum, parameters=parameters)
+    return indices
+
+def coreset_cache_path(data_dir, method, size, threshold, factor, cache_dir=CACHE_DIR, resolution=None, static_pixel_threshold=None, video_stride=1):
+    parameter = size if method == "k_center" else threshold
+    suffix = f"_r{resolution}" if resolution not in (None, 1) else ""
+    suffix += f"_s{static_pixel_threshold}" if static_pixel_threshold is not None else ""
+    suffix += f"_v{video_stride}" if video_stride != 1 else ""
+    return os.path.join(cache_dir, f"coreset_{os.path.basename(os.path.normpath(data_dir))}_{method}_{parameter}_d{factor}{suffix}.npz")
+
+def area_downsample(frames, frame_shape, factor, chunk_size=256):
+    """
+    Area-averaged downsampling of flattened frames, every output pixel is the mean of a factor x factor block.
+    Rows and columns at the border that do not fill a block are cropped.
+
+    Parameters:
+        frames (np.ndarray): (N, H * W) flattened frames of any dtype.
+        frame_shape (tuple): (H, W).
+        factor (int): Downsampling factor.
+
+    Returns:
+        np.ndarray: (N, (H // factor) * (W // factor)) float32 flattened frames.
+    """
+    height, width = frame_shape[0] // factor, frame_shape[1] // factor
+    downsampled = np.empty((len(frames), height * width), dtype=np.float32)
+    for start in range(0, len(frames), chunk_size):
+        chunk = frames[start:start + chunk_size].reshape(-1, *frame_shape)[:, :height * factor, :width * factor].astype(np.float32)
+        downsampled[start:start + len(chunk)] = chunk.reshape(-1, height, factor, width, factor).mean(axis=(2, 4)).reshape(len(chunk), -1)
+    return downsampled
+
+def frame_cache_dir(data_dir, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f"frames_{os.path.basename(os.path.normpath(data_dir))}")
+
+def video_signature(folder_path, gt_frames=None):
+    """
+    Returns the number, total size and latest modification time of the .tif files of a video folder and a checksum of
+    its ground truth, which change when frames are added, removed or rewritten or the labels change.
+    """
+    stats = [entry.stat() for entry in os.scandir(folder_path) if entry.name.endswith('.tif')]
+    return [len(stats), sum(stat.st_size for stat in stats), max((stat.st_mtime_ns for stat in stats), default=0),
+            zlib.crc32(json.dumps(gt_frames).encode())]
+
+def load_frame_cache_manifest(data_dir, cache_dir=CACHE_DIR):
+    """ Returns the manifest of the frame cache, None if there is no cache. """
+    manifest_path = os.path.join(frame_cache_dir(data_dir, cache_dir), "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def update_frame_cache(data_dir, m_file_path, cache_dir=CACHE_DIR, factors=()):
+    """
+    Brings the frame cache in sync with the video folders of the dataset. Only videos that are new or changed since the
+    manifest was written are decoded, removed videos are dropped. Every video is cached as uint8 frames (lossless for
+    8-bit frames) with its labels, a resolution pyramid of area-averaged frames (float16 in [0, 1]) and, for training
+    videos, the RunningMoments of every pyramid level, which are merged into the standardization statistics.
+    The manifest is written last, an interrupted update is redone on the next call.
+
+    Parameters:
+        factors (iterable of int): Downsampling factors to cache in addition to PYRAMID_FACTORS and the cached ones.
+
+    Returns:
+        dict: The manifest, frame_shape, factors and per split the videos with their signature and number of frames.
+    """
+    path = frame_cache_dir(data_dir, cache_dir)
+    manifest = load_frame_cache_manifest(data_dir, cache_dir) or dict(factors=list(PYRAMID_FACTORS), videos=dict())
+    manifest["factors"] = sorted(set(manifest["factors"]) | set(factors))
+    TestVideoFile = parse_ground_truth_m_file(m_file_path)
+    decoded = 0
+    for split, train in [("train", True), ("test", False)]:
+        split_path = os.path.join(data_dir, split.capitalize())
+        os.makedirs(os.path.join(path, split), exist_ok=True)
+        cached = {video["name"]: video for video in manifest["videos"].get(split, [])}
+        videos = []
+        for folder in sorted(os.listdir(split_path)):
+            folder_path = os.path.join(split_path, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            gt_frames = None if train else get_ground_truth_frames(folder, TestVideoFile)
+            signature = video_signature(folder_path, gt_frames)
+            prefix = os.path.join(path, split, folder)
+            video = cached.pop(folder, None)
+            if video is None or video["signature"] != signature:
+                data, labels = load_ucsd_video(folder_path, gt_frames)
+                if not len(data):
+                    continue
+                manifest.setdefault("frame_shape", list(get_frame_shape(split_path)))
+                np.save(f"{prefix}_labels.npy", labels)
+                np.save(f"{prefix}_r1.npy", np.round(data * 255.).astype(np.uint8))
+                del data
+                video = dict(name=folder, signature=signature, n_frames=len(labels), factors=[])
+                decoded += 1
+
+            for factor in sorted(set(manifest["factors"]) - set(video["factors"])):
+                frames = np.load(f"{prefix}_r1.npy", mmap_mode="r")
+                if factor == 1:
+                    level = frames.astype(np.float32) / 255.
+                else:
+                    level = (area_downsample(frames, manifest["frame_shape"], factor) / 255.).astype(np.float16)
+                    np.save(f"{prefix}_r{factor}.npy", level)
+                if train:
+                    np.savez(f"{prefix}_r{factor}_moments.npz", **RunningMoments.from_data(level.astype(np.float32)).state_dict())
+                video["factors"] = sorted(video["factors"] + [factor])
+            videos.append(video)
+
+        for removed in cached:  # folders that no longer exist
+            for file in os.listdir(os.path.join(path, split)):
+                if file.startswith(f"{removed}_"):
+                    os.remove(os.path.join(path, split, file))
+        manifest["videos"][split] = videos
+
+    tmp_path = os.path.join(path, "manifest.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(path, "manifest.json"))
+    if decoded:
+        print(f"Frame cache: decoded {decoded} new or changed videos")
+    return manifest
+
+def get_frame_shape(path):
+    """ Returns the (H, W) shape of the first .tif frame of the videos in path. """
+    for folder in sorted(os.listdir(path)):
+        folder_path = os.path.join(path, folder)
+        if os.path.isdir(folder_path):
+            for img_file in sorted(os.listdir(folder_path)):
+                if img_file.endswith('.tif'):
+                    return tiff.imread(os.path.join(folder_path, img_file)).shape
+    raise FileNotFoundError(f"No .tif frames found in {path}")
+
+def load_frame_cache(data_dir, m_file_path, resolution=1, cache_dir=CACHE_DIR):
+    """
+    Loads frames at a resolution of the pyramid from the frame cache, after updating the cache with update_frame_cache.
+    Levels that are not cached yet are computed from the cached full-resolution frames without decoding the .tif files.
+
+    Parameters:
+        resolution (int): Downsampling factor, e.g. 2, 4 or 8 for 120x180, 60x90 or 30x45 frames.
+
+    Returns:
+        tuple: (N, H * W) float32 training frames in [0, 1], training labels, test frames and test labels.
+    """
+    manifest = update_frame_cache(data_dir, m_file_path, cache_dir, factors=[resolution])
+    path = frame_cache_dir(data_dir, cache_dir)
+    frame_size = (manifest["frame_shape"][0] // resolution) * (manifest["frame_shape"][1] // resolution)
+    splits = []
+    for split in ["train", "test"]:
+        videos = manifest["videos"][split]
+        frames = np.empty((sum(video["n_frames"] for video in videos), frame_size), dtype=np.float32)
+        start = 0
+        for video in videos:
+            frames_ = np.load(os.path.join(path, split, f"{video['name']}_r{resolution}.npy"))
+            frames[start:start + len(frames_)] = frames_.astype(np.float32) / 255. if frames_.dtype == np.uint8 else frames_
+            start += len(frames_)
+        labels = [np.load(os.path.join(path, split, f"{video['name']}_labels.npy")) for video in videos]
+        splits += [frames, np.concatenate(labels) if labels else np.array([])]
+    return tuple(splits)
+
+def load_train_moments(data_dir, resolution=1, cache_dir=CACHE_DIR):
+    """
+    Merges the cached moments of the training videos of the frame cache, e.g. for the standardization statistics
+    without a pass over the training frames. The cache has to be up to date, see update_frame_cache.
+
+    Returns:
+        RunningMoments: Per-pixel moments of all training frames at the resolution.
+    """
+    manifest = load_frame_cache_manifest(data_dir, cache_dir)
+    moments = RunningMoments()
+    for video in manifest["videos"]["train"]:
+        moments = moments.merge(RunningMoments(**np.load(os.path.join(frame_cache_dir(data_dir, cache_dir), "train",
+                                                                      f"{video['name']}_r{resolution}_moments.npz"))))
+    return moments
+
+def get_dataset(data_dir, m_file_path, seed=None, static_pixel_threshold=None, static_pixel_indices=None, resolution=None, store_path=None,
+                cache_dir=CACHE_DIR, return_video_lengths=False, return_static_pixel_indices=False, lazy_train=False):
     """
     Loads the UCSD dataset with dynamic ground truth extraction from a .m file.
 
@@ -58,73 +422,87 @@ def get_dataset(data_dir, m_file_path, seed=None):
         data_dir (str): Directory where the UCSD dataset is located.
         m_file_path (str): Path to the .m file containing ground truth definitions.
         seed (int, optional): Random seed for reproducibility.
+        static_pixel_threshold (float, optional): If given, only the pixels with a standard deviation over the training
+            frames above the threshold are returned, see load_static_pixel_mask.
+        static_pixel_indices (array-like, optional): Indices of the pixels to return, e.g. the static_pixel_indices
+            of a checkpoint, used instead of static_pixel_threshold.
+        resolution (int, optional): If given, the frames are loaded from the frame cache at this downsampling factor
+            (1 for the full 240x360 resolution, 2, 4, 8, ...) instead of decoding the .tif files, see load_frame_cache.
+        store_path (str, optional): If given, the frames are read from a single-file frame store written by
+            frame_store.py instead of the .tif files, downsampled if a resolution is given.
+        cache_dir (str): Directory of the frame cache and the cached static pixel masks.
+        return_video_lengths (bool): If True, a dict with the number of frames of every video of the 'train' and 'test'
+            split is appended to the returned tuple, the frames of the videos are consecutive in the returned arrays.
+        return_static_pixel_indices (bool): If True, the indices of the returned pixels are appended to the returned
+            tuple, None if all pixels are returned, e.g. to save them with a checkpoint.
+        lazy_train (bool): If True, the training data is returned as a FrameStoreDataset of store_path that decompresses
+            the frames chunk by chunk on access instead of an array, only the test frames are loaded into memory.
 
     Returns:
         tuple: Contains training data, training labels, test data, test labels, and label types.
     """
-    def load_ucsd_data(path, TestVideoFile, train=True):
-        data = []
-        labels = []
-
-        # Each folder represents each video
-        for folder in sorted(os.listdir(path)):
-            folder_path = os.path.join(path, folder)
-            if os.path.isdir(folder_path):
-                if not train:
-                    # Extract video index from folder name, e.g., 'Test1' -> 0
-                    video_match = re.search(r'\d+', folder)
-                    if video_match:
-                        video_index = int(video_match.group()) - 1
-                        # Ensure video_index is within bounds
-                        if video_index < len(TestVideoFile):
-                            gt_frames = TestVideoFile[video_index]['gt_frame']
-                        else:
-                            print(f"Warning: Video index {video_index} out of range for folder '{folder}'.")
-                            gt_frames = []
-                    else:
-                        print(f"Warning: Could not extract video index from folder '{folder}'.")
-                        gt_frames = []
-                else:
-                    gt_frames = None
-
-                for img_file in sorted(os.listdir(folder_path)):
-                    if img_file.endswith('.tif'):
-                        img_path = os.path.join(folder_path, img_file)
-                        try:
-                            img = tiff.imread(img_path)
-                            img = img / 255.0  # Normalize pixel values
-                            img_flattened = img.flatten()
-                            data.append(img_flattened)
-
-                            # Assign labels
-                            if train:
-                                labels.append(0)  # All training frames are normal
-                            else:
-                                label = get_label_for_frame(img_file, gt_frames)
-                                labels.append(label)
-                        except tiff.TiffFileError as e:
-                            print(f"Error reading {img_file}: {e}")
-                            continue
-
-        return np.array(data), np.array(labels)
-
-    # Parse the .m file to get TestVideoFile
-    TestVideoFile = parse_ground_truth_m_file(m_file_path)
+    if lazy_train and (store_path is None or static_pixel_threshold is not None or static_pixel_indices is not None):
+        raise ValueError("lazy_train reads the training frames from store_path, it cannot select static pixels")
+    if store_path is not None:
+        store = FrameStore(store_path)
+        splits = []
+        for split in ["train", "test"]:
+            if split == "train" and lazy_train:
+                data_train_id = FrameStoreDataset(store_path, split, resolution=resolution)
+                splits += [data_train_id, data_train_id.labels]
+                continue
+            frames, labels = store.read_split(split)
+            frames = area_downsample(frames, store.frame_shape, resolution) if resolution not in (None, 1) else frames
+            splits += [frames.astype(np.float32) / 255., labels]
+        video_lengths = dict(train=store.video_lengths("train"), test=store.video_lengths("test"))
+        store.close()
+        data_train_id, labels_train_id, data_test, labels_test = splits
+    elif resolution is not None:
+        data_train_id, labels_train_id, data_test, labels_test = load_frame_cache(data_dir, m_file_path, resolution, cache_dir)
+        manifest = load_frame_cache_manifest(data_dir, cache_dir)
+        video_lengths = {split: [video["n_frames"] for video in manifest["videos"][split]] for split in ["train", "test"]}
+    else:
+        # Parse the .m file to get TestVideoFile
+        TestVideoFile = parse_ground_truth_m_file(m_file_path)
 
-    # Define paths for training and testing data
-    train_path = os.path.join(data_dir, 'Train')
-    test_path = os.path.join(data_dir, 'Test')
+        # Define paths for training and testing data
+        train_path = os.path.join(data_dir, 'Train')
+        test_path = os.path.join(data_dir, 'Test')
 
-    # Load train and test data
-    data_train_id, labels_train_id = load_ucsd_data(train_path, TestVideoFile, train=True)
-    data_test, labels_test = load_ucsd_data(test_path, TestVideoFile, train=False)
+        # Load train and test data
+        data_train_id, labels_train_id, video_lengths_train = load_ucsd_data(train_path, TestVideoFile, train=True, return_video_lengths=True)
+        data_test, labels_test, video_lengths_test = load_ucsd_data(test_path, TestVideoFile, train=False, return_video_lengths=True)
+        video_lengths = dict(train=video_lengths_train, test=video_lengths_test)
+
+    if static_pixel_indices is None and static_pixel_threshold is not None:
+        static_pixel_indices = load_static_pixel_mask(data_train_id, static_pixel_threshold,
+                                                      static_pixel_cache_path(data_dir, static_pixel_threshold, cache_dir, resolution))
+        print(f"Static pixel mask: keeping {len(static_pixel_indices)} of {data_train_id.shape[1]} pixels (std > {static_pixel_threshold})")
+    if static_pixel_indices is not None:
+        static_pixel_indices = np.asarray(static_pixel_indices)
+        data_train_id, data_test = data_train_id[:, static_pixel_indices], data_test[:, static_pixel_indices]
 
     id_to_type = {
         0: "normal",
         1: "anomaly"
     }
 
-    return data_train_id, labels_train_id, data_test, labels_test, id_to_type
+    dataset = (data_train_id, labels_train_id, data_test, labels_test, id_to_type)
+    if return_video_lengths:
+        dataset += (video_lengths,)
+    if return_static_pixel_indices:
+        dataset += (static_pixel_indices,)
+    return dataset
+
+def get_checkpoint_dataset(data_dir, m_file_path, checkpoint):
+    """
+    Loads the dataset at the resolution and with the pixels a checkpoint saved by main.py or distill.py was trained on.
+
+    Returns:
+        tuple: As get_dataset with return_video_lengths.
+    """
+    return get_dataset(data_dir, m_file_path, static_pixel_indices=checkpoint.get("static_pixel_indices"), resolution=checkpoint.get("resolution"),
+                       return_video_lengths=True)
 
 def create_meshgrid_from_data(data, n_points=100, meshgrid_offset=1):
     """
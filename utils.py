@@ -2,6 +2,7 @@ import json
 import os
 import pickle
 import numpy as np
+import torch
 import datetime
 from torch.utils.tensorboard import SummaryWriter
 from shutil import copyfile, copytree
@@ -56,4 +57,17 @@ class LossAccumulate:
         return self.losses.keys()
 
     def values(self):
-        return self.losses.values()
\ No newline at end of file
+        return self.losses.values()
+
+def clip_and_track_gradients(parameters, clip_value=None):
+    """
+    Clamps all gradients to [-clip_value, clip_value] in one fused foreach step after backward
+    and returns the maximum gradient and the global gradient L2-norm as device tensors, without synchronizing with the host.
+    """
+    parameters = [p for p in parameters if p.grad is not None]
+    if clip_value:
+        torch.nn.utils.clip_grad_value_(parameters, clip_value, foreach=True)
+    grads = [p.grad for p in parameters]
+    max_gradient = torch.cat([grad.reshape(-1) for grad in grads]).max()  # one reduction, torch._foreach_max is not in torch 2.3
+    global_norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads)))
+    return max_gradient, global_norm
@@ -0,0 +1,194 @@
+"""
+Streaming ingestion of encoded video files (.avi, .mp4, ...) with OpenCV instead of folders of .tif frames
+
+# train on videos laid out like the .tif dataset, <video_dir>/Train/*.avi and <video_dir>/Test/*.avi, test labels from the .m file
+python main.py --video_dir footage --video_stride 2 --resolution 2
+
+# decoding throughput of a video
+python video_loader.py --video footage/Test/Test001.avi --stride 2 --size 120 180
+
+Frames are decoded in a background thread into a bounded queue, only the converted (grayscale, resized) frames of
+the current batch are held in memory. Frame numbers are 1-based like the .tif file names and the ground truth.
+"""
+
+import argparse
+import os
+import queue
+import re
+import threading
+import time
+import cv2
+import numpy as np
+import torch
+
+VIDEO_EXTENSIONS = (".avi", ".mp4", ".mkv", ".mov", ".mpg", ".mpeg")
+
+_END = object()
+
+
+class VideoFrameReader:
+    def __init__(self, path, stride=1, grayscale=True, size=None, queue_size=64):
+        """
+        Iterates (frame number, frame) of a video file, decoded by a background thread.
+
+        :param stride: keep every stride-th frame, the skipped frames are grabbed but not converted
+        :param grayscale: convert BGR frames to single-channel grayscale
+        :param size: (H, W) output size, frames are resized with area interpolation, None keeps the size of the video
+        :param queue_size: frames decoded ahead of the consumer
+        :return: iterator of (1-based frame number, (H, W) or (H, W, 3) uint8 frame)
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Video file {path} not found")
+        self.path = path
+        self.stride = stride
+        self.grayscale = grayscale
+        self.size = size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _convert(self, frame):
+        if self.grayscale and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.size is not None and tuple(frame.shape[:2]) != tuple(self.size):
+            frame = cv2.resize(frame, (self.size[1], self.size[0]), interpolation=cv2.INTER_AREA)
+        return frame
+
+    def _put(self, item):
+        # blocks while the queue is full, gives up once the consumer closed the reader
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _decode(self):
+        capture = cv2.VideoCapture(self.path)
+        try:
+            if not capture.isOpened():
+                raise IOError(f"OpenCV cannot open {self.path}")
+            frame_idx = 0
+            while not self._stop.is_set():
+                if frame_idx % self.stride:
+                    if not capture.grab():
+                        break
+                else:
+                    ok, frame = capture.read()
+                    if not ok or not self._put((frame_idx + 1, self._convert(frame))):
+                        break
+                frame_idx += 1
+        except Exception as e:  # re-raised in the consumer
+            self._put(e)
+        finally:
+            capture.release()
+            self._put(_END)
+
+    def __iter__(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._decode, daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+
+
+def iter_video_batches(paths, batch_size, gt_frames=None, stride=1, grayscale=True, size=None):
+    """
+    Streams batches of flattened frames of one or several videos, like the batches of a DataLoader over get_dataset.
+    Batches may span videos, only the frames of the current batch are in memory.
+
+    :param paths: list of video files, read in order
+    :param gt_frames: optional list of anomalous frame numbers per video, None labels all frames normal
+    :return: iterator of (B, H * W) float tensors in [0, 1] and (B,) label tensors
+    """
+    frames, labels = [], []
+    for video_idx, path in enumerate(paths):
+        anomalous = set(gt_frames[video_idx]) if gt_frames is not None else set()
+        for frame_number, frame in VideoFrameReader(path, stride=stride, grayscale=grayscale, size=size):
+            frames.append(frame.reshape(-1))
+            labels.append(1 if frame_number in anomalous else 0)
+            if len(frames) == batch_size:
+                yield torch.from_numpy(np.stack(frames)).float() / 255., torch.Tensor(labels)
+                frames, labels = [], []
+    if frames:
+        yield torch.from_numpy(np.stack(frames)).float() / 255., torch.Tensor(labels)
+
+
+def load_video(path, gt_frames=None, stride=1, grayscale=True, size=None):
+    """
+    :return: (n, H * W) float32 frames in [0, 1] and (n,) labels of the kept frames of a video
+    """
+    frames, labels = [], []
+    anomalous = set(gt_frames or [])
+    for frame_number, frame in VideoFrameReader(path, stride=stride, grayscale=grayscale, size=size):
+        frames.append(frame.reshape(-1))
+        labels.append(1 if frame_number in anomalous else 0)
+    if not frames:
+        return np.zeros((0, 0), dtype=np.float32), np.array(labels)
+    return np.stack(frames).astype(np.float32) / 255., np.array(labels)
+
+
+def list_videos(path):
+    return sorted(os.path.join(path, file) for file in os.listdir(path) if file.lower().endswith(VIDEO_EXTENSIONS))
+
+
+def get_video_dataset(video_dir, m_file_path=None, stride=1, grayscale=True, size=None, return_video_lengths=False):
+    """
+    Counterpart of uscd_dataset_loader.get_dataset for encoded videos in <video_dir>/Train and <video_dir>/Test.
+    Test videos are matched to the ground truth of the .m file by the number in their file name, e.g. Test003.avi.
+
+    :param size: (H, W) frame size after resizing, None keeps the size of the videos (all videos must agree)
+    :return: data_train, labels_train, data_test, labels_test, id_to_type as returned by get_dataset,
+            with return_video_lengths also the dict of the number of kept frames of every video of the 'train' and 'test' split
+    """
+    from uscd_dataset_loader import parse_ground_truth_m_file, get_ground_truth_frames
+    TestVideoFile = parse_ground_truth_m_file(m_file_path) if m_file_path is not None else []
+    splits = []
+    video_lengths = dict()
+    for split in ["Train", "Test"]:
+        data, labels = [], []
+        for path in list_videos(os.path.join(video_dir, split)):
+            name = os.path.splitext(os.path.basename(path))[0]
+            gt_frames = get_ground_truth_frames(name, TestVideoFile) if split == "Test" and re.search(r'\d+', name) else None
+            frames, labels_ = load_video(path, gt_frames, stride=stride, grayscale=grayscale, size=size)
+            data.append(frames)
+            labels.append(labels_)
+        splits += [np.concatenate(data), np.concatenate(labels)]
+        video_lengths[split.lower()] = [len(labels_) for labels_ in labels]
+    if return_video_lengths:
+        return tuple(splits) + ({0: "normal", 1: "anomaly"}, video_lengths)
+    return tuple(splits) + ({0: "normal", 1: "anomaly"},)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--video", type=str, required=True, help='video file')
+    parser.add_argument("--stride", type=int, default=1, help='keep every stride-th frame')
+    parser.add_argument("--size", nargs=2, type=int, default=None, help='height and width of the resized frames')
+    parser.add_argument("--batch_size", type=int, default=256, help='')
+    parser.add_argument('--color', action='store_true', help='keep the color channels')
+    parser.set_defaults(color=False)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    n_frames = 0
+    for data, _ in iter_video_batches([args.video], args.batch_size, stride=args.stride, grayscale=not args.color, size=args.size):
+        n_frames += len(data)
+    elapsed = time.perf_counter() - start
+    print(f"{n_frames} frames of shape {tuple(data.shape[1:])} in {elapsed:.2f} s ({n_frames / elapsed:.1f} frames/s)")